@@ -6,6 +6,8 @@ results in histograms.
 The algorithm looks for the negative pusles by evaluating the derivative 
 of the wafeform. The falling steep slop must be in a certain range as well as 
 the pulse width to reject fake peaks caused by electronic noise.
+It is implemented in pulse_finder.py in the data_recording_software folder,
+the pulse recorder uses the same code for counting pulses while recording.
 Additional pulses which are smaller than the minimum threshold set during recording 
 are still recognized if they appear in the same waveform that triggered a record.
 
@@ -39,11 +41,19 @@ Final sections not necessary for pulse analysis but included for reference:
     ENERGY CALIBRATION PLOT: Plot linear energy calibration with fit parameters 
                              as shown in the paper.
     ALTERNATIVE code: Unused code which evalutes pulse integrals instead of amplitudes.
+
+For processing many datasets without plots (e.g. on a server), the loading, pulse
+finding, calibration and histogram stages are in pulse_analysis.py in the
+data_recording_software folder, which writes a summary per dataset:
+    cd ../../data_recording_software && python3 -m pulse_analysis DIRECTORY --out SUMMARY_DIR
                              
 
 Expected format for datasets: 
     - MessagePack format files (.msgp) as generated by HTML/js pulse recorder
     - Pandas data frames stored in python's .pkl file format as generated by pulse_recorder.py.
+    - .pulses files continuously written by pulse_recorder.py during the recording
+Datasets may contain complete waveforms or only a window around each pulse (see 
+WINDOW setting in pulse_recorder.py), the latter have an additional 'offset' column.
 
 
 
@@ -55,10 +65,20 @@ import pandas as pd
 import numpy as np
 import matplotlib as mpl
 import matplotlib.pyplot as plt
-from scipy.optimize import curve_fit
 import matplotlib.gridspec as gridspec  # for unequal plot boxes
 import decimal as D
-import msgpack
+import os
+import sys
+
+# the pulse finder is shared with the recording software
+try:
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "data_recording_software"))
+except NameError: # __file__ is not defined when running single cells in some IDEs
+    sys.path.append(os.path.join("..", "..", "data_recording_software"))
+# the analysis stages are also available as functions for batch processing (python3 -m pulse_analysis)
+from pulse_analysis import analyse_files, measurement_time, fit_calibration, poly1
+import pulse_analysis
+from spectrum import save_calibration
 
 mpl.rcParams['font.size']=12 #default font size
 
@@ -70,112 +90,82 @@ SHOW_DETECTED_PULSES = False # will take a long time for large date sets if enab
 OVERLAY_PULSES = False        # shows pulses overlayed and centered on largest amplitude of each pulse
 
 DEBUG = False   # enable for printed debug info on pulse characteristics
-DBG_ID = -1     # supply index to enable debug plot of single waveforms, starting from 0. set as -1 to disable
-
+DBG_ID = -1     # supply index of a waveform in the file to enable debug info on its pulses, starting from 0. set as -1 to disable
 
-### helper function
+USE_CACHE = True # reuse the pulse analysis results of earlier runs with the same files and parameters,
+                 # see result_cache.py (not used with the debug options and pulse plots above)
 
-def poly1(x, a, b): #1st grade polynom
-    return a*x + b
+SAVE_CALIBRATION = None # e.g. "../../data_recording_software/energy_calibration.json" to store the
+                        # peak amplitude calibration below for the online spectrum of the recorder
 
 # <codecell>
 #
 # SELECT DATASET
 #
     
-# read .msgp files from HTML/js pulse recorder
-#file_name = "./data/flight_from-middle-to-landing_GVA-LIS_EJU1445_09-08-2019_11-30.msgp"
-file_name = ""
-
-if file_name is not "":
-    with open(file_name,'rb') as file:
-       msgp = msgpack.unpackb(file.read(),encoding='utf-8')
-       df = pd.DataFrame(msgp)
-       if not isinstance(df['pulse'][0], (np.ndarray, np.generic)):
-           df_new = pd.DataFrame(columns=['pulse'])
-           # create numpy arrays
-           for i,row in df.iterrows():
-               df_new['pulse'].loc[i] = np.asarray(row['pulse'], dtype='int16')
-           df['pulse'] = df_new['pulse'] 
-       # javascript's Date() saves timestamp formated in UTC and milliseconds
-       df['ts'] = pd.to_datetime(df['ts']*1000000)
-       df['ts'] = df['ts'].dt.tz_localize(tz='UTC') 
-       # convert to desired time zone:
-       df['ts'] = df['ts'].dt.tz_convert('Europe/Berlin')
-       # make sure column order starts with timestamp
-       df = df[['ts','pulse']]
-       print(df)
+THL = -300 # same as settting in pulse_recorder.py, only waveforms going below THL are analysed
+
+# datasets are given as a list of files, which are read and analysed block by block,
+# so they don't need to fit into memory (see stream_analysis.py in ../../data_recording_software)
+
+# read .msgp files from HTML/js pulse recorder (timestamps in UTC)
+#files = ["./data/flight_from-middle-to-landing_GVA-LIS_EJU1445_09-08-2019_11-30.msgp"]
    
 # read python pickle files (.pkl) files recorded with pulse_recorder.py
-# df = pd.read_pickle("../data_recording_software/data/pulses_2019-08-01_23-05-42___8___0-00.pkl")
+#files = ["../../data_recording_software/data/pulses_2019-08-01_23-05-42___8___0-00.pkl"]
+
+# read .pulses files written by pulse_recorder.py (also works for interrupted recordings)
+#files = ["../../data_recording_software/data/pulses_2019-08-01_23-05-42.pulses"]
+
+# read all segments of a recording session (.pulses files rotated by pulse_recorder.py)
+#files = ["../../data_recording_software/data/pulses_2019-08-01_23-05-42.session.json"]
+
+# several files of one measurement (e.g. recorded on several days, see Columbite below) are
+# analysed in the given order, the rate uses the sum of their live times (see PULSE ANALYSIS)
 
 ###########################################################
 # load reference measurements (as discussed in the article)
 ###########################################################
    
 # KCl block, 9.44g ~3x3 cm measured at tickest 1 cm spot in the middle
-df = pd.read_pickle("./data/KCL_9-44g_1x3x3cm_touchingdiodecase_pulses_2019-07-08_23-07-18___947___11-47.pkl")
+files = ["./data/KCL_9-44g_1x3x3cm_touchingdiodecase_pulses_2019-07-08_23-07-18___947___11-47.pkl"]
 
 # Columbite stone
 # diode case touching large black spot on the stone
 # recorded on average at 25 deg C, 964 hPa, 50% humidity
 # => dew point 15 deg C, air density 0.00111979 g / (cm^3)
 # uncomment all for more than 70 hours of data or use dataset only partially 
-#df =  pd.read_pickle("./data/Columbit_diodecase_touching_big_spot_2019-06-27_19-46-14___11613___13-53.pkl")
-#df2 = pd.read_pickle("./data/Columbit_diodecase_touching_big_spot_2019-07-01_21-30-08___11145___14-08.pkl")
-#df3 = pd.read_pickle("./data/Columbit_diodecase_touching_big_spot_2019-07-02_20-50-51___10128___12-36.pkl")
-#df4 = pd.read_pickle("./data/Columbit_diodecase_touching_big_spot_2019-07-03_19-04-13___13515___16-59.pkl")
-#df5 = pd.read_pickle("./data/Columbit_diodecase_touching_big_spot_2019-07-04_20-20-16___10433___13-05.pkl")
-#df = df.append(df2, ignore_index = True)
-#df = df.append(df3, ignore_index = True)
-#df = df.append(df4, ignore_index = True)
-#df = df.append(df5, ignore_index = True)
+#files = [
+#    "./data/Columbit_diodecase_touching_big_spot_2019-06-27_19-46-14___11613___13-53.pkl",
+#    "./data/Columbit_diodecase_touching_big_spot_2019-07-01_21-30-08___11145___14-08.pkl",
+#    "./data/Columbit_diodecase_touching_big_spot_2019-07-02_20-50-51___10128___12-36.pkl",
+#    "./data/Columbit_diodecase_touching_big_spot_2019-07-03_19-04-13___13515___16-59.pkl",
+#    "./data/Columbit_diodecase_touching_big_spot_2019-07-04_20-20-16___10433___13-05.pkl"]
 
 # Mixed Alpha Source reference measurment for energy calibration
 # estimated 967 hPa, Temp 23 deg C, 40 % Humidity, 
 # => dew dew point 12 deg C, air density: 0.001123 [g/cm^3]
-#df = pd.read_pickle("./data/mixed_alpha_4236RP_pulses_2019-04-08_17-54-37___27022___0-49.pkl")
+#files = ["./data/mixed_alpha_4236RP_pulses_2019-04-08_17-54-37___27022___0-49.pkl"]
 
 # Radium watch hand, an old watch hand painted with radium-based radioluminescent paint
-#df = pd.read_pickle("./data/Radium_watch_hand_11mm_pulses_2019-06-27_11-46-55___30032___1-28.pkl")
+#files = ["./data/Radium_watch_hand_11mm_pulses_2019-06-27_11-46-55___30032___1-28.pkl"]
 
 # background radiation as measured in souterrain office at CERN, Meyrin, Switzerland
-#df = pd.read_pickle("./data/office_background_pulses_2019-07-17_22-14-10___48___14-44.pkl")
-
-# loading pulse waveforms into lp array
-
-lp = []
-
-THL = -300 # same as settting in pulse_recorder.py
-
-for i,p in df.iterrows():
-    if p.pulse.min() < (THL):
-        lp.append(p.pulse)
-        
-lp = np.asarray(lp[:])      # provide indexes here if leading or trainling pulses should be cut away
-
-#lp=[lp[46]]    # specify index for evaluating only single pulses
+#files = ["./data/office_background_pulses_2019-07-17_22-14-10___48___14-44.pkl"]
 
 # <codecell>
 
 # PULSE ANALYSIS
 
-count=0
-loopcnt =0
-areas = []
-peaks = []
 min_alpha_peak = 1243 # used for highlithing beta vs. alpha pulses
 
+# pulse finder settings, see pulse_finder.py in ../../data_recording_software
 min_g = -20 # steepeness of falling edge slope, almost vertical
 max_g = -3300 # limit to ignore vertical lines
 min_length = 44  # about 0.9 ms
 max_length = 120 # about 2.5 ms, tolerates some alpha-pileup
 min_skip = min_length # was 25
 
-# arrays storing identified pulse waveforms for later plotting
-xpulses = []
-ypulses = []
-
 if SHOW_DETECTED_PULSES:
     fig = plt.figure()
     wf = fig.add_subplot(111)
@@ -195,104 +185,66 @@ if DEBUG:
     fig2 = plt.figure()
     dbg = fig2.add_subplot(111)
 
-gmax=0
-for i,y in enumerate(lp[:]):
-    dydx=np.gradient(y)
-    gy= dydx.min() 
-    gx= dydx.argmin() 
-
-    if DEBUG: 
-        print(i,"- max. gradient: ", gy, )
+def show_block(block, found):
+    """debug output and plots of the waveforms and pulses of one block of the dataset"""
+    lp = block['pulse']
+    for row in (np.flatnonzero(lp.min(axis=1) < THL) if DEBUG else []):
+        i = block['index'][row]
+        y = lp[row]
+        print(i,"- max. gradient: ", np.gradient(y).min(), )
         #show waveform
         x = range(len(y))
         dbg.plot(x, y, alpha=0.3)
         dbg.text(x[y.argmin()], y.min(), i) #lable pulse with id
-
-    while True:
-        # check if waveform and falling edge starts within +/- THL range and if falling slope is large enough 
-        if y[0] > THL and y[0] < np.abs(THL) and y.min() < THL and y[gx] <= np.abs(THL) and gy < min_g and gy > max_g: #and gy > -100:
-            # find next trigger point based on gradient
-            trigx=np.where(dydx < min_g)[0]
-            trigy=dydx[dydx < min_g]
-            peakx1=trigx[0]
-            # check where pulse goes back up to original trigger level
-            crossing_x1 = (y[peakx1+min_length:] > y[peakx1]).argmax() if (y[peakx1+min_length:] > y[peakx1]).any() else -1
-            if crossing_x1 > 0:
-                peakx2=peakx1+crossing_x1+min_length #because crossing_x1 is offset by min_length!
-                diff = np.abs(peakx2 - peakx1)
-                peak = y[peakx1:peakx2].min() 
-                if DEBUG or i == DBG_ID: #or (peak <= -300 and peak >= -310): 
-                    print(i, "- pulse width: ", diff, " max. amplitude: ", peak, "x1/x2: ", peakx1,peakx2)
-                if diff >= min_length and diff <= max_length and peak <= THL :
-                     area = np.absolute(y[peakx1:peakx2]).sum()
-                     areas.append(area)
-                     peak = np.absolute(peak) + y[peakx1] #+ THL -> removing THL offset inlcudes smaller pulses!
-                     if peak < 0:
-                         if DEBUG: print(i,"- peak below THL",peak)
-                     peaks.append(peak)
-                     ypulse = np.roll(y[peakx1-100:peakx2+100],50-y[peakx1:peakx2].argmin())[130:]
-                     if ypulse.size > min_length:
-                         #FIXME: why are some empty?
-                         xpulses.append(list(range(len(ypulse))))
-                         ypulses.append(ypulse)
-                     if SHOW_DETECTED_PULSES: #and peak <= 10:
-                         x = range(len(y))
-                         # wf.plot(y, "black", alpha=0.1)
-                         if OVERLAY_PULSES:
-                             wf.plot(ypulse, "green", alpha=(1/255)) #alpha=(1/255) for smallest setting, 0.1 otherwise
-                             # uncomment below to print index labels next to max pulse amplitude
-                             #wf.text(x[y[peakx1:peakx2].argmin()],y[peakx1:peakx2].min(), i) #lable pulse with id
-                         else:
-                             if peak > min_alpha_peak:
-                                 wf.plot(x[peakx1:peakx2],y[peakx1:peakx2], "red") #, alpha=0.1) 
-                             else:
-                                 wf.plot(x[peakx1:peakx2],y[peakx1:peakx2], "blue") #, alpha=0.1)                    
-                     if gy < gmax:
-                         gmax=gy
-                     count+=1
-                else:
-                    # can be falling slope of overshoot!
-                    if DEBUG or i == DBG_ID:
-                        print(i,"- strange pulse: ", peakx1,peakx2)
-                        #show waveform
-                        #x = range(len(y))
-                        #dbg.plot(x, y, "black")
-                    peakx2=peakx1+min_skip # shift waveform by min_length for next iteration
-                    #raise SystemExit #stop script here if needed
-            else:
-                if DEBUG:
-                   print(i,"- pulse discontinous")
-                   # show trigger points
-                   #dbg.plot(trigx, trigy, "b+")
-                peakx2 = peakx1 + min_skip # shift waveform by min_length for next iteration
-                #raise SystemExit
-
-        else:
-            # remove some data at the front
-            peakx1=0
-            remaining = len(y)
-            if remaining <  min_length:
-                break
+    for p in found:
+        i = block['index'][p['frame']]
+        y = lp[p['frame']]
+        peakx1 = p['position']
+        peakx2 = peakx1 + p['width']
+        peak = p['amplitude']
+        if DEBUG or i == DBG_ID:
+            print(i, "- pulse width: ", p['width'], " max. amplitude: ", p['peak'], "x1/x2: ", peakx1,peakx2)
+            if peak < 0:
+                print(i,"- peak below THL",peak)
+        if SHOW_DETECTED_PULSES: #and peak <= 10:
+            x = range(len(y))
+            # wf.plot(y, "black", alpha=0.1)
+            if OVERLAY_PULSES:
+                ypulse = np.roll(y[max(peakx1-100,0):peakx2+100],50-y[peakx1:peakx2].argmin())[130:]
+                wf.plot(ypulse, "green", alpha=(1/255)) #alpha=(1/255) for smallest setting, 0.1 otherwise
+                # uncomment below to print index labels next to max pulse amplitude
+                #wf.text(x[y[peakx1:peakx2].argmin()],y[peakx1:peakx2].min(), i) #lable pulse with id
             else:
-                peakx2=min_skip
-        y = np.delete(y, slice(0,peakx2)) #skip processed data
-        if len(y) < min_length:
-            break # not enough samples left, got to next waveform
-        else:
-            dydx=np.delete(dydx, slice(0,peakx2))
-            # find next falling edge
-            gy= dydx.min() 
-            gx= dydx.argmin() 
-        loopcnt+=1
-
-
-time_diff = df.iloc[-1,0] - df.iloc[0,0]
-time_diff = time_diff.total_seconds() / 60.0
+                if peak > min_alpha_peak:
+                    wf.plot(x[peakx1:peakx2],y[peakx1:peakx2], "red") #, alpha=0.1) 
+                else:
+                    wf.plot(x[peakx1:peakx2],y[peakx1:peakx2], "blue") #, alpha=0.1)                    
+
+# the files are analysed block by block and only the results of each pulse are kept,
+# see analyse_blocks() in stream_analysis.py and find_pulses_block() in pulse_finder.py
+finder_params = dict(min_g=min_g, max_g=max_g, min_length=min_length, max_length=max_length, min_skip=min_skip)
+result = analyse_files(files, THL, use_cache=USE_CACHE,
+                       on_block=show_block if DEBUG or SHOW_DETECTED_PULSES or DBG_ID >= 0 else None, **finder_params)
+print(sum(f.get('cached', False) for f in result['files']), "of", len(result['files']), "files from the results cache")
+pulses = result['pulses']
+pulse_map = result['map'] # aligned pulse shapes for the persistence plots below
+loopcnt = sum(f['waveforms'] for f in result['files']) # number of analysed waveforms
+count = len(pulses)
+areas = pulses['area']
+peaks = pulses['amplitude'] #+ THL -> removing THL offset inlcudes smaller pulses!
+print(loopcnt, "waveforms below THL")
+
+
+# live time: sum over the files of the live time stored by the recorder (minus vetoed
+# interference and lost frames) or the time from their first to last waveform,
+# see session.file_live_time(); the time between the files doesn't count
+time_diff = measurement_time(result)
 cpm = count/time_diff
-# FIXME: in case of concatenation of several datasets (e.g. columbite stone), 
-# the calculated overall measurement time period will be wrong
+if len(result['files']) > 1:
+    for f in result['files']:
+        print(os.path.basename(f['path']), "-", f['pulses'], "pulses in", round(f['live_time'] / 60.0), "minutes ->",
+              round(f['cpm'], 3) if f['cpm'] is not None else "-", "CPM")
 print("detected pulses:",count, "in", round(time_diff), "minutes ->", round(cpm,3), "CPM")
-peaks=np.asarray(peaks)
 
 # <codecell>
 #
@@ -302,51 +254,37 @@ peaks=np.asarray(peaks)
 #
 
 # reference centroids as estimated from AASI simulation results
-ref = np.asarray([33,1300, 3893, 4290, 4636]) # 11mm of air (1.123 kg/m^3 density) between detector and source
+ref = pulse_analysis.REF # 11mm of air (1.123 kg/m^3 density) between detector and source
 
 # centroids of peak amplitudes estimated from recorded histograms
-data_peak = np.asarray([300,2924,8175,8875, 9500]) # lowest value corresponds to threshold used in 33 keV X-ray measurement
+data_peak = pulse_analysis.DATA_PEAK # lowest value corresponds to threshold used in 33 keV X-ray measurement
 
 # alternative to using max. peak amplitudes: 
 # corresponding peak integrals/areas have been estimated here:
 # only applied to recorded data in disabled code at the very end
-data_area = np.asarray([1,107160,296230,321455, 339771]) 
+data_area = pulse_analysis.DATA_AREA
 
-thr_e_kev = 6    # estimated from threshold measurement with x-ray machine
-src_e_kev = 40.5 # results in best fit (reducedchisq ~= 1)
+thr_e_kev = pulse_analysis.THR_E_KEV # estimated from threshold measurement with x-ray machine
+src_e_kev = pulse_analysis.SRC_E_KEV # results in best fit (reducedchisq ~= 1)
 e_kev = [thr_e_kev,src_e_kev,src_e_kev,src_e_kev,src_e_kev]
 
-#http://www.physics.utah.edu/~detar/lessons/python/curve_fit/node1.html
-
-popt_area, pcov_area = curve_fit(poly1, data_area, ref, sigma=e_kev,absolute_sigma=True)
-popt_peak, pcov_peak = curve_fit(poly1, data_peak, ref, sigma=e_kev, absolute_sigma=True)
+# linear fits, see fit_calibration() in pulse_analysis.py
+fit_area = fit_calibration(data_area, ref, e_kev)
+fit_peak = fit_calibration(data_peak, ref, e_kev)
+popt_area, pcov_area, perr_area, data_fit_area = fit_area['popt'], fit_area['pcov'], fit_area['perr'], fit_area['fit']
+popt_peak, pcov_peak, perr_peak, data_fit_peak = fit_peak['popt'], fit_peak['pcov'], fit_peak['perr'], fit_peak['fit']
 
-data_fit_area = poly1(data_area,*popt_area)
-data_fit_peak = poly1(data_peak,*popt_peak)
-
-perr_area = np.sqrt(np.diag(pcov_area))
-perr_peak = np.sqrt(np.diag(pcov_peak))
 print("perr area: ", perr_area, ", perr peak: ", perr_peak)
-#calculation of residuals
-residuals = ref - data_fit_area
-ss_res = np.sum(residuals**2)
-ss_tot = np.sum((ref - np.mean(ref))**2)
-r_squared_a = 1 - (ss_res/ss_tot)
-
-chisq = np.sum((residuals/e_kev)**2)
-reducedchisq_area = chisq/float(len(data_area)-2)
+if SAVE_CALIBRATION:
+    save_calibration(SAVE_CALIBRATION, *popt_peak, errors=perr_peak.tolist(),
+                     source="analyse_and_plot_pulses.py: poly1 fit of data_peak " + str(data_peak.tolist()) +
+                            " vs. ref " + str(ref.tolist()) + " keV")
 
+r_squared_a, chisq, reducedchisq_area = fit_area['r_squared'], fit_area['chisq'], fit_area['reducedchisq']
 print('R squared curve_fit area is: ',(r_squared_a))
 print('chi sq.:', chisq, " red. chi sq.:",reducedchisq_area )
 
-residuals = ref - data_fit_peak
-ss_res = np.sum(residuals**2)
-ss_tot = np.sum((data_peak - np.mean(data_peak))**2)
-r_squared_p = 1 - (ss_res/ss_tot)
-
-chisq = np.sum((residuals/e_kev)**2)
-reducedchisq = chisq/float(len(data_peak)-2)
-
+r_squared_p, chisq, reducedchisq = fit_peak['r_squared'], fit_peak['chisq'], fit_peak['reducedchisq']
 print('R squared curve_fit peak is: ',(r_squared_p))
 print('chi sq.:', chisq, " red. chi sq.:",reducedchisq )
 
@@ -668,7 +606,9 @@ wf.set_ylabel('Audio signal amplitude [arb. unit]', fontsize = 14)
 #wf.set_ylim(-1300,400) # beta pulse range
 wf.set_ylim(-17000,5000) # complete alpha pulse range
 fig.tight_layout() #rect=(0.05,-0.010,1.01,1.02))
-hb = wf.hexbin(np.ravel(xpulses), np.asarray(ypulses).ravel(), gridsize=188, cmap='Greens', mincnt=1, vmax=100)
+counts, y_edges = pulse_map.image(120) # accumulated while analysing, see PulseMap in stream_analysis.py
+hb = wf.pcolormesh(np.arange(counts.shape[0] + 1), np.append(y_edges, y_edges[-1] + 120),
+                   np.ma.masked_equal(counts.T, 0), cmap='Greens', vmax=100)
 #cb = fig.colorbar(hb, ax=wf)
 
 # <codecell>
@@ -690,61 +630,20 @@ wf.set_ylabel('Audio signal amplitude [arb. unit]', fontsize = 16)
 #wf.set_yticklabels(list(map(str, np.arange(-17000,6000,1000))), minor=False)
 #wf.set_ylim(-1300,400) # beta pulse range
 
-#hb = wf.hexbin(xpulses, ypulses, gridsize=354, cmap='Greens', mincnt=1, vmax=100)
-#cb = fig.colorbar(hb, ax=wf)
-
-length = max(map(len, xpulses))
-xpulses_n=np.array([np.append(xi,[0]*(length-len(xi))) for xi in xpulses], dtype=np.int)
-length = max(map(len, ypulses))
-ypulses_n=np.array([np.append(yi,[0]*(length-len(yi))) for yi in ypulses], dtype=np.int)
-
-
-#wf.plot(ypulses_n[23])
-
-## <codecell>
-
-#xpulses_n=np.asarray([x for x in xpulses if len(x) > 0 ])
-#ypulses_n=np.asarray([x for x in ypulses if len(x) > 0] )
-#xpulses_n=np.array(xpulses)
-#ypulses_n=np.array(ypulses)
-
-
-
-divx=1
 divy=180
 
-xmin,xmax = min([i.min() for i in xpulses_n]), max([i.max() for i in xpulses_n])
-ymin,ymax = min([i.min() for i in ypulses_n]), max([i.max() for i in ypulses_n])
-
-xsize = (np.round((xmax-xmin)/divx)).astype(int)
-ysize = (np.round((ymax-ymin)/divy)).astype(int)
+# aligned pulses in bins of divy, accumulated while analysing (see PulseMap in stream_analysis.py),
+# starting at the lowest signal value
+im, y_edges = pulse_map.image(divy)
+first = np.flatnonzero(im.any(axis=0))[0] if im.any() else 0
+im, ymin = im[:, first:], y_edges[first]
+ysize = im.shape[1] - 1
 
 wf.set_ylim(0,(4000-ymin)/divy)
 wf.set_yticks(np.arange((-ymin-15000)/divy,ysize,2500/divy), minor=False)
 wf.set_yticklabels(list(map(str, np.arange(-15000,4001,2500))), minor=False)
 fig.tight_layout(pad=0.1,h_pad=0) #rect=(0.05,-0.010,1.01,1.02))
 
-
-#xsize,ysize  = (xmax-xmin),(ymax-ymin)
-
-
-im = np.zeros((xsize+1,ysize+1))
-def addIm(im,x,y):
-    for i,j in zip(x,y):
-        #try:
-            im[i,j] = im[i,j]+1
-        #except IndexError:
-        #    print(i,j)
-    return im
-
-for i,val in enumerate(xpulses_n[:]):
-    #xo = (np.round((xpulses_n[i]-xmin)/xsize)).astype(int)
-    yo = (np.round((ypulses_n[i]-ymin)/divy)).astype(int)
-    xo = (xpulses_n[i]-xmin)
-    #yo = (ypulses_n[i]-ymin)/ysize
-    #im[xo,yo] = im[xo,yo]+1
-    im = addIm(im,xo,yo)
-    #im = addIm(im,xpulses_n[i],ypulses_n[i]-ymin)
 im = np.ma.masked_array(im,mask=(im==0))
 
 wf.imshow( im.T,interpolation='nearest',origin="lower",cmap="Greens", vmax=250)#  extent=([x_edges[0], x_edges[-1], y_edges[0], y_edges[-1]]))
@@ -752,11 +651,10 @@ wf.imshow( im.T,interpolation='nearest',origin="lower",cmap="Greens", vmax=250)#
 #x_edges = np.arange(xsize)
 #y_edges = np.arange(ysize)
 
-#bin_values,_,__ = np.histogram2d(np.ravel(xpulses_n),np.ravel(ypulses_n),bins=(x_edges, y_edges) )
+#bin_values,_,__ = np.histogram2d(...,bins=(x_edges, y_edges) )
 #X, Y = np.meshgrid(x_edges,y_edges)
 
 #wf.pcolormesh(X,Y, bin_values.T, cmap="Greens", vmax=100)
-#hb = wf.hexbin(np.ravel(xpulses_n), np.asarray(ypulses_n).ravel(), gridsize=(188,188*2), cmap='Greens', mincnt=1, vmax=20)
 
 
 #wf.hist2d(im[:,0],im[:,1],bins=(x_edges, y_edges),vmax=3)
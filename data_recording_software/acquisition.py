@@ -0,0 +1,675 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Acquisition pipeline of the pulse recorder, independent of the GUI.
+
+The PortAudio callback runs in a real-time audio thread and must return
+quickly, otherwise frames get lost. Therefore it only copies each frame into a
+preallocated FrameRing. A separate consumer thread takes the frames from there
+and does the triggering, particle type classification and storage of the
+waveforms. The GUI (or any other frontend) only reads the latest results from
+this class, it never runs inside the audio thread.
+
+Pulse timestamps are derived from the position of the trigger sample in the
+audio stream (sample counter / RATE), anchored once to the wall clock via the
+ADC time PortAudio reports for the first frame. Intervals between pulses are
+therefore exact to one sample and not quantised to the callback times.
+
+Pulses crossing the border between two audio frames are stitched together
+(overlap-save): the last 'overlap' samples of each frame are kept and put in
+front of the next frame before searching for pulses. A search only accepts
+pulses starting at least one max. pulse length before the end of the combined
+waveform, later ones are found in full by the next search. Pulses already
+counted are never accepted again, so each pulse is counted exactly once and
+always with its complete waveform.
+
+Either the complete triggered audio frames are stored (as always) or, if a
+window is set, only 'pre' samples before and 'post' samples after the start
+of each valid pulse, together with the stream position of the window.
+Stitching only applies to the live count and the stored windows: stored
+frames are the unchanged audio frames, the offline analysis of whole frames
+misses or truncates pulses crossing a frame border (untriggered neighbour
+frames are not stored).
+
+Optionally, the threshold follows the noise of the input (see
+noise_tracker.py). Every change of the threshold, adaptive or manual, is
+recorded in the .pulses file with the stream position from which it applies.
+
+Triggered frames can be checked for interference bursts (see veto.py).
+Vetoed frames are neither searched nor stored, each interval of consecutive
+vetoed frames is recorded in the .pulses file as dead time.
+
+Long recordings can be split into several .pulses files (segments), after
+rotate_interval seconds of stream time or rotate_size bytes. The segments,
+their live times and the gaps (lost frames) of the recording are listed in a
+session manifest, see session.py.
+
+With an energy calibration, all valid pulses are also filled into an
+energy histogram and counts per minute (see spectrum.py).
+
+The audio callback also counts the input overflow/underflow flags reported by
+PortAudio and records its own run time, metrics() collects these together with
+the ring buffer and storage figures (see health.py).
+
+Instead of the audio input, start() also accepts a replay source (see
+replay.py). Its frames are pushed into the same ring by a feeder thread, which
+waits for free slots instead of dropping frames. For recording several
+channels, one Acquisition per channel is fed by a shared input stream, see
+multichannel.py.
+"""
+
+import os
+import json
+import threading
+import datetime
+import time
+from collections import deque
+import numpy as np
+try:
+    import pyaudio
+except ImportError: # only needed for recording from the audio input, not for a replay
+    pyaudio = None
+
+from ring_buffer import FrameRing
+from noise_tracker import NoiseTracker
+from veto import BurstVeto
+from spectrum import EnergySpectrum
+from event_store import EventStore, PTYPE_NAMES
+import pulse_file
+import pulse_finder
+import session
+
+ALPHA, BETA = 0, 1 # particle type codes, index into event_store.PTYPE_NAMES
+CALLBACK_HISTORY = 4096 # run times of the last audio callbacks kept for the percentiles
+
+
+class Acquisition:
+
+    def __init__(self, thl, min_alpha_peak, rate, frame_size, ring_slots=64,
+                 save_data=True, data_folder="./data", stream_to_disk=True,
+                 flush_interval=2.0, export_pkl=True, skip_empty=False, overlap=512, window=None,
+                 verbose=True, name=None, device=None, adaptive_thl=None, veto=None,
+                 rotate_interval=None, rotate_size=None, calibration=None):
+        self.thl = thl
+        self.min_alpha_peak = min_alpha_peak
+        self.rate = rate
+        self.frame_size = frame_size
+        self.save_data = save_data
+        self.data_folder = data_folder
+        self.stream_to_disk = stream_to_disk  # write pulses to a .pulses file while recording
+        self.flush_interval = flush_interval  # max. seconds of data held in memory before writing
+        self.export_pkl = export_pkl          # convert the .pulses file to the old .pkl format at the end
+        self.skip_empty = skip_empty          # don't store triggered frames without a valid pulse
+        self.window = window                  # (pre, post) samples stored around each pulse, None for whole frames
+        # pulses starting less than margin samples before the end of a frame are left to the next search
+        self.margin = max(pulse_finder.MAX_LENGTH + 1, window[1] if window else 0)
+        if overlap < self.margin + (window[0] if window else 0) or overlap > frame_size:
+            raise ValueError("overlap too short for max. pulse length and stored window or longer than a frame")
+        self.overlap = overlap                # samples kept from the previous frame for stitching
+        self.verbose = verbose        # print one line per triggered frame
+        self.name = name              # channel name, prefix of the file names
+        self.device = device          # PortAudio input device index, None for the default input
+        self.on_pulse = None          # optional hook called with the peak amplitude of each trigger
+        # adaptive_thl: settings of the NoiseTracker adapting thl (k, floor, max_false_rate), None for a fixed threshold
+        self.noise_tracker = NoiseTracker(rate, **adaptive_thl) if adaptive_thl is not None else None
+        # veto: settings of the BurstVeto for interference bursts (max_crossings, ...), None for no veto
+        self.veto = BurstVeto(rate, frame_size, **veto) if veto is not None else None
+        self.vetoed_frames = 0
+        self.veto_interval = None     # currently open veto interval
+        self.veto_intervals = []      # all closed veto intervals as dicts, also written to the .pulses file
+        self.dead_time = 0.           # [s] sum of all veto intervals
+        # calibration: energy calibration dict (see spectrum.py), None for no online spectrum
+        self.spectrum = EnergySpectrum(calibration, rate) if calibration is not None else None
+        self.logged_thl = thl         # threshold of the last logged change
+        self.thl_changes = []         # all threshold changes as dicts, also written to the .pulses file
+
+        self.ring = FrameRing(ring_slots, frame_size)
+        self.events = EventStore(sum(window) if window else frame_size)
+
+        self.pcounter = 0             # triggered (and stored) frames, or stored pulse windows
+        self.frame_counter = 0        # all processed audio frames
+        self.triggered = 0            # frames with samples below threshold
+        self.ptype_counts = np.zeros(len(PTYPE_NAMES), dtype=np.int64) # announced pulses per type
+        self.pulse_counter = 0        # valid pulses according to pulse_finder, several per frame possible
+        self.empty_frames = 0         # triggered frames without a valid pulse
+        self.stitched = 0             # pulses starting in the previous frame
+        self.tail = np.zeros(0, dtype=np.int16) # end of the previous frame
+        self.tail_end = 0             # stream position after the last tail sample
+        self.tail_triggered = False   # tail contains samples below threshold
+        self.last_end = 0             # stream position where the last counted pulse ended
+        self.cps = 0.
+        self.cps_window = 10.         # seconds of stream time used for the pulse rate
+        self.recent = deque()         # stream positions of the pulses in the rate window
+        self.peaks = []
+        self.last_pulse = None        # waveform of the latest trigger, read by the GUI
+        self.creation_time = datetime.datetime.now()
+        self.input_overflows = 0      # callbacks flagged by PortAudio: samples lost before the callback
+        self.input_underflows = 0     # callbacks flagged by PortAudio: gaps filled with zeros
+        self.callbacks = 0
+        self.callback_times = np.zeros(CALLBACK_HISTORY) # [s], written by the audio thread only
+        self.t0 = None                # local time of stream sample 0 as datetime64[ns]
+
+        self.writer = None
+        self.last_flush = time.monotonic()
+        self.rotate_interval = rotate_interval # [s] of stream time per .pulses file, None: no limit
+        self.rotate_size = rotate_size         # max. bytes per .pulses file, None: no limit
+        self.segment_time = self.creation_time # start of the current segment, used in the file names
+        self.segment = None           # current segment, see session.py
+        self.segments = []            # finished segments
+        self.gaps = []                # (start, end) stream positions of lost frames
+        self.gap_time = 0.            # [s]
+
+        self.running = False
+        self.consumer = None
+        self.feeding = False          # a replay source is still pushing frames
+        self.feeder = None
+        self.replay = None            # file name of the replay source
+        self.sparse = False           # source with triggered frames only: skipped positions are no lost frames
+        self.p = None
+        self.stream = None
+
+    def audio_callback(self, in_data, frame_count, time_info, status):
+        self.push(in_data, frame_count, time_info, status)
+        return (None, pyaudio.paContinue)
+
+    def push(self, in_data, frame_count, time_info, status):
+        # runs in the PortAudio thread: copy the frame and return immediately
+        entered = time.perf_counter()
+        if status:
+            if status & pyaudio.paInputOverflow:
+                self.input_overflows += 1
+            if status & pyaudio.paInputUnderflow:
+                self.input_underflows += 1
+        if self.t0 is None:
+            self.anchor(time_info, frame_count)
+        self.ring.push(in_data)
+        self.callback_times[self.callbacks % CALLBACK_HISTORY] = time.perf_counter() - entered
+        self.callbacks += 1
+
+    def anchor(self, time_info, frame_count):
+        """Set the wall clock time of the first sample in the stream."""
+        now = time.time()
+        # time_info holds the ADC capture time of the first sample in this buffer and the
+        # current time, both on the PortAudio stream clock. Some host APIs report 0.
+        latency = 0.
+        if time_info:
+            adc = time_info.get('input_buffer_adc_time', 0.)
+            current = time_info.get('current_time', 0.)
+            if adc > 0 and current >= adc:
+                latency = current - adc
+        if latency <= 0:
+            latency = frame_count / self.rate # at least one buffer was captured
+        first = now - latency - self.ring.samples_in / self.rate
+        self.t0 = np.datetime64(datetime.datetime.fromtimestamp(first), 'ns')
+
+    def timestamp(self, position):
+        """Local time of a stream sample position."""
+        return self.t0 + np.timedelta64(int(round(position * 1e9 / self.rate)), 'ns')
+
+    def start(self, source=None):
+        """Start recording from the audio input or replaying the frames of source."""
+        if source is not None:
+            self.replay = source.path
+            self.t0 = source.t0
+            self.sparse = source.sparse
+        elif pyaudio is None:
+            raise RuntimeError("pyaudio is required for recording from the audio input")
+        self.start_consumer()
+        if source is not None:
+            self.feeding = True
+            self.feeder = threading.Thread(target=self.feed, args=(source,), name="replay feeder", daemon=True)
+            self.feeder.start()
+            return
+        self.p = pyaudio.PyAudio()
+        self.stream = self.p.open(format=pyaudio.paInt16, channels=1, rate=self.rate, input=True,
+                                  input_device_index=self.device,
+                                  frames_per_buffer=self.frame_size, stream_callback=self.audio_callback)
+        self.stream.start_stream()
+
+    def start_consumer(self):
+        """Open the output file and start processing frames pushed into the ring."""
+        if self.save_data and self.stream_to_disk:
+            self.open_segment(None)
+        self.running = True
+        self.consumer = threading.Thread(target=self.consume, name="pulse consumer", daemon=True)
+        self.consumer.start()
+
+    def log_thl(self, position, reason):
+        """Record a threshold change, applies from stream position on."""
+        change = {'position': position, 'thl': self.thl, 'reason': reason}
+        if self.t0 is not None:
+            change['ts'] = str(self.timestamp(position))
+        if self.noise_tracker is not None:
+            change.update(self.noise_tracker.state())
+        self.thl_changes.append(change)
+        self.logged_thl = self.thl
+        if self.writer is not None:
+            self.writer.write_json(b"THLC", change)
+        if self.verbose:
+            print("THL:", self.thl, "(" + reason + ")")
+
+    def veto_frame(self, start, samples, reason):
+        """Drop a frame of an interference burst and extend the current veto interval."""
+        self.vetoed_frames += 1
+        end = start + len(samples)
+        if self.veto_interval is None:
+            self.veto_interval = {'start': start, 'end': end, 'frames': 0, 'reasons': {}}
+        interval = self.veto_interval
+        interval['end'] = end
+        interval['frames'] += 1
+        interval['reasons'][reason] = interval['reasons'].get(reason, 0) + 1
+        # no stitching of pulses across the burst
+        self.tail = np.zeros(0, dtype=np.int16)
+        self.tail_end = end
+        self.tail_triggered = False
+
+    def close_veto(self):
+        """Record the dead time of the finished veto interval."""
+        interval = self.veto_interval
+        self.veto_interval = None
+        interval['dead_time'] = (interval['end'] - interval['start']) / self.rate
+        if self.t0 is not None:
+            interval['ts'] = str(self.timestamp(interval['start']))
+        self.dead_time += interval['dead_time']
+        self.veto_intervals.append(interval)
+        if self.writer is not None:
+            self.writer.write_json(b"VETO", interval)
+        if self.verbose:
+            print("Veto:", interval['frames'], "frames,", round(interval['dead_time'], 2), "s dead time", interval['reasons'])
+
+    def adapt_thl(self, start, samples):
+        """Update the noise estimate with a frame and follow it with the threshold."""
+        tracker = self.noise_tracker
+        tracker.update(samples)
+        tracker.relax(start)
+        thl = tracker.propose(self.thl)
+        if thl is not None:
+            self.thl = thl
+            self.log_thl(start, "adaptive")
+
+    def stop(self):
+        if self.stream is not None:
+            self.stream.stop_stream()
+            self.stream.close()
+            self.stream = None
+            print("Stream closed")
+        if self.feeder is not None:
+            self.feeding = False
+            self.feeder.join()
+            self.feeder = None
+        # let the consumer drain all frames that are still in the ring
+        self.running = False
+        if self.consumer is not None:
+            self.consumer.join()
+            self.consumer = None
+        if self.p is not None:
+            self.p.terminate()
+            self.p = None
+
+    def feed(self, source):
+        """Replay thread, takes the place of the audio callback."""
+        ring = self.ring
+        for start, samples in source.frames():
+            while ring.occupancy() >= ring.slots and self.feeding:
+                time.sleep(0.001)
+            if not self.feeding:
+                break
+            ring.push(samples, start)
+        self.feeding = False
+
+    def consume(self):
+        ring = self.ring
+        while self.running or ring.occupancy() > 0:
+            if ring.wait(0.1):
+                self.process(*ring.peek())
+                ring.release()
+                # checked for every frame, an unpaced replay processes many files' worth between flushes
+                if self.writer is not None and self.rotation_due():
+                    self.rotate()
+            if self.writer is not None and time.monotonic() - self.last_flush >= self.flush_interval:
+                self.flush()
+        self.flush_tail()
+        if self.veto_interval is not None:
+            self.close_veto()
+        if self.writer is not None:
+            self.flush()
+
+    def open_segment(self, position):
+        """Start a new .pulses file at stream position (None: first frame of the stream)."""
+        if position is not None and self.t0 is not None:
+            self.segment_time = self.timestamp(position).astype('datetime64[us]').item()
+        self.writer = pulse_file.PulseFileWriter(self.file_name(pulse_file.FILE_EXTENSION), self.header())
+        self.segment = {'file': self.writer.path.split("/")[-1], 'pkl': None,
+                        'start': self.segment_time.isoformat(), 'start_position': position,
+                        'counters': (self.frame_counter, self.pcounter, self.pulse_counter,
+                                     self.dead_time, self.gap_time)}
+
+    def close_segment(self, position):
+        """Finish the current .pulses file at stream position and update the session manifest."""
+        seg = self.segment
+        frames, stored, pulses, dead_time, gap_time = seg.pop('counters')
+        if seg['start_position'] is None: # no frame at all
+            seg['start_position'] = position = 0
+        seg['end_position'] = position
+        seg['stop'] = (self.timestamp(position).astype('datetime64[us]').item().isoformat()
+                       if self.t0 is not None else datetime.datetime.now().isoformat())
+        seg['duration'] = (position - seg['start_position']) / self.rate
+        seg['dead_time'] = self.dead_time - dead_time
+        seg['gap_time'] = self.gap_time - gap_time
+        seg['live_time'] = seg['duration'] - seg['dead_time'] - seg['gap_time']
+        seg['frames'] = self.frame_counter - frames
+        seg['stored'] = self.pcounter - stored
+        seg['pulses'] = self.pulse_counter - pulses
+        if self.spectrum is not None:
+            self.writer.write_json(b"SPEC", self.spectrum.state())
+        self.writer.close({'pcounter': seg['stored'], 'frame_counter': seg['frames'],
+                           'thl': self.thl, 'thl_changes': len(self.thl_changes),
+                           'vetoed_frames': self.vetoed_frames, 'dead_time': seg['dead_time'],
+                           'live_time': seg['live_time'], 'stop': seg['stop']})
+        if seg['frames'] == 0 and self.segments:
+            os.remove(self.writer.path) # rotated just before the end of the recording
+        else:
+            self.segments.append(seg)
+        self.segment = None
+        self.write_manifest()
+
+    def rotate(self):
+        """Continue in a new .pulses file after the last processed frame."""
+        position = self.tail_end
+        self.flush()
+        if self.veto_interval is not None:
+            self.close_veto() # dead time belongs to the segment it occurred in
+        self.close_segment(position)
+        self.open_segment(position)
+        self.segment['start_position'] = position
+        if self.verbose:
+            print("Continuing in", self.writer.path)
+
+    def rotation_due(self):
+        seg = self.segment
+        if seg is None or seg['start_position'] is None:
+            return False
+        if self.rotate_interval and (self.tail_end - seg['start_position']) / self.rate >= self.rotate_interval:
+            return True
+        # events not flushed yet: timestamp, ptype, position and samples of each
+        pending = len(self.events) * (8 + 1 + 8 + 2 * self.events.frame_size)
+        return bool(self.rotate_size) and self.writer.bytes_written + pending >= self.rotate_size
+
+    def manifest(self):
+        # settings of the session, the segment fields of the HEAD records ('start', 'segment') are in 'segments'
+        header = {key: value for key, value in self.header().items() if key not in ('start', 'segment')}
+        return {'session': self.creation_time.isoformat(), 'name': self.name, 'header': header,
+                'segments': self.segments, 'gaps': self.gaps, 'live_time': sum(s['live_time'] for s in self.segments)}
+
+    def write_manifest(self):
+        session.write_manifest(self.file_name(session.MANIFEST_EXTENSION, start=self.creation_time), self.manifest())
+
+    def flush(self):
+        """Write all pending events to the .pulses file and sync it to disk."""
+        self.writer.write_events(*self.events.take())
+        self.writer.sync()
+        self.last_flush = time.monotonic()
+
+    def header(self):
+        return {'RATE': self.rate, 'FRAME_SIZE': self.frame_size, 'THL': self.thl,
+                'MIN_ALPHA_PEAK': self.min_alpha_peak, 'start': self.segment_time.isoformat(),
+                'session': self.creation_time.isoformat(), 'segment': len(self.segments),
+                'WINDOW': list(self.window) if self.window else None, 'OVERLAP': self.overlap,
+                'REPLAY': self.replay, 'SPARSE': self.sparse, 'NAME': self.name,
+                'ADAPTIVE_THL': self.noise_tracker is not None,
+                'VETO': self.veto is not None}
+
+    def file_name(self, extension, suffix="", start=None):
+        """Name of an output file of the current segment or with the given start time."""
+        prefix = "/" + self.name + "_pulses" if self.name else "/pulses"
+        start = start or self.segment_time
+        return self.data_folder + prefix + start.strftime("_%Y-%m-%d_%H-%M-%S") + suffix + extension
+
+    def find_stitched(self, start, samples):
+        """Search for pulses in the previous tail + this frame.
+        Returns the pulses counted in this step, all pulses found (positions in
+        both are stream positions), the searched waveform and its stream position."""
+        if self.tail_end != start:
+            self.flush_tail() # frames were lost, the tail does not fit
+        work = np.concatenate((self.tail, samples)) if len(self.tail) else samples
+        work_start = start - len(self.tail)
+        found = pulse_finder.find_pulses(work, self.thl)
+        found['position'] += work_start
+        # pulses starting later may end (or their window may end) in the next frame,
+        # the next search finds them with some baseline from this frame in front
+        limit = start + len(samples) - self.margin
+        pos = found['position']
+        counted = found[(pos >= self.last_end) & (pos < limit)]
+        self.stitched += int((counted['position'] < start).sum())
+        return counted, found, work, work_start
+
+    def keep_tail(self, start, samples):
+        self.tail = samples[-self.overlap:].copy()
+        self.tail_end = start + len(samples)
+        self.tail_triggered = self.tail.min() < self.thl
+
+    def flush_tail(self):
+        """Count remaining pulses in the tail, at the end of the stream or after lost frames."""
+        if self.tail_triggered:
+            tail_start = self.tail_end - len(self.tail)
+            found = pulse_finder.find_pulses(self.tail, self.thl)
+            found['position'] += tail_start
+            found = found[found['position'] >= self.last_end]
+            self.count_pulses(found)
+            if self.window:
+                self.store_windows(found, self.tail, tail_start)
+        self.tail = np.zeros(0, dtype=np.int16)
+        self.tail_triggered = False
+
+    def count_pulses(self, pulses):
+        if len(pulses) == 0:
+            return
+        self.pulse_counter += len(pulses)
+        for p in pulses:
+            x = int(p['position'])
+            self.count_rate(x)
+            if self.spectrum is not None:
+                self.spectrum.add(int(p['amplitude']), x, ALPHA if p['peak'] < self.min_alpha_peak else BETA)
+        self.last_end = int(pulses['position'][-1] + pulses['width'][-1])
+
+    def store_windows(self, pulses, work, work_start):
+        """Store the window around each pulse, padded with the edge values
+        where it reaches beyond the available samples."""
+        pre, post = self.window
+        for p in pulses:
+            x1 = int(p['position'])
+            a = x1 - pre - work_start
+            b = x1 + post - work_start
+            w = work[max(a, 0):min(b, len(work))]
+            if a < 0 or b > len(work):
+                w = np.pad(w, (max(-a, 0), max(b - len(work), 0)), mode='edge')
+            ptype = ALPHA if p['peak'] < self.min_alpha_peak else BETA
+            t = self.timestamp(x1)
+            self.announce(t, ptype, p['peak'])
+            if self.save_data:
+                self.events.append(t, ptype, w, x1 - pre)
+            self.pcounter += 1
+
+    def announce(self, t, ptype, peak):
+        self.ptype_counts[ptype] += 1
+        if self.verbose:
+            print("* ", t, "   alpha  " if ptype == ALPHA else "   elect   ", self.pcounter, "  ", peak, sep="")
+        if self.on_pulse is not None:
+            self.on_pulse(peak)
+
+    def process(self, start, samples):
+        """Trigger, classify and store one audio frame starting at stream position start.
+        Runs in the consumer thread."""
+        self.frame_counter += 1
+        if self.frame_counter == 1:
+            if self.segment is not None:
+                self.segment['start_position'] = start
+        elif start > self.tail_end and not self.sparse: # frames were lost
+            self.gaps.append((self.tail_end, start))
+            self.gap_time += (start - self.tail_end) / self.rate
+        if self.thl != self.logged_thl:
+            self.log_thl(start, "manual") # changed by the GUI
+        peak = samples.min()
+        triggered = peak < self.thl
+        self.triggered += int(triggered)
+        if self.noise_tracker is not None:
+            self.adapt_thl(start, samples)
+        if self.veto is not None:
+            reason = self.veto.check(samples, self.thl, triggered)
+            if reason is not None:
+                self.veto_frame(start, samples, reason)
+                return
+            if self.veto_interval is not None:
+                self.close_veto()
+        if not triggered and not self.tail_triggered:
+            self.keep_tail(start, samples)
+            return
+        if self.t0 is None:
+            self.anchor(None, len(samples))
+        counted, found, work, work_start = self.find_stitched(start, samples)
+        self.keep_tail(start, samples)
+        self.count_pulses(counted)
+        valid = (found['position'] + found['width'] > start).any() # a pulse ends in this frame
+        if triggered and not valid and self.noise_tracker is not None:
+            # a trigger close to the end of the frame can be a pulse completed by the next frame
+            if np.argmax(samples < self.thl) < len(samples) - self.margin:
+                self.noise_tracker.false_trigger(start)
+        if self.window:
+            self.store_windows(counted, work, work_start)
+            if triggered:
+                self.last_pulse = samples.copy()
+            return
+        if not triggered:
+            return # only searched for the end of a pulse from the previous frame
+        if not valid:
+            self.empty_frames += 1
+            if self.skip_empty:
+                return
+        position = start + int(np.argmax(samples < self.thl)) # first sample below threshold
+        t = self.timestamp(position)
+        if peak < self.min_alpha_peak:
+            ptype = ALPHA
+        else:
+            ptype = BETA #beta/electron
+        self.announce(t, ptype, peak)
+        # local minima, same as scipy.signal.argrelextrema(samples, np.less) without importing scipy
+        minima = np.flatnonzero((samples[1:-1] < samples[:-2]) & (samples[1:-1] < samples[2:])) + 1
+        if len(minima) > 0:
+            self.peaks.append(sum(minima)/len(minima/2))
+            self.peaks = self.peaks[-100:] #only keep the last 100 for averaging
+        if self.save_data:
+            self.events.append(t, ptype, samples, start)
+        self.pcounter += 1
+        self.last_pulse = samples.copy() # the ring slot will be reused
+
+    def count_rate(self, position):
+        """Pulse rate in counts per second over the last cps_window seconds of stream time."""
+        recent = self.recent
+        recent.append(position)
+        window = int(self.cps_window * self.rate)
+        while recent[0] <= position - window:
+            recent.popleft()
+        span = min(window, position + 1) / self.rate
+        self.cps = len(recent) / span
+
+    def avg_peak(self):
+        return round(sum(self.peaks)/100,1)
+
+    def ring_status(self):
+        return "ring: {used}/{slots} (max. {hw}), overflows: {ov}, input overflows: {iov}".format(
+            used=self.ring.occupancy(), slots=self.ring.slots, hw=self.ring.high_water, ov=self.ring.overflows,
+            iov=self.input_overflows)
+
+    def metrics(self):
+        """Health figures of the running acquisition as a JSON serialisable dict."""
+        n = min(self.callbacks, CALLBACK_HISTORY)
+        times = self.callback_times[:n] * 1e3
+        if n:
+            p50, p90, p99 = np.percentile(times, [50, 90, 99])
+            callback_ms = {'p50': p50, 'p90': p90, 'p99': p99, 'max': times.max()}
+        else:
+            callback_ms = None
+        return {'name': self.name,
+                'time': datetime.datetime.now().isoformat(),
+                'uptime': (datetime.datetime.now() - self.creation_time).total_seconds(),
+                'replay': self.replay,
+                'thl': self.thl,
+                'thl_changes': len(self.thl_changes),
+                'noise': self.noise_tracker.state() if self.noise_tracker is not None else None,
+                'counts_per_minute': self.spectrum.rates()[0, -5:].tolist() if self.spectrum is not None else None,
+                'frames': self.frame_counter,
+                'triggered_frames': self.triggered,
+                'stored': self.pcounter,
+                'pulses': self.pulse_counter,
+                'empty_frames': self.empty_frames,
+                'stitched': self.stitched,
+                'vetoed_frames': self.vetoed_frames,
+                'dead_time': self.dead_time,
+                'cps': self.cps,
+                'ptype_counts': dict(zip(PTYPE_NAMES, self.ptype_counts.tolist())),
+                'input_overflows': self.input_overflows,
+                'input_underflows': self.input_underflows,
+                'callbacks': self.callbacks,
+                'callback_ms': callback_ms,
+                'queue_depth': self.ring.occupancy(),
+                'queue_max': self.ring.high_water,
+                'queue_slots': self.ring.slots,
+                'dropped_frames': self.ring.overflows,
+                'segment': len(self.segments),
+                'gap_time': self.gap_time,
+                'bytes_written': self.writer.bytes_written if self.writer is not None else 0}
+
+    def save(self):
+        timediff = datetime.datetime.now() - self.creation_time
+        if self.segment is not None:
+            self.close_segment(self.tail_end)
+            for seg in self.segments:
+                print("Pulses written to", self.data_folder + "/" + seg['file'])
+        if self.save_data and self.spectrum is not None:
+            with open(self.file_name(".json", "_spectrum", start=self.creation_time), "w") as f:
+                json.dump(self.spectrum.state(), f, default=str)
+        if not self.save_data or self.pcounter == 0:
+            return
+        if self.writer is None:
+            print("Saving data to file...")
+            td_str = '-'.join(str(timediff).split(':')[:2])
+            df = self.events.to_dataframe(self.window[0] if self.window else None)
+            df.attrs['vetoes'] = self.veto_intervals # see pulse_file.to_dataframe()
+            df.attrs['dead_time'] = self.dead_time
+            _ = df.to_pickle(self.file_name(".pkl", "___" + str(self.pcounter) + "___" + td_str))
+            print("Saving completed.")
+        elif self.export_pkl:
+            print("Saving data to file...")
+            self.export_segments()
+            print("Saving completed.")
+        print()
+        print('Number of recorded waveforms:', self.pcounter, "of",self.frame_counter, "total audio frames")
+        print('containing', self.pulse_counter, "valid pulses,", self.empty_frames, "triggered frames without valid pulse",
+              "(skipped)" if self.skip_empty else "")
+        print(self.stitched, "pulses were stitched across frame borders")
+        if self.veto is not None:
+            print(self.vetoed_frames, "frames vetoed as interference bursts in", len(self.veto_intervals),
+                  "intervals,", round(self.dead_time, 1), "s dead time")
+            if self.dead_time > 0:
+                print("the vetoed frames are missing in the .pkl files, their dead time is in df.attrs['dead_time']")
+        print('at least', self.events.count('alpha') ,"alphas and")
+        print('at least', self.events.count('beta') ,"electrons/betas were detected")
+
+    def export_segments(self):
+        """Convert each .pulses file of the session to a .pkl file, named like the files of a single recording."""
+        for seg in self.segments:
+            if seg['stored'] == 0:
+                continue
+            path = self.data_folder + "/" + seg['file']
+            df = pulse_file.to_dataframe(pulse_file.read_pulse_file(path))
+            td_str = '-'.join(str(datetime.timedelta(seconds=round(seg['duration']))).split(':')[:2])
+            pkl = path[:-len(pulse_file.FILE_EXTENSION)] + "___" + str(len(df)) + "___" + td_str + ".pkl"
+            _ = df.to_pickle(pkl)
+            seg['pkl'] = pkl.split("/")[-1]
+        self.write_manifest()
+
+    def summary(self):
+        print("Ring buffer: max. occupancy", self.ring.high_water, "of", self.ring.slots,
+              "slots,", self.ring.overflows, "frames lost due to overflow")
+        print("Audio input:", self.input_overflows, "overflows,", self.input_underflows, "underflows in",
+              self.callbacks, "callbacks")
@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Loading of recorded waveform datasets as one contiguous int16 matrix.
+
+load_dataset() reads a dataset in any of the recorded formats and returns a
+dict with
+    'pulse'   (N, frame length) int16 array, one waveform per row
+    'ts'      N timestamps [datetime64, local time as in the .pkl files]
+    'ptype'   N particle type codes (index into event_store.PTYPE_NAMES)
+    'offset'  N pulse starts in each waveform if only a window around each
+              pulse is stored (WINDOW in pulse_recorder.py), else None
+    'header'  header of .pulses files, else None
+    'start', 'stop'   first and last timestamp of the file, also if the first
+              or last waveforms were removed by the threshold
+Only waveforms going below thl are kept if a threshold is given. This
+prefilter is a single row minimum over blocks of the matrix, the kept rows are
+moved to the front of the same array, so the memory needed stays at about the
+size of the raw samples:
+    .pulses   the file is memory-mapped, the samples of each chunk are copied
+              once from the file into the preallocated matrix
+    .wav      mono recordings are memory-mapped as frames of frame_size
+              samples (read-only), nothing is read before it is used; with
+              a threshold only the triggered frames are copied. Timestamps
+              are counted back from the modification time of the file.
+    .pkl      the pickled waveforms are copied row by row into the matrix
+              and released right after, unpickling needs about twice the
+              memory of the samples
+    .msgp     (webGui recordings) timestamps are in UTC
+All waveforms of a dataset must have the same length.
+
+iter_blocks() yields a dataset in blocks of a fixed number of waveforms for
+datasets larger than the memory (see stream_analysis.py). .pulses and .wav
+files are read block by block from the memory-mapped file, so only one block
+is held at a time (the mapped file itself is page cache, which the system
+can drop). .pkl and .msgp files can only be unpickled as a whole.
+
+python3 dataset.py FILE [--thl THL] prints the load time and the peak memory
+allocated while loading.
+"""
+
+import argparse
+import json
+import os
+import struct
+import time
+import tracemalloc
+import numpy as np
+
+import pulse_file
+from event_store import PTYPE_NAMES
+from recorder_options import FRAME_SIZE, RATE
+
+BLOCK = 256       # rows per step of the threshold prefilter
+BLOCK_SIZE = 2048 # waveforms per block of iter_blocks()
+UNKNOWN = PTYPE_NAMES.index("unknown")
+
+
+def load_dataset(path, thl=None, frame_size=FRAME_SIZE):
+    """Read a .pulses, .pkl, .wav or .msgp dataset, see module description."""
+    ext = os.path.splitext(path)[1].lower()
+    if ext == pulse_file.FILE_EXTENSION:
+        data = load_pulses(path)
+    elif ext == ".pkl":
+        data = load_pkl(path)
+    elif ext == ".wav":
+        return load_wav(path, thl, frame_size)
+    elif ext == ".msgp":
+        data = load_msgp(path)
+    else:
+        raise ValueError("unknown file type: " + path)
+    data['start'] = data['ts'][0] if len(data['ts']) else None
+    data['stop'] = data['ts'][-1] if len(data['ts']) else None
+    if thl is not None:
+        keep = below(data['pulse'], thl)
+        n = compact(data['pulse'], keep)
+        data['pulse'] = data['pulse'][:n]
+        for key in ('ts', 'ptype', 'offset'):
+            if data[key] is not None:
+                data[key] = data[key][keep]
+    return data
+
+
+def below(waves, thl):
+    """Rows of waves going below thl, computed block by block."""
+    return np.concatenate([waves[i:i+BLOCK].min(axis=1) < thl for i in range(0, len(waves), BLOCK)]
+                          or [np.zeros(0, dtype=bool)])
+
+
+def compact(waves, keep):
+    """Move the rows to keep to the front of waves (in place), returns their number."""
+    n = 0
+    for i in range(0, len(waves), BLOCK):
+        rows = waves[i:i+BLOCK][keep[i:i+BLOCK]] # at most BLOCK rows copied at once
+        waves[n:n+len(rows)] = rows
+        n += len(rows)
+    return n
+
+
+def load_pulses(path):
+    header = None
+    chunks = [] # (ts, ptype, waves) views into the mapped file
+    for tag, payload in pulse_file.map_records(path):
+        if tag == b"HEAD":
+            header = json.loads(bytes(payload).decode("utf-8"))
+        elif tag == b"EVTP":
+            ts, ptype, waves, _ = pulse_file.decode_events(payload)
+            chunks.append((ts, ptype, waves))
+    frame_len = pulse_file.record_length(header) if header else 0
+    if len({c[2].shape[1] for c in chunks}) > 1:
+        raise ValueError(path + " contains waveforms of different length")
+    if chunks:
+        frame_len = chunks[0][2].shape[1]
+    n = sum(len(c[0]) for c in chunks)
+    pulse = np.empty((n, frame_len), dtype=np.int16)
+    ts = np.empty(n, dtype='datetime64[ns]')
+    ptype = np.empty(n, dtype=np.int8)
+    i = 0
+    for t, p, w in chunks:
+        pulse[i:i+len(t)] = w
+        ts[i:i+len(t)] = t
+        ptype[i:i+len(t)] = p
+        i += len(t)
+    window = header.get('WINDOW') if header else None
+    return {'pulse': pulse, 'ts': ts, 'ptype': ptype, 'header': header,
+            'offset': np.full(n, window[0], dtype=np.int64) if window else None}
+
+
+def ptype_codes(names):
+    codes = {name: i for i, name in enumerate(PTYPE_NAMES)}
+    return np.array([codes.get(name, UNKNOWN) for name in names], dtype=np.int8)
+
+
+def load_pkl(path):
+    import pandas as pd # only needed for .pkl files
+    df = pd.read_pickle(path)
+    waves = list(df.pop('pulse'))
+    n = len(waves)
+    frame_len = len(waves[0]) if n else 0
+    pulse = np.empty((n, frame_len), dtype=np.int16)
+    for i in range(n):
+        if len(waves[i]) != frame_len:
+            raise ValueError(path + " contains waveforms of different length")
+        pulse[i] = waves[i]
+        waves[i] = None # release the pickled waveform
+    return {'pulse': pulse, 'ts': df['ts'].values.astype('datetime64[ns]'),
+            'ptype': ptype_codes(df['ptype']) if 'ptype' in df else np.full(n, UNKNOWN, dtype=np.int8),
+            'offset': df['offset'].values.astype(np.int64) if 'offset' in df else None,
+            'header': None}
+
+
+def load_msgp(path):
+    import msgpack # only needed for webGui recordings
+    with open(path, "rb") as f:
+        data = msgpack.unpackb(f.read(), raw=False)
+    if isinstance(data, dict):
+        data = [data[k] for k in sorted(data, key=int)]
+    if len({len(d['pulse']) for d in data}) > 1:
+        raise ValueError(path + " contains waveforms of different length")
+    pulse = np.array([d['pulse'] for d in data], dtype=np.int16).reshape(len(data), -1)
+    return {'pulse': pulse, 'ts': np.array([d['ts'] for d in data], dtype='datetime64[ms]').astype('datetime64[ns]'),
+            'ptype': np.full(len(data), UNKNOWN, dtype=np.int8), 'offset': None, 'header': None}
+
+
+def wav_data(path):
+    """(offset of the sample data, its size in bytes, channels, rate) of a 16 bit .wav file."""
+    with open(path, "rb") as f:
+        riff, _, wave_id = struct.unpack("<4sI4s", f.read(12))
+        if riff != b"RIFF" or wave_id != b"WAVE":
+            raise ValueError(path + " is not a .wav file")
+        channels = rate = None
+        while True:
+            head = f.read(8)
+            if len(head) < 8:
+                raise ValueError(path + " has no data chunk")
+            chunk, size = struct.unpack("<4sI", head)
+            if chunk == b"fmt ":
+                fmt = f.read(size + size % 2)
+                tag, channels, rate, _, _, bits = struct.unpack_from("<HHIIHH", fmt)
+                if tag != 1 or bits != 16:
+                    raise ValueError(path + " is not a 16 bit PCM recording")
+            elif chunk == b"data":
+                return f.tell(), size, channels, rate
+            else:
+                f.seek(size + size % 2, 1)
+
+
+def load_wav(path, thl=None, frame_size=FRAME_SIZE):
+    offset, size, channels, rate = wav_data(path)
+    n = size // (2 * channels * frame_size)
+    samples = np.memmap(path, dtype='<i2', mode='r', offset=offset, shape=(n * frame_size, channels))
+    if channels == 1:
+        pulse = samples.reshape(n, frame_size)
+    else:
+        pulse = np.ascontiguousarray(samples[:, 0]).reshape(n, frame_size) # first channel
+    end = np.datetime64(int(os.path.getmtime(path) * 1e9), 'ns')
+    ts = end - ((n - np.arange(n)) * frame_size * 1e9 / rate).astype('timedelta64[ns]')
+    data = {'pulse': pulse, 'ts': ts, 'ptype': np.full(n, UNKNOWN, dtype=np.int8), 'offset': None,
+            'header': {'RATE': rate, 'FRAME_SIZE': frame_size},
+            'start': ts[0] if n else None, 'stop': ts[-1] if n else None}
+    if thl is not None:
+        keep = below(pulse, thl)
+        data['pulse'] = pulse[keep] # copies only the triggered frames
+        data['ts'] = ts[keep]
+        data['ptype'] = data['ptype'][keep]
+    return data
+
+
+def iter_blocks(path, block_size=BLOCK_SIZE, thl=None, frame_size=FRAME_SIZE):
+    """Yield a dataset in blocks of at most block_size waveforms, as dicts like
+    load_dataset() with the additional key 'index': row of each waveform in the
+    file. 'start' and 'stop' of the file are only known after the last block."""
+    ext = os.path.splitext(path)[1].lower()
+    if ext == pulse_file.FILE_EXTENSION:
+        blocks = pulses_blocks(path, block_size)
+    elif ext == ".wav":
+        blocks = wav_blocks(path, block_size, frame_size)
+    else:
+        data = load_dataset(path, frame_size=frame_size)
+        blocks = ({'pulse': data['pulse'][i:i+block_size], 'ts': data['ts'][i:i+block_size],
+                   'ptype': data['ptype'][i:i+block_size], 'header': data['header'],
+                   'offset': data['offset'][i:i+block_size] if data['offset'] is not None else None}
+                  for i in range(0, len(data['ts']), block_size))
+    first = 0
+    for block in blocks:
+        n = len(block['ts'])
+        block['index'] = np.arange(first, first + n)
+        first += n
+        if thl is not None:
+            keep = below(block['pulse'], thl)
+            for key in ('pulse', 'ts', 'ptype', 'offset', 'index'):
+                if block[key] is not None:
+                    block[key] = block[key][keep]
+        yield block
+
+
+def pulses_blocks(path, block_size):
+    header = None
+    pending, n = [], 0 # (ts, ptype, waves) views into the mapped file, not yet returned
+
+    def take(k):
+        """Copy the first k pending waveforms into a block."""
+        parts = []
+        while k:
+            ts, ptype, waves = pending[0]
+            m = min(k, len(ts))
+            parts.append((ts[:m], ptype[:m], waves[:m]))
+            if m == len(ts):
+                pending.pop(0)
+            else:
+                pending[0] = (ts[m:], ptype[m:], waves[m:])
+            k -= m
+        ts, ptype, waves = (np.concatenate(a) for a in zip(*parts))
+        window = header.get('WINDOW') if header else None
+        return {'pulse': waves, 'ts': ts, 'ptype': ptype, 'header': header,
+                'offset': np.full(len(ts), window[0], dtype=np.int64) if window else None}
+
+    for tag, payload in pulse_file.map_records(path):
+        if tag == b"HEAD":
+            header = json.loads(bytes(payload).decode("utf-8"))
+        elif tag == b"EVTP":
+            ts, ptype, waves, _ = pulse_file.decode_events(payload)
+            pending.append((ts, ptype, waves))
+            n += len(ts)
+            while n >= block_size:
+                yield take(block_size)
+                n -= block_size
+    if n:
+        yield take(n)
+
+
+def wav_blocks(path, block_size, frame_size):
+    data = load_wav(path, frame_size=frame_size)
+    for i in range(0, len(data['ts']), block_size):
+        yield {'pulse': data['pulse'][i:i+block_size], 'ts': data['ts'][i:i+block_size],
+               'ptype': data['ptype'][i:i+block_size], 'offset': None, 'header': data['header']}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Load a dataset, print load time and peak memory.")
+    parser.add_argument("file", help=".pulses, .pkl, .wav or .msgp dataset")
+    parser.add_argument("--thl", type=int, default=None, help="keep only waveforms going below thl")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    tracemalloc.start()
+    t = time.perf_counter()
+    data = load_dataset(args.file, args.thl)
+    elapsed = time.perf_counter() - t
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print("{0}: {1} x {2} samples ({3:.1f} MB), loaded in {4:.2f} s, peak memory {5:.1f} MB".format(
+        os.path.basename(args.file), data['pulse'].shape[0], data['pulse'].shape[1],
+        data['pulse'].nbytes / 1e6, elapsed, peak / 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Append-only columnar store for recorded pulse events.
+
+Growing a pandas DataFrame with append() copies the whole frame each time,
+which gets slower with every recorded pulse. Here events are written into
+preallocated chunks instead: one array of timestamps, one array of particle
+type codes, one array of stream positions (sample index of the first stored
+sample) and one contiguous int16 block holding the waveforms. When a chunk
+is full, a new one is allocated and the old ones are left untouched, so the
+cost per event stays the same for the whole run.
+
+to_dataframe() builds the same DataFrame (columns 'ts', 'ptype', 'pulse')
+that pulse_recorder.py always saved, so existing .pkl readers keep working. If only a window around each pulse is
+stored (see WINDOW in pulse_recorder.py), an additional 'offset' column gives
+the sample index of the pulse start inside each stored waveform.
+"""
+
+import numpy as np
+
+PTYPE_NAMES = ["alpha", "beta", "betagamma", "x-ray", "muon" ,"unknown"]
+
+
+class EventStore:
+
+    def __init__(self, frame_size, chunk_size=1024):
+        self.frame_size = frame_size
+        self.chunk_size = chunk_size
+        self.ts_chunks = []
+        self.ptype_chunks = []
+        self.pos_chunks = []
+        self.wave_chunks = []
+        self.n = 0       # number of events currently held
+        self.fill = 0    # number of used rows in the last chunk
+        self.counts = np.zeros(len(PTYPE_NAMES), dtype=np.int64) # all events ever appended
+
+    def __len__(self):
+        return self.n
+
+    def _new_chunk(self):
+        self.ts_chunks.append(np.empty(self.chunk_size, dtype='datetime64[ns]'))
+        self.ptype_chunks.append(np.empty(self.chunk_size, dtype=np.int8))
+        self.pos_chunks.append(np.empty(self.chunk_size, dtype=np.int64))
+        self.wave_chunks.append(np.empty((self.chunk_size, self.frame_size), dtype=np.int16))
+        self.fill = 0
+
+    def append(self, ts, ptype, samples, position=-1):
+        """Store one event. ts is a datetime, ptype an index into PTYPE_NAMES,
+        samples the int16 waveform (copied, so a reused buffer can be passed),
+        position the stream position of the first sample."""
+        if not self.wave_chunks or self.fill == self.chunk_size:
+            self._new_chunk()
+        i = self.fill
+        self.ts_chunks[-1][i] = np.datetime64(ts, 'ns')
+        self.ptype_chunks[-1][i] = ptype
+        self.pos_chunks[-1][i] = position
+        row = self.wave_chunks[-1][i]
+        n = min(len(samples), self.frame_size)
+        row[:n] = samples[:n]
+        row[n:] = 0
+        self.fill += 1
+        self.n += 1
+        self.counts[ptype] += 1
+
+    def count(self, ptype_name):
+        return int(self.counts[PTYPE_NAMES.index(ptype_name)])
+
+    def _joined(self, chunks):
+        if not chunks:
+            return chunks
+        # only the last chunk is partially filled
+        return np.concatenate(chunks[:-1] + [chunks[-1][:self.fill]])
+
+    def arrays(self):
+        """All events as (timestamps, ptype codes, (N, frame_size) waveform matrix, stream positions)."""
+        if self.n == 0:
+            return (np.empty(0, dtype='datetime64[ns]'), np.empty(0, dtype=np.int8),
+                    np.empty((0, self.frame_size), dtype=np.int16), np.empty(0, dtype=np.int64))
+        return (self._joined(self.ts_chunks), self._joined(self.ptype_chunks),
+                self._joined(self.wave_chunks), self._joined(self.pos_chunks))
+
+    def take(self):
+        """Return all stored events like arrays() and empty the store.
+        Used for flushing the events to disk, the per type counts are kept."""
+        arrays = self.arrays()
+        self.ts_chunks, self.ptype_chunks, self.wave_chunks, self.pos_chunks = [], [], [], []
+        self.n = 0
+        self.fill = 0
+        return arrays
+
+    def to_dataframe(self, offset=None):
+        """DataFrame in the format written by pulse_recorder.py, one waveform array per row.
+        offset is the pulse start inside each waveform if only windows are stored."""
+        ts, ptype, waves, _ = self.arrays()
+        return events_to_dataframe(ts, ptype, waves, offset)
+
+
+def events_to_dataframe(ts, ptype, waves, offset=None):
+    import pandas as pd # only needed for .pkl export, keeps the recorder startup fast
+    df = pd.DataFrame({'ts': pd.to_datetime(ts),
+                       'ptype': np.asarray(PTYPE_NAMES, dtype=object)[ptype]})
+    df['pulse'] = list(waves)
+    if offset is not None:
+        df['offset'] = offset
+    return df
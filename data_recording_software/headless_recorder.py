@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Command line version of pulse_recorder.py for unattended measurements,
+e.g. on a small Linux computer without a display.
+
+It uses the same audio capture, trigger and storage code (acquisition.py)
+but no Qt/pyqtgraph window. Instead of the oscilloscope plot, a one-line
+status report is printed periodically. The recording stops after the given
+duration, on Ctrl-C or on SIGTERM (e.g. 'kill <pid>' or systemd stop) and
+the data is saved the same way as by pulse_recorder.py. Health metrics
+(lost frames, callback run times, queue depth, ...) are logged to a
+_metrics.jsonl file next to the data, see health.py.
+
+For long measurements, --rotate-hours and --rotate-mb split the recording into
+several files, listed with their live times in a .session.json manifest:
+    python3 headless_recorder.py --rotate-hours 1 --duration 172800
+
+Example, record for 12 hours with a higher threshold:
+    python3 headless_recorder.py --thl -400 --duration 43200 --data-folder ./data
+
+Several detectors can be recorded at once with one --channel option per
+channel, each with its own threshold and alpha cut (see multichannel.py):
+    python3 headless_recorder.py --channel default:0:-300 --channel default:1:-350:-1300
+
+Required python modules besides numpy & pandas:
+    pyaudio
+"""
+
+STATUS_INTERVAL = 60 # seconds between status lines
+METRICS_INTERVAL = 60 # seconds between lines of the _metrics.jsonl log
+
+import argparse
+import datetime
+import signal
+import time
+
+from acquisition import Acquisition
+import recorder_options
+from recorder_options import (THL, MIN_ALPHA_PEAK, DATA_FOLDER, RATE, FRAME_SIZE, RING_SLOTS,
+                              FLUSH_INTERVAL, OVERLAP)
+from multichannel import MultiRecorder, parse_channel
+from health import HealthMonitor
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Record pulses of the DIY particle detector without GUI.")
+    parser.add_argument("--thl", type=int, default=THL,
+                        help="trigger threshold (default: %(default)s)")
+    parser.add_argument("--min-alpha-peak", type=int, default=MIN_ALPHA_PEAK,
+                        help="amplitude separating alpha from electron pulses (default: %(default)s)")
+    parser.add_argument("--data-folder", default=DATA_FOLDER,
+                        help="folder for the recorded data files (default: %(default)s)")
+    parser.add_argument("--duration", type=float, default=0,
+                        help="stop after this many seconds, 0 records until stopped (default: %(default)s)")
+    parser.add_argument("--status-interval", type=float, default=STATUS_INTERVAL,
+                        help="seconds between status lines (default: %(default)s)")
+    parser.add_argument("--no-pkl", action="store_true",
+                        help="only write the .pulses file, skip the .pkl export at the end")
+    parser.add_argument("--skip-empty", action="store_true",
+                        help="don't save triggered frames without a valid pulse")
+    recorder_options.add_arguments(parser) # adaptive threshold, veto, rotation, calibration
+    parser.add_argument("--window", type=int, nargs=2, metavar=("PRE", "POST"),
+                        help="only store PRE samples before and POST samples after each pulse start")
+    parser.add_argument("--channel", action="append", metavar="DEVICE:CHANNEL[:THL[:MIN_ALPHA_PEAK]]",
+                        help="record this input channel, can be given several times, "
+                             "THL and MIN_ALPHA_PEAK default to the values above")
+    parser.add_argument("--device", type=int,
+                        help="PortAudio input device index for single channel recording (default: system default)")
+    parser.add_argument("--metrics-port", type=int,
+                        help="serve health metrics as JSON on http://127.0.0.1:PORT/metrics")
+    parser.add_argument("--verbose", action="store_true",
+                        help="print one line per triggered frame")
+    return parser.parse_args(argv)
+
+
+def status_line(acq, started):
+    elapsed = datetime.timedelta(seconds=round(time.monotonic() - started))
+    name = acq.name + ": " if acq.name else ""
+    return name + "{elapsed}  frames: {frames}  saved: {saved} (alpha: {alpha}, elect: {beta})  pulses: {pulses} (stitched: {stitched})  {cps:.2f} CPS  THL: {thl}  {ring}".format(
+        elapsed=elapsed, frames=acq.frame_counter, saved=acq.pcounter, pulses=acq.pulse_counter,
+        stitched=acq.stitched,
+        alpha=acq.events.count('alpha'), beta=acq.events.count('beta'),
+        cps=acq.cps, thl=acq.thl, ring=acq.ring_status())
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    options = dict(ring_slots=RING_SLOTS, data_folder=args.data_folder, flush_interval=FLUSH_INTERVAL,
+                   export_pkl=not args.no_pkl, skip_empty=args.skip_empty, overlap=OVERLAP,
+                   window=args.window, verbose=args.verbose, adaptive_thl=recorder_options.adaptive_thl(args),
+                   veto=recorder_options.veto(args), **recorder_options.rotation(args),
+                   calibration=recorder_options.calibration(args))
+    if args.channel:
+        acq = MultiRecorder([parse_channel(spec, args.thl, args.min_alpha_peak) for spec in args.channel],
+                            RATE, FRAME_SIZE, **options)
+        channels = acq.channels
+    else:
+        acq = Acquisition(args.thl, args.min_alpha_peak, RATE, FRAME_SIZE, device=args.device, **options)
+        channels = [acq]
+
+    stop = []
+    def request_stop(signum, frame):
+        stop.append(signum)
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    health = HealthMonitor(acq, port=args.metrics_port, log_interval=METRICS_INTERVAL,
+                           log_path=acq.file_name(".jsonl", "_metrics"))
+    acq.start()
+    started = time.monotonic()
+    next_status = started + args.status_interval
+    print("Recording started, THL:", ", ".join(str(a.thl) for a in channels), ", stop with Ctrl-C or SIGTERM")
+    while not stop:
+        time.sleep(0.2)
+        now = time.monotonic()
+        if args.duration > 0 and now - started >= args.duration:
+            break
+        if now >= next_status:
+            for a in channels:
+                print(status_line(a, started), flush=True)
+            next_status += args.status_interval
+    acq.stop()
+    for a in channels:
+        print(status_line(a, started))
+    acq.save()
+    acq.summary()
+    health.stop()
+    print('done.')
+
+
+if __name__ == '__main__':
+    main()
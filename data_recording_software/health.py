@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Health monitoring of a running recording.
+
+HealthMonitor serves the figures of Acquisition.metrics() as JSON on a local
+HTTP port and/or appends them periodically as one JSON line to a log file.
+The log proves after a long run whether frames were lost (input_overflows of
+the audio device, dropped_frames of the ring buffer) and shows the trigger rate
+and the callback run times under real load, e.g. for tuning THL.
+
+    curl http://127.0.0.1:8000/metrics
+
+Only the standard library is used, the server runs in a daemon thread and
+only reads from the acquisition.
+"""
+
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = json.dumps(self.server.acq.metrics(), default=str).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # don't mix request logs into the recorder output
+
+
+class HealthMonitor:
+
+    def __init__(self, acq, port=None, host="127.0.0.1", log_path=None, log_interval=60.):
+        self.acq = acq
+        self.log_path = log_path
+        self.log_interval = log_interval
+        self.server = None
+        self.stopped = threading.Event()
+        if port is not None:
+            self.server = ThreadingHTTPServer((host, port), MetricsHandler)
+            self.server.acq = acq
+            threading.Thread(target=self.server.serve_forever, name="metrics server", daemon=True).start()
+            print("Health metrics on http://{0}:{1}/metrics".format(host, self.server.server_address[1]))
+        self.logger = None
+        if log_path is not None:
+            self.logger = threading.Thread(target=self.log_loop, name="metrics log", daemon=True)
+            self.logger.start()
+
+    def log(self):
+        with open(self.log_path, "a") as f:
+            f.write(json.dumps(self.acq.metrics(), default=str) + "\n")
+
+    def log_loop(self):
+        while not self.stopped.wait(self.log_interval):
+            self.log()
+
+    def stop(self):
+        """Write a last log line and shut the server down."""
+        self.stopped.set()
+        if self.logger is not None:
+            self.logger.join()
+            self.log()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
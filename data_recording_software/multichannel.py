@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Recording of several detector channels in one process, e.g. both channels of
+a stereo USB interface and/or several interfaces side by side.
+
+Every channel is handled by its own Acquisition (see acquisition.py) with its
+own threshold, alpha cut, ring buffer, consumer thread and output files
+(named after the channel). Each input device is opened only once, with as many
+channels as needed. Its audio callback views the interleaved int16 frame as a
+(frame_size, channels) array and hands one column per channel to the channel's
+ring buffer, so deinterleaving is a single strided copy per channel.
+
+Channels are given as DEVICE:CHANNEL[:THL[:MIN_ALPHA_PEAK]], DEVICE is the
+PortAudio device index or 'default', e.g. for a stereo interface:
+    python3 headless_recorder.py --channel default:0:-300 --channel default:1:-350
+"""
+
+import datetime
+import numpy as np
+try:
+    import pyaudio
+except ImportError:
+    pyaudio = None
+
+from acquisition import Acquisition
+
+
+def parse_channel(spec, thl, min_alpha_peak):
+    """Split a DEVICE:CHANNEL[:THL[:MIN_ALPHA_PEAK]] string into
+    (device, channel, thl, min_alpha_peak), device None for the default input."""
+    fields = spec.split(":")
+    if not 2 <= len(fields) <= 4:
+        raise ValueError("channel must be given as DEVICE:CHANNEL[:THL[:MIN_ALPHA_PEAK]]: " + spec)
+    device = None if fields[0] in ("", "default") else int(fields[0])
+    channel = int(fields[1])
+    if len(fields) > 2:
+        thl = int(fields[2])
+    if len(fields) > 3:
+        min_alpha_peak = int(fields[3])
+    return device, channel, thl, min_alpha_peak
+
+
+def channel_name(device, channel):
+    return "ch" + str(channel) if device is None else "dev" + str(device) + "_ch" + str(channel)
+
+
+class InputDevice:
+
+    def __init__(self, p, device, inputs, rate, frame_size):
+        self.device = device
+        self.inputs = inputs # list of (channel index, Acquisition)
+        self.channels = max(ch for ch, _ in inputs) + 1
+        self.stream = p.open(format=pyaudio.paInt16, channels=self.channels, rate=rate, input=True,
+                             input_device_index=device, frames_per_buffer=frame_size,
+                             stream_callback=self.audio_callback, start=False)
+
+    def audio_callback(self, in_data, frame_count, time_info, status):
+        block = np.frombuffer(in_data, dtype=np.int16).reshape(-1, self.channels)
+        for ch, acq in self.inputs:
+            acq.push(block[:, ch], frame_count, time_info, status)
+        return (None, pyaudio.paContinue)
+
+    def start(self):
+        self.stream.start_stream()
+
+    def stop(self):
+        self.stream.stop_stream()
+        self.stream.close()
+
+
+class MultiRecorder:
+
+    def __init__(self, specs, rate, frame_size, data_folder="./data", **kwargs):
+        """specs: list of (device, channel, thl, min_alpha_peak), further
+        keyword arguments are passed to every Acquisition."""
+        self.rate = rate
+        self.frame_size = frame_size
+        self.data_folder = data_folder
+        self.creation_time = datetime.datetime.now()
+        self.channels = []
+        self.by_device = {}
+        for device, channel, thl, min_alpha_peak in specs:
+            if channel in dict(self.by_device.get(device, [])):
+                raise ValueError("channel {0} of device {1} given twice".format(channel, device))
+            acq = Acquisition(thl, min_alpha_peak, rate, frame_size, data_folder=data_folder,
+                              name=channel_name(device, channel), device=device, **kwargs)
+            acq.creation_time = acq.segment_time = self.creation_time # same time in all file names
+            self.channels.append(acq)
+            self.by_device.setdefault(device, []).append((channel, acq))
+        self.p = None
+        self.devices = []
+
+    def start(self):
+        if pyaudio is None:
+            raise RuntimeError("pyaudio is required for recording from the audio input")
+        for acq in self.channels:
+            acq.start_consumer()
+        self.p = pyaudio.PyAudio()
+        self.devices = [InputDevice(self.p, device, inputs, self.rate, self.frame_size)
+                        for device, inputs in self.by_device.items()]
+        for dev in self.devices:
+            dev.start()
+
+    def stop(self):
+        for dev in self.devices:
+            dev.stop()
+        self.devices = []
+        print("Streams closed")
+        for acq in self.channels:
+            acq.stop()
+        if self.p is not None:
+            self.p.terminate()
+            self.p = None
+
+    def save(self):
+        for acq in self.channels:
+            print("Channel", acq.name)
+            acq.save()
+
+    def summary(self):
+        for acq in self.channels:
+            print("Channel", acq.name)
+            acq.summary()
+
+    def metrics(self):
+        return {'channels': [acq.metrics() for acq in self.channels]}
+
+    def file_name(self, extension, suffix=""):
+        return self.data_folder + self.creation_time.strftime("/pulses_%Y-%m-%d_%H-%M-%S") + suffix + extension
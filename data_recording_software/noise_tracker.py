@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Adaptive trigger threshold from the baseline and noise of the audio input.
+
+The baseline offset and the RMS noise are estimated as exponentially weighted
+running averages of the median and of the median absolute deviation (scaled
+to a standard deviation) of each frame. Unlike mean and variance, these are
+not pulled off by the few samples of a pulse, so triggered frames can be used
+as well. Otherwise a sudden increase of the noise, which triggers every frame,
+would never be seen by the estimate. The threshold
+is then set to k standard deviations below the baseline, but never closer to
+zero than a hard floor, so a very quiet input doesn't record every small
+fluctuation.
+
+Triggered frames without a valid pulse (see pulse_finder.py) are counted as
+false triggers. If their rate over the last minute of stream time is above the
+target, k is increased, if it is well below, k slowly returns to its start
+value. This keeps the recorded data volume bounded in noisy environments
+without manual changes of THL.
+"""
+
+from collections import deque
+import numpy as np
+
+
+class NoiseTracker:
+
+    def __init__(self, rate, k=6., floor=-150, max_false_rate=0.05, weight=0.02,
+                 min_change=10, window=60.):
+        self.rate = rate
+        self.k0 = k                   # start value of k
+        self.k = k                    # threshold distance from the baseline in standard deviations
+        self.k_max = 4 * k
+        self.floor = floor            # the threshold never gets closer to zero than this
+        self.max_false_rate = max_false_rate # target max. false triggers per second
+        self.weight = weight          # weight of each new frame in the running statistics
+        self.min_change = min_change  # smaller threshold changes are ignored (no logging of every frame)
+        self.window = int(window * rate) # stream samples used for the false trigger rate
+        self.baseline = None
+        self.noise = None             # standard deviation of the noise
+        self.false_triggers = deque() # stream positions of the recent false triggers
+
+    def update(self, samples):
+        """Add a frame to the running statistics."""
+        median = np.median(samples)
+        sigma = 1.4826 * np.median(np.abs(samples - median)) # MAD of gaussian noise = 0.6745 sigma
+        if self.baseline is None:
+            self.baseline, self.noise = median, sigma
+            return
+        w = self.weight
+        self.baseline += w * (median - self.baseline)
+        self.noise += w * (sigma - self.noise)
+
+    def false_trigger(self, position):
+        """Register a triggered frame without valid pulse and adapt k."""
+        recent = self.false_triggers
+        recent.append(position)
+        while recent[0] <= position - self.window:
+            recent.popleft()
+        if len(recent) / (self.window / self.rate) > self.max_false_rate:
+            self.k = min(self.k * 1.1, self.k_max)
+
+    def relax(self, position):
+        """Let k return towards its start value while false triggers are rare."""
+        recent = self.false_triggers
+        while recent and recent[0] <= position - self.window:
+            recent.popleft()
+        if len(recent) / (self.window / self.rate) < self.max_false_rate / 4:
+            self.k = max(self.k * 0.999, self.k0)
+
+    def threshold(self):
+        """Threshold for the current noise level, None until update() got the first frame."""
+        if self.baseline is None:
+            return None
+        return int(min(round(self.baseline - self.k * self.noise), self.floor))
+
+    def propose(self, thl):
+        """New threshold if it differs enough from the current one thl, else None."""
+        new = self.threshold()
+        if new is None or abs(new - thl) < self.min_change:
+            return None
+        return new
+
+    def state(self):
+        if self.baseline is None:
+            return {'baseline': None, 'sigma': None, 'k': round(self.k, 2)}
+        return {'baseline': round(float(self.baseline), 1), 'sigma': round(float(self.noise), 1),
+                'k': round(self.k, 2)}
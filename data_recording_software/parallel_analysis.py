@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Pulse analysis of large datasets on all CPU cores.
+
+Every waveform is analysed independently, so a dataset (or a list of dataset
+files) is split into chunks of waveforms and the pulse finder
+(find_pulses_block() in pulse_finder.py) runs on the chunks in a process pool.
+The waveforms of each file are copied once into shared memory, the workers
+only receive the name of the shared block and the rows of their chunk, so no
+waveform data is pickled between the processes. Only the (small) pulse lists
+come back.
+
+The results are merged deterministically: chunk results are collected in
+submission order and sorted by the timestamp of their waveform (then file,
+waveform and position in the waveform), so any number of workers gives exactly
+the same pulse list as the analysis in a single process.
+
+Datasets with stored windows (WINDOW setting of pulse_recorder.py, 'offset'
+column) are evaluated as in analyse_and_plot_pulses.py: only the pulse
+starting at the offset of each window is counted (pulse_finder.window_pulses()).
+
+Usage:
+    python3 parallel_analysis.py DATASET [DATASET ...] [--workers N]
+    python3 parallel_analysis.py DATASET --scaling 1,2,4,8
+The second form analyses the datasets with each worker count, checks that the
+results are identical and prints the speedup and the scaling efficiency
+(speedup / workers) compared to the analysis in this process.
+"""
+
+import argparse
+import multiprocessing
+import os
+import time
+from multiprocessing import shared_memory
+import numpy as np
+
+import pulse_finder
+from pulse_finder import RESULT_DTYPE, THL
+from dataset import load_dataset
+
+CHUNK_SIZE = 2048 # waveforms per task
+
+
+def load_waveforms(path):
+    """Timestamps, (N, frame length) waveform array and window offsets (None for
+    complete frames) of a dataset, see dataset.py."""
+    data = load_dataset(path)
+    return data['ts'], data['pulse'], data['offset']
+
+
+class SharedWaveforms:
+    """A 2d waveform array copied into shared memory, see attach()."""
+
+    def __init__(self, waves):
+        self.shm = shared_memory.SharedMemory(create=True, size=max(waves.nbytes, 1))
+        self.array = np.ndarray(waves.shape, dtype=waves.dtype, buffer=self.shm.buf)
+        self.array[:] = waves
+        self.spec = (self.shm.name, waves.shape, waves.dtype.str)
+
+    def close(self):
+        del self.array
+        self.shm.close()
+        self.shm.unlink()
+
+
+_attached = {} # shared blocks already opened by this worker process
+
+
+def attach(spec):
+    """The array of a SharedWaveforms block, opened once per worker process."""
+    name, shape, dtype = spec
+    if name not in _attached:
+        shm = shared_memory.SharedMemory(name=name)
+        _attached[name] = (shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+    return _attached[name][1]
+
+
+def analyse_chunk(task):
+    """Run the pulse finder on rows a:b of a shared block, frame numbers relative to the block."""
+    spec, a, b, starts, params = task
+    found = pulse_finder.find_pulses_block(attach(spec)[a:b], starts=starts, **params)
+    found['frame'] += a
+    return found
+
+
+def analyse(paths, workers=None, chunk_size=CHUNK_SIZE, thl=THL, **params):
+    """Find all pulses in the given dataset files with a pool of workers processes
+    (None: all cores, 1: in this process). Returns one array of RESULT_DTYPE in timestamp order,
+    'file' is the index in paths, 'frame' the index of the waveform in its file."""
+    return analyse_datasets([load_waveforms(path) for path in paths], workers, chunk_size, thl, **params)
+
+
+def analyse_datasets(datasets, workers=None, chunk_size=CHUNK_SIZE, thl=THL, **params):
+    """analyse() for already loaded datasets, list of (ts, waves, offset) as returned by load_waveforms()."""
+    params['thl'] = thl
+    workers = workers or os.cpu_count()
+    blocks, tasks, owners = [], [], []
+    try:
+        for i, (ts, waves, offset) in enumerate(datasets):
+            for rows, block in pulse_finder.group_by_length(waves):
+                shared = SharedWaveforms(block) if workers > 1 else None
+                blocks.append(shared)
+                starts = offset[rows].astype(np.int64) if offset is not None else np.zeros(len(rows), dtype=np.int64)
+                for a in range(0, len(rows), chunk_size):
+                    spec = shared.spec if shared else block
+                    tasks.append((spec, a, a + chunk_size, starts[a:a+chunk_size], params))
+                    owners.append((i, rows))
+        if workers > 1:
+            with multiprocessing.Pool(workers) as pool:
+                results = pool.map(analyse_chunk, tasks, chunksize=1)
+        else:
+            results = [pulse_finder.find_pulses_block(spec[a:b], starts=starts, **p)
+                       for spec, a, b, starts, p in tasks]
+            for found, (spec, a, b, starts, p) in zip(results, tasks):
+                found['frame'] += a
+    finally:
+        for shared in blocks:
+            if shared is not None:
+                shared.close()
+
+    parts = []
+    for found, (i, rows) in zip(results, owners):
+        ts, waves, offset = datasets[i]
+        part = np.zeros(len(found), dtype=RESULT_DTYPE)
+        for name in pulse_finder.PULSE_DTYPE.names:
+            part[name] = found[name]
+        part['frame'] = rows[found['frame']] # index of the waveform in its file
+        part['file'] = i
+        part['ts'] = ts[part['frame']]
+        if offset is not None:
+            part = pulse_finder.window_pulses(part, offset)
+        parts.append(part)
+    if not parts:
+        return np.zeros(0, dtype=RESULT_DTYPE)
+    pulses = np.concatenate(parts)
+    return pulses[np.lexsort((pulses['position'], pulses['frame'], pulses['file'], pulses['ts']))]
+
+
+def scaling(paths, worker_counts, **kwargs):
+    """Analyse with each number of workers, print time, speedup and efficiency.
+    The datasets are loaded once before, only the analysis is timed."""
+    datasets = [load_waveforms(path) for path in paths]
+    t = time.perf_counter()
+    reference = analyse_datasets(datasets, workers=1, **kwargs)
+    serial = time.perf_counter() - t
+    print("workers      time   speedup  efficiency")
+    print("{0:7d} {1:9.2f} s {2:8.2f} {3:10.0%}   (this process)".format(1, serial, 1., 1.))
+    for n in worker_counts:
+        t = time.perf_counter()
+        pulses = analyse_datasets(datasets, workers=n, **kwargs)
+        elapsed = time.perf_counter() - t
+        if not np.array_equal(pulses, reference):
+            raise RuntimeError("results with {0} workers differ from the serial analysis".format(n))
+        print("{0:7d} {1:9.2f} s {2:8.2f} {3:10.0%}".format(n, elapsed, serial / elapsed, serial / elapsed / n))
+    return reference
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Find the pulses of recorded datasets on all CPU cores.")
+    parser.add_argument("files", nargs="+", help=".pkl or .pulses datasets")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: all cores)")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="waveforms per task")
+    parser.add_argument("--thl", type=int, default=THL, help="pulse threshold")
+    parser.add_argument("--scaling", default=None, metavar="N,N,...",
+                        help="compare the given worker counts, e.g. 1,2,4,8")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    t = time.perf_counter()
+    if args.scaling:
+        pulses = scaling(args.files, [int(n) for n in args.scaling.split(",")],
+                         chunk_size=args.chunk_size, thl=args.thl)
+    else:
+        pulses = analyse(args.files, args.workers, args.chunk_size, args.thl)
+    for i, path in enumerate(args.files):
+        print(os.path.basename(path) + ":", np.count_nonzero(pulses['file'] == i), "pulses")
+    print(len(pulses), "pulses in total, {0:.2f} s".format(time.perf_counter() - t))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Pulse analysis of recorded datasets as a library and a batch command.
+
+The stages of analyse_and_plot_pulses.py as functions with explicit parameters:
+    dataset_files()     dataset files of a list of files and directories
+    analyse_files()     pulses of one dataset (one or more files or session
+                        manifests, streamed in the given order), through the
+                        results cache (result_cache.py) unless disabled, with
+                        the live time and rate of each file
+    measurement_time()  live time of a dataset [min], the sum of the live
+                        times of its files (see session.file_live_time()), so
+                        the time between files recorded on different days
+                        doesn't count
+    fit_calibration()   linear energy calibration fit of reference centroids
+    histogram()         amplitude histogram with the binning of the plots
+    summarize()         compact summary of a dataset (counts, rate, time, ...)
+    write_summary()     summary (.json) and histogram (.csv) files of a dataset
+    plot_histogram()    histogram with energy axis as image (only module that
+                        imports matplotlib, and only when called)
+
+Usage:
+    python3 -m pulse_analysis DATASET_OR_DIRECTORY [...] [--out DIR] [--plot]
+    python3 -m pulse_analysis FILE [FILE ...] --session NAME
+Every dataset file (or session manifest, replacing its segments) is analysed
+on its own, one after the other in this process, and NAME.summary.json and
+NAME.histogram.csv are written to the output directory (NAME.histogram.png
+with --plot). A dataset that fails to load is reported and skipped. With
+--session, all files together are one measurement (e.g. a campaign recorded
+over several days), the summary lists the pulses, live time and rate of each
+file and of the whole measurement.
+"""
+
+import argparse
+import json
+import os
+import pickle
+import sys
+import time
+import numpy as np
+
+import pulse_finder
+from pulse_finder import THL
+import session
+from result_cache import analyse_cached, CACHE_DIR
+from spectrum import load_calibration, CALIBRATION_FILE
+from stream_analysis import analyse_blocks
+
+# default settings, same as in analyse_and_plot_pulses.py (finder defaults: see pulse_finder.py)
+BIN_WIDTH = 67        # amplitude histogram resolution [arb. unit], as used in the energy calibration
+MIN_ALPHA_PEAK = 1243 # amplitudes above are counted as alpha pulses (min_alpha_peak)
+EXTENSIONS = (".pulses", ".pkl", ".msgp", ".wav", session.MANIFEST_EXTENSION)
+CALIBRATION = CALIBRATION_FILE
+
+# energy calibration reference of the mixed alpha source measurement, see analyse_and_plot_pulses.py
+REF = np.asarray([33, 1300, 3893, 4290, 4636])        # centroids from AASI simulation results [keV]
+DATA_PEAK = np.asarray([300, 2924, 8175, 8875, 9500]) # centroids of the peak amplitudes [arb. unit]
+DATA_AREA = np.asarray([1, 107160, 296230, 321455, 339771]) # corresponding pulse areas
+THR_E_KEV = 6     # estimated from threshold measurement with x-ray machine
+SRC_E_KEV = 40.5  # results in best fit (reducedchisq ~= 1)
+E_KEV = [THR_E_KEV, SRC_E_KEV, SRC_E_KEV, SRC_E_KEV, SRC_E_KEV]
+
+
+def poly1(x, a, b): #1st grade polynom
+    return a*x + b
+
+
+def dataset_files(paths, extensions=EXTENSIONS):
+    """Dataset files given directly or found (not recursively) in the given directories, sorted per directory.
+    Segments of a session manifest in the same directory and their .pkl exports are left out,
+    the manifest stands for them."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            found = sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith(extensions))
+            recorded = set(name for manifest in found if manifest.endswith(session.MANIFEST_EXTENSION)
+                           for name in session.manifest_files(manifest))
+            files += [name for name in found if name not in recorded]
+        else:
+            files.append(path)
+    return files
+
+
+def analyse_files(files, thl=THL, use_cache=True, cache_dir=CACHE_DIR, on_block=None, **params):
+    """Pulses of a dataset stored in one or more files, see stream_analysis.analyse_blocks().
+    The results cache is used unless disabled or on_block needs the waveforms of each block.
+    Session manifests are replaced by their segments. Additional keys of each file summary:
+    'segment' (manifest entry or None), 'pulses', 'live_time' [s] and 'cpm'."""
+    files = session.session_files(files)
+    paths = [f['path'] for f in files]
+    if on_block is not None or not use_cache:
+        result = analyse_blocks(paths, thl, on_block=on_block, **params)
+    else:
+        result = analyse_cached(paths, thl, cache_dir=cache_dir, **params)
+    counts = np.bincount(result['pulses']['file'], minlength=len(paths))
+    for info, f, count in zip(result['files'], files, counts):
+        info['segment'] = f['segment']
+        info['pulses'] = int(count)
+        info['live_time'] = session.file_live_time(info['path'], f['segment'], info['start'], info['stop'])
+        info['cpm'] = count / info['live_time'] * 60 if info['live_time'] > 0 else None
+    return result
+
+
+def measurement_time(result):
+    """Live time of an analysis result [min], the sum of the live times of its files."""
+    return sum(f['live_time'] for f in result['files']) / 60.0
+
+
+def fit_calibration(data=DATA_PEAK, ref=REF, sigma=E_KEV):
+    """Linear fit ref = a * data + b with the errors sigma of ref. Returns a dict with
+    popt (a, b), pcov, perr, fit (at data), residuals, r_squared, chisq and reducedchisq."""
+    from scipy.optimize import curve_fit # only needed for fitting
+    data, ref = np.asarray(data), np.asarray(ref)
+    #http://www.physics.utah.edu/~detar/lessons/python/curve_fit/node1.html
+    popt, pcov = curve_fit(poly1, data, ref, sigma=sigma, absolute_sigma=True)
+    fit = poly1(data, *popt)
+    residuals = ref - fit
+    chisq = np.sum((residuals / np.asarray(sigma))**2)
+    return {'popt': popt, 'pcov': pcov, 'perr': np.sqrt(np.diag(pcov)), 'fit': fit, 'residuals': residuals,
+            'r_squared': 1 - np.sum(residuals**2) / np.sum((ref - np.mean(ref))**2),
+            'chisq': chisq, 'reducedchisq': chisq / float(len(data) - 2)}
+
+
+def histogram(peaks, bin_width=BIN_WIDTH, min_bin=0, max_bin=None):
+    """Counts and bin edges of the pulse amplitudes, bins of bin_width from min_bin up to
+    (at least) max_bin, by default the largest amplitude (as in the histogram plots)."""
+    if max_bin is None:
+        max_bin = max(peaks) if len(peaks) else min_bin
+    return np.histogram(peaks, bins=np.arange(min_bin, max_bin + bin_width, bin_width))
+
+
+def zero_energy_bin(calibration):
+    """Amplitude of 0 keV, the start of the histograms."""
+    return int(np.round(-calibration['b'] / calibration['a']))
+
+
+def summarize(result, calibration=None, min_alpha_peak=MIN_ALPHA_PEAK):
+    """Compact summary of an analysis result, json compatible. 'minutes' is the live time,
+    'cpm' the rate over it, 'files' lists pulses, live time and rate of each file."""
+    peaks = result['pulses']['amplitude']
+    minutes = measurement_time(result)
+    starts = [f['start'] for f in result['files'] if f['start'] is not None]
+    stops = [f['stop'] for f in result['files'] if f['stop'] is not None]
+    summary = {'files': [{'path': f['path'], 'pulses': f['pulses'], 'minutes': f['live_time'] / 60.0,
+                          'cpm': f['cpm']} for f in result['files']],
+               'start': str(min(starts)) if starts else None,
+               'stop': str(max(stops)) if stops else None,
+               'minutes': minutes,
+               'waveforms': int(sum(f['waveforms'] for f in result['files'])),
+               'pulses': len(peaks),
+               'alpha_pulses': int(np.count_nonzero(peaks > min_alpha_peak)),
+               'cpm': len(peaks) / minutes if minutes > 0 else None,
+               'amplitude': {'median': float(np.median(peaks)) if len(peaks) else None,
+                             'max': int(peaks.max()) if len(peaks) else None}}
+    if calibration is not None:
+        energy = poly1(peaks, calibration['a'], calibration['b'])
+        summary['energy_kev'] = {'median': float(np.median(energy)) if len(peaks) else None,
+                                 'max': float(energy.max()) if len(peaks) else None}
+        summary['calibration'] = {'a': calibration['a'], 'b': calibration['b']}
+    return summary
+
+
+def write_summary(out_dir, name, summary, entries, edges, calibration=None):
+    """Write NAME.summary.json and NAME.histogram.csv (amplitude bins, energy bins, counts)."""
+    os.makedirs(out_dir, exist_ok=True)
+    with open(os.path.join(out_dir, name + ".summary.json"), "w") as f:
+        json.dump(summary, f, indent=1, default=str)
+    columns = [edges[:-1], edges[1:]]
+    header = "amplitude_low,amplitude_high"
+    if calibration is not None:
+        columns += [poly1(edges[:-1], calibration['a'], calibration['b']),
+                    poly1(edges[1:], calibration['a'], calibration['b'])]
+        header += ",energy_low_kev,energy_high_kev"
+    np.savetxt(os.path.join(out_dir, name + ".histogram.csv"), np.column_stack(columns + [entries]),
+               delimiter=",", header=header + ",counts", comments="", fmt="%.6g")
+
+
+def plot_histogram(path, entries, edges, calibration=None, title=None):
+    """Save the amplitude histogram (with energy axis if calibrated) as an image."""
+    import matplotlib # only needed for plots
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    fig = plt.figure(figsize=(7, 5))
+    h = fig.add_subplot(111)
+    h.hist(edges[:-1], bins=edges, weights=entries, color="blue", histtype="step", linewidth=0.8)
+    h.set_xlabel('Pulse amplitude [arb. unit]')
+    h.set_ylabel('Counts')
+    if title:
+        h.set_title(title, fontsize=9)
+    if calibration is not None:
+        ax2 = h.secondary_xaxis('top', functions=(lambda x: poly1(x, calibration['a'], calibration['b']),
+                                                  lambda e: (e - calibration['b']) / calibration['a']))
+        ax2.set_xlabel('Energy [keV]')
+    fig.tight_layout()
+    fig.savefig(path)
+    plt.close(fig)
+
+
+def analyse_dataset(paths, name, out_dir, thl=THL, bin_width=BIN_WIDTH, calibration=None, plot=False,
+                    use_cache=True, cache_dir=CACHE_DIR, **params):
+    """All stages for one dataset (list of files), output files named by name, returns its summary."""
+    result = analyse_files(paths, thl, use_cache, cache_dir, **params)
+    min_bin = zero_energy_bin(calibration) if calibration is not None else 0
+    entries, edges = histogram(result['pulses']['amplitude'], bin_width, min_bin)
+    summary = summarize(result, calibration)
+    summary.update(thl=thl, bin_width=bin_width, params=params)
+    write_summary(out_dir, name, summary, entries, edges, calibration)
+    if plot:
+        plot_histogram(os.path.join(out_dir, name + ".histogram.png"), entries, edges, calibration, name)
+    return summary
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Analyse datasets and write a summary and histogram per dataset.")
+    parser.add_argument("paths", nargs="+", help="dataset files (.pulses, .pkl, .msgp, .wav) or directories")
+    parser.add_argument("--out", default="summary", help="output directory")
+    parser.add_argument("--session", default=None, metavar="NAME",
+                        help="analyse all files as one measurement, output files named NAME")
+    parser.add_argument("--thl", type=int, default=THL, help="pulse threshold")
+    parser.add_argument("--min-g", type=int, default=pulse_finder.MIN_G, help="falling edge slope")
+    parser.add_argument("--max-g", type=int, default=pulse_finder.MAX_G, help="limit to ignore vertical lines")
+    parser.add_argument("--min-length", type=int, default=pulse_finder.MIN_LENGTH, help="minimum pulse width")
+    parser.add_argument("--max-length", type=int, default=pulse_finder.MAX_LENGTH, help="maximum pulse width")
+    parser.add_argument("--min-skip", type=int, default=None, help="skip after a rejected edge (default: min length)")
+    parser.add_argument("--bin-width", type=float, default=BIN_WIDTH, help="histogram resolution [arb. unit]")
+    parser.add_argument("--calibration", default=CALIBRATION, help="energy calibration file, 'none' to disable")
+    parser.add_argument("--plot", action="store_true", help="also save the histograms as images")
+    parser.add_argument("--no-cache", action="store_true", help="don't use the results cache")
+    parser.add_argument("--cache-dir", default=CACHE_DIR, help="results cache directory")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    calibration = load_calibration(args.calibration) if args.calibration != "none" else None
+    params = dict(min_g=args.min_g, max_g=args.max_g, min_length=args.min_length, max_length=args.max_length,
+                  min_skip=args.min_skip if args.min_skip is not None else args.min_length)
+    failed = []
+    t = time.perf_counter()
+    files = dataset_files(args.paths)
+    if args.session:
+        datasets = [(files, args.session)]
+    else:
+        datasets = [([path], os.path.basename(path)) for path in files]
+    for paths, name in datasets:
+        try:
+            summary = analyse_dataset(paths, name, args.out, args.thl, args.bin_width, calibration, args.plot,
+                                      not args.no_cache, args.cache_dir, **params)
+        except (OSError, ValueError, KeyError, EOFError, pickle.UnpicklingError) as e:
+            print(name + ": failed -", e, file=sys.stderr)
+            failed.append(name)
+            continue
+        if len(summary['files']) > 1:
+            for f in summary['files']:
+                print("    {0}: {1} pulses in {2:.0f} minutes -> {3} CPM".format(
+                    os.path.basename(f['path']), f['pulses'], f['minutes'],
+                    round(f['cpm'], 3) if f['cpm'] is not None else "-"))
+        print("{0}: {1} pulses in {2:.0f} minutes -> {3} CPM".format(
+            name, summary['pulses'], summary['minutes'],
+            round(summary['cpm'], 3) if summary['cpm'] is not None else "-"))
+    print(len(datasets) - len(failed), "of", len(datasets), "datasets analysed in {0:.1f} s, results in".format(
+        time.perf_counter() - t), args.out)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Crash-safe streaming file format for recorded pulses (.pulses files).
+
+Unlike the .pkl files, which can only be written once at the end of a run,
+this format is appended to while recording. Pulses are written in chunks and
+the file is fsync'ed periodically, so a crash or power cut loses at most the
+last few seconds of data and the memory use of the recorder stays bounded.
+
+File layout (all integers little endian):
+    magic       8 bytes  b"DIYPULS1"
+    records     repeated until end of file, each consisting of
+        tag     4 bytes  record type, see below
+        length  uint32   payload size in bytes
+        crc32   uint32   checksum of the payload
+        payload length bytes
+
+Record types:
+    b"HEAD"  JSON: RATE, FRAME_SIZE, THL, MIN_ALPHA_PEAK, start time, ... (first record)
+             WINDOW is [pre, post] if only a window around each pulse is stored
+    b"EVTP"  chunk of pulses: uint32 n, uint32 frame_len,
+             n x int64 timestamps [ns since epoch, local time as in the .pkl files],
+             n x int8 ptype codes (index into event_store.PTYPE_NAMES),
+             n x int64 stream positions of the first stored sample,
+             n x frame_len int16 samples
+    b"THLC"  JSON: change of the trigger threshold: stream position from which
+             the new thl applies, reason (manual/adaptive), noise estimate
+    b"VETO"  JSON: interval of frames vetoed as interference burst (see veto.py):
+             start and end stream position, frames, reasons, dead_time [s]
+    b"SPEC"  JSON: online energy histogram and counts per minute of the recording
+             so far (see spectrum.py), written when the file is closed
+    b"END "  JSON summary written on a clean shutdown
+
+A reader stops at the first incomplete or corrupt record, therefore a
+truncated file of an interrupted recording can still be read up to the last
+complete chunk. Unknown record types are skipped.
+"""
+
+import os
+import json
+import mmap
+import struct
+import zlib
+import numpy as np
+
+from event_store import events_to_dataframe
+
+MAGIC = b"DIYPULS1"
+RECORD = struct.Struct("<4sII")
+EVENTS = struct.Struct("<II") # header of EVTP records
+FILE_EXTENSION = ".pulses"
+
+
+class PulseFileWriter:
+
+    def __init__(self, path, header):
+        self.path = path
+        self.f = open(path, "wb")
+        self.f.write(MAGIC)
+        self.bytes_written = len(MAGIC)
+        self.write_json(b"HEAD", header)
+        self.sync()
+
+    def write_record(self, tag, payload):
+        self.f.write(RECORD.pack(tag, len(payload), zlib.crc32(payload)))
+        self.f.write(payload)
+        self.bytes_written += RECORD.size + len(payload)
+
+    def write_json(self, tag, obj):
+        self.write_record(tag, json.dumps(obj, default=str).encode("utf-8"))
+
+    def write_events(self, ts, ptype, waves, positions):
+        n = len(ts)
+        if n == 0:
+            return
+        waves = np.ascontiguousarray(waves, dtype='<i2')
+        payload = b"".join((EVENTS.pack(n, waves.shape[1]),
+                            np.ascontiguousarray(ts, dtype='datetime64[ns]').view('<i8').tobytes(),
+                            np.ascontiguousarray(ptype, dtype=np.int8).tobytes(),
+                            np.ascontiguousarray(positions, dtype='<i8').tobytes(),
+                            waves.tobytes()))
+        self.write_record(b"EVTP", payload)
+
+    def sync(self):
+        """Push all written records to the disk."""
+        self.f.flush()
+        os.fsync(self.f.fileno())
+
+    def close(self, summary=None):
+        if self.f is None:
+            return
+        if summary is not None:
+            self.write_json(b"END ", summary)
+        self.sync()
+        self.f.close()
+        self.f = None
+
+
+def iter_records(path):
+    """Yield (tag, payload) of all complete records in a .pulses file."""
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(path + " is not a .pulses file")
+        while True:
+            head = f.read(RECORD.size)
+            if len(head) < RECORD.size:
+                return
+            tag, length, crc = RECORD.unpack(head)
+            payload = f.read(length)
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                return # truncated or damaged tail of an interrupted recording
+            yield tag, payload
+
+
+def read_json_records(path, tags):
+    """Decoded payloads of the JSON records with the given tags, as list of (tag, dict).
+    Only the record headers of other records are read, their payloads are skipped."""
+    records = []
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(path + " is not a .pulses file")
+        while True:
+            head = f.read(RECORD.size)
+            if len(head) < RECORD.size:
+                return records
+            tag, length, crc = RECORD.unpack(head)
+            if tag not in tags:
+                f.seek(length, os.SEEK_CUR)
+                continue
+            payload = f.read(length)
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                return records # truncated or damaged tail of an interrupted recording
+            records.append((tag, json.loads(payload.decode("utf-8"))))
+
+
+def read_summary(path):
+    """END summary of a .pulses file, None for interrupted recordings."""
+    summary = [record for tag, record in read_json_records(path, (b"END ",))]
+    return summary[-1] if summary else None
+
+
+def map_records(path):
+    """Like iter_records(), but the payloads are memoryviews into the memory-mapped
+    file, so event records can be decoded without copying (see dataset.py).
+    The pages of the records already passed are released from memory, they are
+    read from the file again if a payload is still used, so reading a large file
+    only keeps the records in use in memory."""
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size < len(MAGIC):
+            raise ValueError(path + " is not a .pulses file")
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    buf = memoryview(mm)
+    if buf[:len(MAGIC)] != MAGIC:
+        raise ValueError(path + " is not a .pulses file")
+    pos = released = len(MAGIC)
+    while pos + RECORD.size <= len(buf):
+        tag, length, crc = RECORD.unpack_from(buf, pos)
+        pos += RECORD.size
+        payload = buf[pos:pos+length]
+        if len(payload) < length or zlib.crc32(payload) != crc:
+            return # truncated or damaged tail of an interrupted recording
+        yield tag, payload
+        pos += length
+        if hasattr(mmap, "MADV_DONTNEED") and pos - released > (1 << 24):
+            # always from the start: pages of payloads still used later were read in again
+            released = pos - pos % mmap.PAGESIZE
+            mm.madvise(mmap.MADV_DONTNEED, 0, released)
+
+
+def decode_events(payload):
+    """Arrays (ts, ptype, waves, positions) of an EVTP record."""
+    n, frame_len = EVENTS.unpack_from(payload)
+    pos = EVENTS.size
+    ts = np.frombuffer(payload, dtype='<i8', count=n, offset=pos).view('datetime64[ns]')
+    pos += 8 * n
+    ptype = np.frombuffer(payload, dtype=np.int8, count=n, offset=pos)
+    pos += n
+    positions = np.frombuffer(payload, dtype='<i8', count=n, offset=pos)
+    pos += 8 * n
+    waves = np.frombuffer(payload, dtype='<i2', count=n * frame_len, offset=pos).reshape(n, frame_len)
+    return ts, ptype, waves, positions
+
+
+def read_pulse_file(path):
+    """Read a complete or truncated .pulses file.
+    Returns a dict with the header, the optional end summary and
+    the 'ts', 'ptype', 'position' and 'pulse' arrays of all complete chunks
+    as well as the lists of threshold changes 'thl_changes' and veto intervals 'vetoes'
+    and the online 'spectrum' (None if not recorded)."""
+    header, summary = None, None
+    thl_changes, vetoes = [], []
+    spectrum = None
+    ts, ptype, waves, positions = [], [], [], []
+    for tag, payload in iter_records(path):
+        if tag == b"HEAD":
+            header = json.loads(payload.decode("utf-8"))
+        elif tag == b"EVTP":
+            t, p, w, x = decode_events(payload)
+            ts.append(t)
+            ptype.append(p)
+            waves.append(w)
+            positions.append(x)
+        elif tag == b"THLC":
+            thl_changes.append(json.loads(payload.decode("utf-8")))
+        elif tag == b"VETO":
+            vetoes.append(json.loads(payload.decode("utf-8")))
+        elif tag == b"SPEC":
+            spectrum = json.loads(payload.decode("utf-8"))
+        elif tag == b"END ":
+            summary = json.loads(payload.decode("utf-8"))
+    frame_len = record_length(header) if header else 0
+    return {'header': header,
+            'summary': summary,
+            'thl_changes': thl_changes,
+            'vetoes': vetoes,
+            'spectrum': spectrum,
+            'ts': np.concatenate(ts) if ts else np.empty(0, dtype='datetime64[ns]'),
+            'ptype': np.concatenate(ptype) if ptype else np.empty(0, dtype=np.int8),
+            'position': np.concatenate(positions) if positions else np.empty(0, dtype=np.int64),
+            'pulse': np.concatenate(waves) if waves else np.empty((0, frame_len), dtype=np.int16)}
+
+
+def record_length(header):
+    """Number of samples stored per event."""
+    window = header.get('WINDOW')
+    return sum(window) if window else header['FRAME_SIZE']
+
+
+def to_dataframe(data):
+    """Convert the result of read_pulse_file() into the DataFrame format of the .pkl files.
+    The frames of vetoed intervals are not in the file, their dead time is noted in df.attrs
+    ('vetoes', 'dead_time' [s]): rates from the .pkl alone must subtract it from the duration."""
+    window = data['header'].get('WINDOW') if data['header'] else None
+    df = events_to_dataframe(data['ts'], data['ptype'], data['pulse'], window[0] if window else None)
+    df.attrs['vetoes'] = data['vetoes']
+    df.attrs['dead_time'] = sum(veto['dead_time'] for veto in data['vetoes'])
+    return df
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Pulse finder shared by the recorder (online) and the analysis script (offline).
+
+The negative pulses are found by evaluating the derivative of the waveform.
+The falling edge must be steeper than min_g but not steeper than max_g
+(vertical lines are artefacts) and the pulse must return to its start level
+after min_length to max_length samples. This is the same algorithm the
+analysis script analyse_and_plot_pulses.py always used, which walked through
+each waveform with np.delete(). Here, everything that algorithm recomputed for
+the remaining part of the waveform after each step (its minimum, the position
+and value of the steepest slope, the next falling edge) is precomputed once
+per waveform with cumulative minima over the reversed arrays. The remaining
+scan only jumps between candidate positions and never copies the waveform.
+
+find_pulses_block() runs the same algorithm on many waveforms at once, for the
+offline analysis of long measurements. The gradient (in integers), all falling
+edges and steepest slope positions are computed for a whole (N, frame length)
+block, then all waveforms are scanned in lock-step: each step looks up the
+next edge of every waveform with searchsorted() and gathers all pulse windows
+with one array index. The number of python-level steps only depends on the
+frame length, not on the number of waveforms. The results are identical to
+calling find_pulses() for each waveform, about 10x faster than the original
+np.delete() loop and 3x faster than find_pulses() for 4096 sample frames.
+
+window_pulses() selects the pulse each stored window was written for.
+
+find_pulses() and find_pulses_block() return a structured array with one row
+per pulse, ordered by frame and position:
+    frame       index of the waveform (always 0 for a single waveform)
+    position    sample index of the start of the falling edge
+    width       pulse width in samples
+    peak        minimum sample value of the pulse
+    amplitude   pulse height relative to the level at the start of the pulse
+    area        sum of absolute sample values between start and end of the pulse
+"""
+
+import numpy as np
+
+# default settings, same as in analyse_and_plot_pulses.py
+THL = -300
+MIN_G = -20       # steepeness of falling edge slope, almost vertical
+MAX_G = -3300     # limit to ignore vertical lines
+MIN_LENGTH = 44   # about 0.9 ms
+MAX_LENGTH = 120  # about 2.5 ms, tolerates some alpha-pileup
+MIN_SKIP = MIN_LENGTH
+
+PULSE_DTYPE = np.dtype([('frame', np.int64), ('position', np.int64), ('width', np.int32),
+                        ('peak', np.int32), ('amplitude', np.int32), ('area', np.int64)])
+
+# pulses of several dataset files: index of the file and timestamp of the waveform in addition,
+# frame is the index of the waveform in its file (parallel_analysis.py, stream_analysis.py)
+RESULT_DTYPE = np.dtype([('file', np.int32), ('ts', 'datetime64[ns]')] +
+                        [(name, PULSE_DTYPE[name]) for name in PULSE_DTYPE.names])
+
+
+def suffix_min(a):
+    """Minimum of a[..., i:] for every i (along the last axis)."""
+    return np.minimum.accumulate(a[..., ::-1], axis=-1)[..., ::-1]
+
+
+def last_index(a):
+    """Index of the last True value in each row of a, -1 if there is none."""
+    n = a.shape[-1]
+    return np.where(a.any(axis=-1), n - 1 - a[..., ::-1].argmax(axis=-1), -1)
+
+
+def find_pulses(y, thl=THL, min_g=MIN_G, max_g=MAX_G, min_length=MIN_LENGTH,
+                max_length=MAX_LENGTH, min_skip=MIN_SKIP, start=0):
+    """Find all pulses in one waveform y, see module description for the result.
+    The search starts at sample index start, e.g. the known start of a stored pulse."""
+    y = np.asarray(y)
+    n = len(y)
+    if n < max(min_length, 2):
+        return np.zeros(0, dtype=PULSE_DTYPE)
+    idx = np.arange(n)
+    dydx = np.gradient(y)
+    # steepest falling slope of the remaining waveform and its first position
+    g_min = suffix_min(dydx)
+    is_first_min = dydx <= np.append(g_min[1:], np.inf)
+    g_pos = suffix_min(np.where(is_first_min, idx, n))
+    # start of the next falling edge
+    next_edge = suffix_min(np.where(dydx < min_g, idx, n))
+    # waveform and falling edge start within +/- THL range, falling slope is large enough
+    candidate = ((y > thl) & (y < abs(thl)) & (suffix_min(y) < thl) &
+                 (y[g_pos] <= abs(thl)) & (g_min < min_g) & (g_min > max_g))
+
+    pulses = []
+    s = start
+    while n - s >= min_length:
+        if not candidate[s]:
+            s += min_skip
+            continue
+        x1 = next_edge[s]
+        # check where pulse goes back up to original trigger level
+        above = y[x1+min_length:x1+max_length+1] > y[x1]
+        crossing = above.argmax() if above.any() else -1
+        if crossing > 0:
+            x2 = x1 + crossing + min_length
+            peak = y[x1:x2].min()
+            if peak <= thl:
+                area = np.absolute(y[x1:x2].astype(np.int64)).sum()
+                pulses.append((0, x1, x2 - x1, peak, abs(int(peak)) + int(y[x1]), area))
+                s = x2
+                continue
+        # no proper pulse, can be falling slope of overshoot
+        s = x1 + min_skip
+    return np.array(pulses, dtype=PULSE_DTYPE)
+
+
+def group_by_length(waves):
+    """Split waveforms into (row indices, (rows, length) array) groups of equal length.
+    A 2d array is a single group and is not copied."""
+    if isinstance(waves, np.ndarray) and waves.ndim == 2:
+        return [(np.arange(len(waves)), waves)]
+    lengths = np.array([len(w) for w in waves], dtype=np.int64)
+    groups = []
+    for n in np.unique(lengths):
+        rows = np.flatnonzero(lengths == n)
+        groups.append((rows, np.array([waves[i] for i in rows]).reshape(len(rows), n)))
+    return groups
+
+
+def find_pulses_block(waves, thl=THL, min_g=MIN_G, max_g=MAX_G, min_length=MIN_LENGTH,
+                      max_length=MAX_LENGTH, min_skip=MIN_SKIP, starts=None, block_size=1024):
+    """Find all pulses in many waveforms, same results as find_pulses() for each of them.
+    waves is a (N, frame length) array or a list of waveforms (grouped by length),
+    starts the optional start index for each waveform. Blocks of block_size
+    waveforms are processed at once to limit the memory used."""
+    groups = group_by_length(waves)
+    if starts is None:
+        starts = np.zeros(sum(len(rows) for rows, _ in groups), dtype=np.int64)
+    starts = np.asarray(starts, dtype=np.int64)
+    parts = []
+    for rows, block in groups:
+        for i in range(0, len(rows), block_size):
+            found = _find_in_block(block[i:i+block_size], starts[rows[i:i+block_size]], thl, min_g,
+                                   max_g, min_length, max_length, min_skip)
+            found['frame'] = rows[i:i+block_size][found['frame']]
+            parts.append(found)
+    if not parts:
+        return np.zeros(0, dtype=PULSE_DTYPE)
+    pulses = np.concatenate(parts)
+    return pulses[np.lexsort((pulses['position'], pulses['frame']))]
+
+
+def window_pulses(pulses, offsets):
+    """Only the pulse starting at the offset of each stored window (WINDOW setting of
+    pulse_recorder.py), frame = index in offsets. Other pulses in a window have windows of
+    their own, windows where the stored pulse isn't found again are left out."""
+    return pulses[pulses['position'] == offsets[pulses['frame']]]
+
+
+def _next(flat, f, s, n):
+    """First position >= s in row f of a 2d array with row length n, given the sorted flat
+    indices of its True values, or n if there is none."""
+    q = f * n + s
+    j = flat[np.minimum(np.searchsorted(flat, q), len(flat) - 1)] if len(flat) else q
+    return np.where((j >= q) & (j < (f + 1) * n), j - f * n, n)
+
+
+def _find_in_block(y, starts, thl, min_g, max_g, min_length, max_length, min_skip):
+    """find_pulses() for all rows of the 2d array y at once, frame = row index."""
+    m, n = y.shape
+    if m == 0 or n < max(min_length, 2):
+        return np.zeros(0, dtype=PULSE_DTYPE)
+    rows = np.arange(m)
+    # twice np.gradient(y) in integers, so the comparisons below are exact and cheap
+    d2 = np.empty((m, n), dtype=np.int32)
+    np.subtract(y[:, 2:], y[:, :-2], out=d2[:, 1:-1], dtype=np.int32)
+    d2[:, 0] = 2 * (y[:, 1].astype(np.int32) - y[:, 0])
+    d2[:, -1] = 2 * (y[:, -1].astype(np.int32) - y[:, -2])
+    # falling edges, the next one after position s is the start of the pulse
+    edges = np.flatnonzero(d2 < 2 * min_g)
+    # positions where the slope is steeper than everywhere after them, the
+    # next one after s is the (first) steepest slope of the remaining waveform
+    steepest = np.ones((m, n), dtype=bool)
+    np.less_equal(d2[:, :-1], suffix_min(d2[:, 1:]), out=steepest[:, :-1])
+    steepest = np.flatnonzero(steepest)
+    # the remaining waveform goes below THL up to last_below and
+    # has no vertical line (slope steeper than max_g) after last_vertical
+    last_below = last_index(y < thl)
+    last_vertical = last_index(d2 <= 2 * max_g)
+    del d2
+
+    flat = y.reshape(-1)
+    offsets = np.arange(max_length + 1)
+    pulses = []
+    s = starts.copy()
+    active = n - s >= min_length
+    while active.any():
+        f = rows[active]
+        sf = s[f]
+        ys = flat[f * n + sf]
+        # waveform and falling edge start within +/- THL range, falling slope is large enough
+        c = (ys > thl) & (ys < abs(thl)) & (sf <= last_below[f]) & (sf > last_vertical[f])
+        x1 = _next(edges, f[c], sf[c], n)
+        ok = (x1 < n) & (flat[f[c] * n + _next(steepest, f[c], sf[c], n)] <= abs(thl))
+        c[c] = ok
+        s[f[~c]] += min_skip
+        f, x1 = f[c], x1[ok]
+        if len(f) == 0:
+            active = n - s >= min_length
+            continue
+        level = flat[f * n + x1]
+        # check where pulse goes back up to original trigger level
+        window = flat[np.minimum(x1[:, None] + offsets, n - 1) + (f * n)[:, None]]
+        above = (window[:, min_length:] > level[:, None]) & (offsets[min_length:] < (n - x1)[:, None])
+        crossing = np.where(above.any(axis=1), above.argmax(axis=1), -1)
+        width = crossing + min_length
+        k = np.arange(len(f))
+        peak = np.minimum.accumulate(window, axis=1)[k, np.maximum(width - 1, 0)]
+        found = (crossing > 0) & (peak <= thl)
+        if found.any():
+            area = np.cumsum(np.absolute(window[found].astype(np.int64)), axis=1)
+            pulse = np.zeros(found.sum(), dtype=PULSE_DTYPE)
+            pulse['frame'] = f[found]
+            pulse['position'] = x1[found]
+            pulse['width'] = width[found]
+            pulse['peak'] = peak[found]
+            pulse['amplitude'] = np.absolute(peak[found].astype(np.int64)) + level[found]
+            pulse['area'] = area[np.arange(len(area)), width[found] - 1]
+            pulses.append(pulse)
+        # no proper pulse, can be falling slope of overshoot
+        s[f] = np.where(found, x1 + width, x1 + min_skip)
+        active = n - s >= min_length
+    if not pulses:
+        return np.zeros(0, dtype=PULSE_DTYPE)
+    return np.concatenate(pulses)
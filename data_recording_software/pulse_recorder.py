@@ -6,11 +6,14 @@ A live view of triggering pulses is provided via an oscilloscope plot if the pul
 amplitude is larger than the threshold level.
 
 This program tries to process the audio input as fast as possible, therefore no
-further analysis is done here. The trigger amplitude is compared with the
+further analysis is done here. The audio callback only copies each frame into a
+ring buffer, triggering and storage run in a separate thread (see acquisition.py).
+The status line shows the ring buffer occupancy and overflows (= lost frames). The trigger amplitude is compared with the
 MIN_ALPHA_PEAK value and the corresponding particle type ('ptype') is saved with 
-each waveform. Further pulses appearing in the same waveform will not be counted.
-This is the job of the analysis script analyse_and_plot_pulses.py (it will also catch smaller puslses below
-the threshold value.)
+each waveform. All valid pulses in a triggered waveform are counted for the
+displayed pulse rate, using the same pulse finder (pulse_finder.py) as the
+analysis script analyse_and_plot_pulses.py. This includes smaller pulses below
+the threshold value which appear in the same waveform.
 
 Required python modules besides numpy & pandas:
     pyaudio
@@ -24,6 +27,20 @@ Keyboard shortcuts in pulse/oscilloscope plot window:
 Allway close the plot window first (Ctrl-W, CMD-Q etc. or by its closing icon).
 The program will stop recording and save all waveforms in a new .pkl file.
 Only if script displays "done." but still runs, use Ctrl-C.
+
+With STREAM_TO_DISK enabled, pulses are written every few seconds to a .pulses
+file during the measurement. If the program crashes, this file can still be
+read with pulse_file.read_pulse_file() up to the last written chunk.
+With an energy calibration (CALIBRATION_FILE), the energies of all valid pulses
+are histogrammed online and shown with the counts per minute below the plot,
+both are also saved with the data (see spectrum.py).
+Long recordings can be split into several files (ROTATE_HOURS, ROTATE_MB), which
+are listed with their live times in a .session.json manifest (see session.py).
+Lost frames, callback run times etc. are logged to a _metrics.jsonl file and
+can be served on a local HTTP port (METRICS_PORT, see health.py).
+
+For unattended measurements without display use headless_recorder.py instead.
+Recorded files can be replayed through the same pipeline with replay.py.
     
 
 @author: Oliver Keller
@@ -36,54 +53,83 @@ THL = -300    # default threshold value, can be modified
 
 SAVE_DATA = True            # save recorded pulses in .pkl file for later analysis
 DATA_FOLDER = "./data"      # folder for saving recorded data files (create folder if missing)
+STREAM_TO_DISK = True       # write pulses continuously to a crash-safe .pulses file (see pulse_file.py)
+EXPORT_PKL = True           # additionally convert the .pulses file to a .pkl file when finished
 ENABLE_SONIFICATION = False # (requires pyo module, https://github.com/belangeo/pyo)
+SOUND_OUTPUT_DEVICE = 1     # pyo audio output device for the sonification
+SOUND_VOICES = 3            # max. number of sounds playing at the same time
+SOUND_MAX_RATE = 10         # max. number of sounds started per second, further pulses are silent
 MIN_ALPHA_PEAK = -1243      # threshold to distinguish between alpha and electron pulses
                             # as obtained from reference measurements
-
-
+ADAPTIVE_THL = False        # follow the noise of the input with the threshold (see noise_tracker.py),
+                            # THL is only the start value, '+'/'-' still work until the next adaption
+NOISE_K = 6                 # adaptive threshold in standard deviations of the noise below the baseline
+THL_FLOOR = -150            # the adaptive threshold never gets closer to zero than this
+MAX_FALSE_RATE = 0.05       # triggers/s without valid pulse before the adaptive threshold moves further out
+VETO_BURSTS = True          # don't store frames of interference bursts, e.g. motors or phones near the cable
+MAX_CROSSINGS = 20          # veto frames crossing the threshold more often (see veto.py)
+MAX_SIGN_CHANGES = 40       # veto frames swinging more often between large positive and negative values
+VETO_RATE_FACTOR = None     # e.g. 10: also veto while the trigger rate is 10x the long term average,
+                            # also drops real pulses for a while when the count rate rises (e.g. a source)
+SKIP_EMPTY_FRAMES = False   # don't save triggered waveforms without a valid pulse (see pulse_finder.py)
+WINDOW = None               # e.g. (100, 200): only store 100 samples before and 200 after the start
+                            # of each valid pulse instead of the whole frame (>10x smaller files)
+                            # note: with None, pulses crossing a frame border are only stitched for the
+                            # live count, the stored frames are unchanged, so the offline analysis still
+                            # misses or truncates them; stored windows always contain the whole pulse
+OVERLAP = 512               # samples of the previous waveform used to complete pulses crossing
+                            # the frame border, must be longer than the max. pulse length (120)
+                            # plus the stored WINDOW
+
+
+import os
 import sys
-import time
-from pyqtgraph.Qt import QtCore, QtGui, QtWidgets
 import numpy as np
+from pyqtgraph.Qt import QtCore, QtGui, QtWidgets
 import pyqtgraph as pg
-import pyaudio
-import pandas as pd
-import datetime
-import random
+import time
 from functools import partial
-from scipy.signal import argrelextrema
-if ENABLE_SONIFICATION: import pyo
+
+from acquisition import Acquisition
+from health import HealthMonitor
+from spectrum import online_calibration
 
 
 RATE = 48000       # audio sampling rate, should stay like this.
                    # other rates might require new energy calibration
                    # and will in any case require modification of analysis scripts
+INPUT_DEVICE = None # PortAudio input device index, None for the system default input
+                    # several channels/devices can be recorded with headless_recorder.py --channel
 FRAME_SIZE = 4096  # size of waveform frame size. could be modified, but not tested
-
-if ENABLE_SONIFICATION:
-    s = pyo.Server(duplex=0).boot()
-    s.deactivateMidi()
-    s.setOutputDevice(1)
-    pyo.pa_list_devices()
-    s.start()
-    tab_m = pyo.HarmTable([1,0,0,0,0,.3,0,0,0,0,0,.2,0,0,0,0,0,.1,0,0,0,0,.05]).normalize()
-    tab_p = pyo.HarmTable([1,0,.33,0,.2,0,.143,0,.111])
-
-class Ring:
-
-    def __init__(self, fport=250, fmod=100, amp=.3):
-        self.mod = pyo.Osc(tab_m, freq=fmod, mul=amp)
-        self.port = pyo.Osc(tab_p, freq=fport, mul=self.mod)
-
-    def out(self):
-        self.port.out()
-        return self
-
-    def sig(self):
-        return self.port
+RING_SLOTS = 64    # audio frames buffered between audio callback and processing thread (~5.5 s)
+                   # increase if the ring overflow counter in the status line goes up
+GUI_FPS = 20       # max. refresh rate of the oscilloscope plot and status line,
+                   # lower it on slow computers to leave more CPU time for the acquisition
+FLUSH_INTERVAL = 2 # seconds between writes to the .pulses file, at most this much data is lost on a crash
+CALIBRATION_FILE = "energy_calibration.json" # energy calibration for the online spectrum (see spectrum.py),
+                                             # relative to this folder, None disables the spectrum and rate panel
+                                             # (also disabled with a warning if the file can't be read)
+SPECTRUM_INTERVAL = 1 # seconds between updates of the spectrum and rate panel
+ROTATE_HOURS = None # e.g. 1: start a new .pulses (and .pkl) file every hour, see session.py
+ROTATE_MB = None    # e.g. 500: start a new .pulses file when it reaches this size
+METRICS_PORT = None     # e.g. 8000: serve health metrics on http://127.0.0.1:8000/metrics (see health.py)
+METRICS_INTERVAL = 60   # seconds between lines of the _metrics.jsonl log in DATA_FOLDER
+
+def minmax_decimate(y, pixels):
+    """Reduce waveform y to a min. and max. value per pixel column,
+    so narrow pulses stay visible while drawing only 2*pixels points."""
+    step = int(np.ceil(len(y) / max(pixels, 1)))
+    if step <= 1:
+        return np.arange(len(y)), y
+    pad = (-len(y)) % step
+    if pad:
+        y = np.concatenate((y, np.full(pad, y[-1], dtype=y.dtype)))
+    blocks = y.reshape(-1, step)
+    x = np.repeat(np.arange(blocks.shape[0]) * step, 2)
+    return x, np.column_stack((blocks.min(axis=1), blocks.max(axis=1))).ravel()
 
 class Scope(QtGui.QMainWindow):
-    def __init__(self, parent=None):
+    def __init__(self, parent=None, source=None):
         global app
         QtGui.QMainWindow.__init__(self, parent)
         #super(Scope, self).__init__(parent)
@@ -98,73 +144,38 @@ class Scope(QtGui.QMainWindow):
         
         self.app = app
         self.app.aboutToQuit.connect(self.close)
-        self.pcounter=0
-        self.creation_time=datetime.datetime.now()
-        
-        self.df = pd.DataFrame(columns = ['ts','ptype'])
-        self.ptypes = pd.Series(["alpha", "beta", "betagamma", "x-ray", "muon" ,"unknown"], dtype="category")
 
-        self.thl =  THL
         self.hl = -1243 # green cursor, highlight line for measuring only
-        self.peaks=[]
         self.paused = False
         
-        if ENABLE_SONIFICATION:
-            # setup some wild Karplus-Strong oscillator
-            self.lf = pyo.Sine(.03, mul=.2, add=1)
-            self.rg = Ring(fport = [random.choice([62.5,125,187.5,250]) * random.uniform(.99,1.01) for i in range(8)],
-                                    fmod = self.lf * [random.choice([25,50,75,100]) * random.uniform(.99,1.01) for i in range(8)],
-                                    amp = 0.1)
-            self.env = pyo.Adsr(attack=0.01, decay=0.1, sustain=0.5, release=1.5, dur=5, mul=0.1)
-            self.res = pyo.Waveguide(self.rg.sig(), freq=[30.1,60.05,119.7,181,242.5,303.33], dur=30, mul=1*self.env).out()
+        self.sonifier = None
+        if self.sound:
+            # sounds are played by their own thread, the acquisition only queues the pulses
+            from sonification import Sonifier
+            self.sonifier = Sonifier(SOUND_OUTPUT_DEVICE, voices=SOUND_VOICES, max_rate=SOUND_MAX_RATE)
         
-        def audio_callback(in_data, frame_count, time_info, status):
-            now = time.time()
-            samples = np.frombuffer(in_data, dtype=np.int16)
-            peak = samples.min()
-            if  peak < self.thl:
-                t =  pd.datetime.fromtimestamp(now)
-                print("* ", t, end="")
-                pulse = pd.DataFrame()
-                pulse = pulse.assign(ts=[t])
-                if peak < MIN_ALPHA_PEAK:
-                    pulse = pulse.assign(ptype=[self.ptypes[0]]) #alpha
-                    print("   alpha  ", end="")
-                else:
-                    pulse = pulse.assign(ptype=[self.ptypes[1]]) #beta/electron
-                    print("   elect   ", end="")
-                if self.sound:
-                    self.lf.setMul(abs(int(peak)/16000))
-                    self.env.dur = abs(int(peak)/500)
-                    self.env.play()
-                print(self.pcounter, "  ", end="")
-                print(peak)
-                minima=argrelextrema(samples, np.less)
-                self.peaks.append(sum(minima[0])/len(minima[0]/2))
-                self.peaks = self.peaks[-100:] #only keep the last 100 for averaging
-                pulse = pulse.assign(pulse=[samples])
-                if self.save_data:
-                    self.df = self.df.append(pulse, ignore_index=True,sort=False)
-                self.pcounter+=1
-                # calculate pulse rate in counts per second
-                dt = (now-self.lastupdate)
-                if dt <= 0:
-                    dt = 0.000000000001
-                cps2 = 1.0 / dt
-                self.lastupdate = now
-                self.cps = self.cps * 0.9 + cps2 * 0.1 # simple weighted average
-                tx = 'Mean pulse rate:  {cps:.1f} CPS'.format(cps=self.cps )
-                self.label.setText(tx + ", THL (red): " + str(self.thl) + ", cursor(green): " + str(self.hl) + ", (avg peak: "+str(round(sum(self.peaks)/100,1)) + ")")
-                self.ydata=np.frombuffer(in_data, dtype=np.int16)
-                self.frame_counter+=frame_count
-                if not self.paused:
-                    self.h2.setData(self.ydata)
-            self.thlp.setData(FRAME_SIZE*[self.thl])
-            self.hlp.setData(FRAME_SIZE*[self.hl]) #draw green highlight line
-
-            return (in_data, pyaudio.paContinue)
- 
-    
+        self.acq = Acquisition(THL, MIN_ALPHA_PEAK, RATE, FRAME_SIZE, ring_slots=RING_SLOTS,
+                               save_data=self.save_data, data_folder=DATA_FOLDER,
+                               stream_to_disk=STREAM_TO_DISK, flush_interval=FLUSH_INTERVAL,
+                               export_pkl=EXPORT_PKL, skip_empty=SKIP_EMPTY_FRAMES, overlap=OVERLAP,
+                               window=WINDOW, device=INPUT_DEVICE,
+                               adaptive_thl=dict(k=NOISE_K, floor=THL_FLOOR, max_false_rate=MAX_FALSE_RATE)
+                                            if ADAPTIVE_THL else None,
+                               veto=dict(max_crossings=MAX_CROSSINGS, max_sign_changes=MAX_SIGN_CHANGES,
+                                         rate_factor=VETO_RATE_FACTOR)
+                                    if VETO_BURSTS else None,
+                               rotate_interval=ROTATE_HOURS * 3600 if ROTATE_HOURS else None,
+                               rotate_size=ROTATE_MB * 1e6 if ROTATE_MB else None,
+                               calibration=online_calibration(CALIBRATION_FILE and
+                                   os.path.join(os.path.dirname(os.path.abspath(__file__)), CALIBRATION_FILE)))
+        if self.sound:
+            self.acq.on_pulse = self.sonifier.submit
+        self.shown_pulse = None # last drawn waveform and line positions, only redraw on changes
+        self.shown_width = 0
+        self.shown_thl = None
+        self.shown_hl = None
+        self.shown_text = None
+
         #### Create Gui Elements ###########
         self.mainbox = QtGui.QWidget()
         self.setCentralWidget(self.mainbox)
@@ -181,20 +192,23 @@ class Scope(QtGui.QMainWindow):
         self.thlp = self.otherplot.plot(pen='r')
         self.hlp = self.otherplot.plot(pen='g')
 
+        # energy spectrum and counts per minute of all valid pulses, if calibrated
+        self.shown_spectrum = 0 # time of the last update
+        if self.acq.spectrum is not None:
+            self.canvas.nextRow()
+            self.specplot = self.canvas.addPlot(title="Energy spectrum")
+            self.specplot.setLabel('bottom', "Energy", units="keV")
+            self.specplot.setLogMode(y=True)
+            self.spec = self.specplot.plot(stepMode=True, pen='c')
+            self.rateplot = self.canvas.addPlot(title="Counts per minute (all: white, alpha: yellow)")
+            self.rateplot.setLabel('bottom', "Minute")
+            self.rate_all = self.rateplot.plot(pen='w')
+            self.rate_alpha = self.rateplot.plot(pen='y')
+
+        # the GUI is only updated from the Qt main thread, never from the audio or consumer thread
+        self.timer = QtCore.QTimer()
+        self.timer.timeout.connect(self.update_plot)
 
-        self.p = pyaudio.PyAudio()
-        self.stream = self.p.open(format=pyaudio.paInt16, channels=1, rate=RATE, input=True, frames_per_buffer=FRAME_SIZE,stream_callback=audio_callback)
-
-
-        #### Set Data  #####################
-
-        self.x = np.linspace(0,50., num=100)
-        self.X,self.Y = np.meshgrid(self.x,self.x)
-
-        self.frame_counter = 0
-        self.cps = 0.
-        self.lastupdate = time.time()
-        
         # keyboard shortcuts
         
         self.sh = QtGui.QShortcut(QtGui.QKeySequence("+"), self, self.thl_down)
@@ -224,19 +238,52 @@ class Scope(QtGui.QMainWindow):
         #self.sh.setContext(QtCore.Qt.ApplicationShortcut)
 
         #### Start  #####################
-        self.stream.start_stream()
+        self.health = HealthMonitor(self.acq, port=METRICS_PORT, log_interval=METRICS_INTERVAL,
+                                    log_path=self.acq.file_name(".jsonl", "_metrics") if self.save_data else None)
+        self.acq.start(source) # source: replay of a recorded file instead of the audio input, see replay.py
+        self.timer.start(int(1000 / GUI_FPS))
+
+    def update_plot(self):
+        # called by the timer with at most GUI_FPS, shows only the latest pulse
+        acq = self.acq
+        tx = 'Mean pulse rate:  {cps:.1f} CPS'.format(cps=acq.cps)
+        tx = tx + ", THL (red): " + str(acq.thl) + ", cursor(green): " + str(self.hl) + ", (avg peak: "+str(acq.avg_peak()) + "), " + acq.ring_status()
+        if tx != self.shown_text:
+            self.label.setText(tx)
+            self.shown_text = tx
+        pulse = acq.last_pulse
+        width = int(self.otherplot.vb.width())
+        if pulse is not None and not self.paused and (pulse is not self.shown_pulse or width != self.shown_width):
+            self.h2.setData(*minmax_decimate(pulse, width))
+            self.shown_pulse = pulse
+            self.shown_width = width
+        # threshold and cursor lines only need two points each
+        if acq.thl != self.shown_thl:
+            self.thlp.setData([0, FRAME_SIZE-1], [acq.thl, acq.thl])
+            self.shown_thl = acq.thl
+        if self.hl != self.shown_hl:
+            self.hlp.setData([0, FRAME_SIZE-1], [self.hl, self.hl]) #draw green highlight line
+            self.shown_hl = self.hl
+        spectrum = acq.spectrum
+        if spectrum is not None and time.monotonic() - self.shown_spectrum >= SPECTRUM_INTERVAL:
+            edges = np.append(spectrum.edges, spectrum.edges[-1] + spectrum.bin_width)
+            self.spec.setData(edges, spectrum.counts.copy() + 0.1) # log scale, empty bins at 0.1
+            rates = spectrum.rates().copy()
+            self.rate_all.setData(rates[0])
+            self.rate_alpha.setData(rates[1])
+            self.shown_spectrum = time.monotonic()
     
     def toggle_pause(self):
         self.paused = not self.paused
         
     
     def thl_up(self):
-        self.thl+=1
-        #print(self.thl)
+        self.acq.thl+=1
+        #print(self.acq.thl)
 
     def thl_down(self):
-        #print(self.thl)
-        self.thl-=1
+        #print(self.acq.thl)
+        self.acq.thl-=1
 
     def hl_up(self,i):
         self.hl+=i
@@ -246,25 +293,15 @@ class Scope(QtGui.QMainWindow):
         #print(self.thl)
         self.hl-=i
         
-    def close_stream(self):
-        self.stream.close()
-        self.stream.stop_stream()
-        print("Stream closed")
-        
     def close(self):
-        timediff = datetime.datetime.now() - self.creation_time
-        self.close_stream()
-        if self.save_data and self.pcounter > 0:
-            print("Saving data to file...")
-            #print(self.df.to_string)
-            td_str = '-'.join(str(timediff).split(':')[:2])
-            _ = self.df.to_pickle(DATA_FOLDER + self.creation_time.strftime("/pulses_%Y-%m-%d_%H-%M-%S") + "___" + str(self.pcounter) + "___" + td_str + ".pkl")
-            print("Saving completed.")
-            print()
-            print('Number of recorded waveforms:', self.pcounter, "of",self.frame_counter, "total audio frames")
-            print('at least', len(self.df[self.df['ptype'] == 'alpha']) ,"alphas and") 
-            print('at least', len(self.df[self.df['ptype'] == 'beta']) ,"electrons/betas were detected") 
-        self.p.terminate()
+        self.timer.stop()
+        self.acq.stop()
+        self.acq.save()
+        self.acq.summary()
+        self.health.stop()
+        if self.sonifier is not None:
+            self.sonifier.stop()
+            self.sonifier = None
         app = QtGui.QApplication([])
         app.closeAllWindows()
         app.quit()
@@ -272,17 +309,21 @@ class Scope(QtGui.QMainWindow):
         print('done.')
 
         
-if __name__ == '__main__':
+def main(source=None):
+    global app
     #app = pg.mkQApp()
     # app = QtWidgets.QApplication(sys.argv)
     if not QtWidgets.QApplication.instance():
         app = QtWidgets.QApplication(sys.argv)
     else:
         app = QtWidgets.QApplication.instance() 
-    mainWin = Scope()
+    mainWin = Scope(source=source)
     mainWin.show()
     #if (sys.flags.interactive != 1) or not hasattr(QtCore, 'PYQT_VERSION'):
     app.exec_()
-    if ENABLE_SONIFICATION: s.stop()
+
+
+if __name__ == '__main__':
+    main()
 
 
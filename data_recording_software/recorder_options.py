@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Default settings and command line options shared by the recorder scripts
+without GUI (headless_recorder.py and replay.py). The defaults are the same as
+the settings in pulse_recorder.py, the pulse finder defaults are those of
+pulse_finder.py (THL).
+
+add_arguments() adds the options for the adaptive threshold, the burst veto,
+the rotation of the output files and the energy calibration to a parser,
+adaptive_thl(), veto(), rotation() and calibration() turn the parsed options
+into the arguments of acquisition.Acquisition.
+"""
+
+from pulse_finder import THL
+from spectrum import online_calibration, CALIBRATION_FILE # energy_calibration.json next to the scripts
+
+# default settings, same as in pulse_recorder.py
+MIN_ALPHA_PEAK = -1243
+DATA_FOLDER = "./data"
+RATE = 48000
+FRAME_SIZE = 4096
+RING_SLOTS = 64
+FLUSH_INTERVAL = 2
+OVERLAP = 512
+
+NOISE_K = 6
+THL_FLOOR = -150
+MAX_FALSE_RATE = 0.05
+
+MAX_CROSSINGS = 20
+MAX_SIGN_CHANGES = 40
+
+
+def add_arguments(parser):
+    parser.add_argument("--adaptive-thl", action="store_true",
+                        help="follow the input noise with the threshold, --thl is the start value")
+    parser.add_argument("--noise-k", type=float, default=NOISE_K,
+                        help="adaptive threshold in standard deviations below the baseline (default: %(default)s)")
+    parser.add_argument("--thl-floor", type=int, default=THL_FLOOR,
+                        help="the adaptive threshold never gets closer to zero than this (default: %(default)s)")
+    parser.add_argument("--max-false-rate", type=float, default=MAX_FALSE_RATE,
+                        help="target max. triggers/s without valid pulse (default: %(default)s)")
+    parser.add_argument("--no-veto", action="store_true",
+                        help="store all triggered frames, also those of interference bursts (see veto.py)")
+    parser.add_argument("--max-crossings", type=int, default=MAX_CROSSINGS,
+                        help="veto frames with more threshold crossings (default: %(default)s)")
+    parser.add_argument("--max-sign-changes", type=int, default=MAX_SIGN_CHANGES,
+                        help="veto frames with more large swings between positive and negative (default: %(default)s)")
+    parser.add_argument("--veto-rate-factor", type=float,
+                        help="also veto frames while the trigger rate is this many times the long term average,"
+                             " this drops real pulses after a rise of the count rate (default: off)")
+    parser.add_argument("--rotate-hours", type=float,
+                        help="start a new output file after this many hours of recording")
+    parser.add_argument("--rotate-mb", type=float,
+                        help="start a new output file when the .pulses file reaches this size")
+    parser.add_argument("--calibration", default=CALIBRATION_FILE,
+                        help="energy calibration for the online spectrum, '' to disable (default: %(default)s)")
+
+
+def adaptive_thl(args):
+    """NoiseTracker settings from the command line, None for a fixed threshold."""
+    if not args.adaptive_thl:
+        return None
+    return dict(k=args.noise_k, floor=args.thl_floor, max_false_rate=args.max_false_rate)
+
+
+def rotation(args):
+    """Acquisition arguments for splitting the output into several files."""
+    return dict(rotate_interval=args.rotate_hours * 3600 if args.rotate_hours else None,
+                rotate_size=args.rotate_mb * 1e6 if args.rotate_mb else None)
+
+
+def veto(args):
+    """BurstVeto settings from the command line, None without veto."""
+    if args.no_veto:
+        return None
+    return dict(max_crossings=args.max_crossings, max_sign_changes=args.max_sign_changes,
+                rate_factor=args.veto_rate_factor)
+
+
+def calibration(args):
+    """Energy calibration of the online spectrum, None if disabled or not readable."""
+    return online_calibration(args.calibration)
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Replay recorded data through the acquisition pipeline of the pulse recorder,
+without a sound card.
+
+The frames of a recording are pushed into the ring buffer of acquisition.py
+as if they came from the audio input, so triggering, pulse finding, stitching
+and storage run exactly as during a measurement. Supported input files:
+    .pkl     datasets of pulse_recorder.py (e.g. diode_detector/data)
+    .pulses  streamed files of pulse_recorder.py (see pulse_file.py)
+    .wav     continuous 16 bit audio recordings, the first channel is used
+    .msgp    recordings of the webGui (requires the msgpack module)
+
+The .pkl and .msgp files only contain the triggered frames. Their stream
+positions are reconstructed from the timestamps: frames recorded less than
+half a frame apart are treated as contiguous, larger gaps are kept. Like the
+stored frames of .pulses files, they are replayed as a sparse stream: the
+skipped stream positions are untriggered frames, not lost frames, so they
+count as live time of a saved replay (lost frames of the original recording
+can't be told apart from them).
+
+The replay runs as fast as possible (--speed 0, default) or paced, e.g.
+--speed 1 for real time. Afterwards the throughput (frames/s, pulses/s) and
+the pulse counts are printed for each file, which can be used to benchmark the
+acquisition and to compare trigger settings on the reference datasets:
+    python3 replay.py ../data_analysis_and_reference_measurements/diode_detector/data/*.pkl
+    python3 replay.py --thl -400 --window 100 200 recording.wav
+
+With --gui, the oscilloscope window of pulse_recorder.py shows the replay
+(one file only). Nothing is saved unless --save is given.
+"""
+
+import argparse
+import os
+import time
+import wave
+import numpy as np
+
+from acquisition import Acquisition
+import recorder_options
+from recorder_options import THL, MIN_ALPHA_PEAK, DATA_FOLDER, RATE, FRAME_SIZE, RING_SLOTS, OVERLAP
+import pulse_file
+
+
+def stream_positions(ts, lengths, rate):
+    """Stream positions of frames with timestamps ts [datetime64].
+    Gaps shorter than half a frame are closed, frames never overlap."""
+    lengths = np.asarray(lengths, dtype=np.int64)
+    if len(ts) == 0:
+        return np.zeros(0, dtype=np.int64)
+    elapsed = (ts - ts[0]).astype('timedelta64[ns]').astype(np.int64)
+    pos = np.round(elapsed * (rate / 1e9)).astype(np.int64)
+    gaps = np.diff(pos) - lengths[:-1]
+    gaps[gaps < lengths[:-1] // 2] = 0
+    return np.concatenate(([0], np.cumsum(lengths[:-1] + gaps)))
+
+
+class ReplaySource:
+
+    def __init__(self, path, frame_size=FRAME_SIZE, rate=RATE, speed=0.):
+        self.path = path
+        self.rate = rate
+        self.speed = speed # 1 = real time, 0 = as fast as possible
+        self.t0 = None     # local time of stream position 0, None: time of the replay
+        self.sparse = True # only triggered frames, see Acquisition.sparse
+        ext = os.path.splitext(path)[1].lower()
+        if ext == ".pkl":
+            self.load_pkl(path)
+        elif ext == pulse_file.FILE_EXTENSION:
+            self.load_pulses(path)
+        elif ext == ".wav":
+            self.load_wav(path, frame_size)
+        elif ext == ".msgp":
+            self.load_msgp(path)
+        else:
+            raise ValueError("unknown file type: " + path)
+        self.frame_size = max([frame_size] + [len(w) for w in self.waves])
+        self.samples = sum(len(w) for w in self.waves)
+
+    def load_triggered(self, ts, waves):
+        self.waves = [np.ascontiguousarray(w, dtype=np.int16) for w in waves]
+        ts = np.asarray(ts, dtype='datetime64[ns]')
+        self.positions = stream_positions(ts, [len(w) for w in self.waves], self.rate)
+        if len(ts):
+            self.t0 = ts[0]
+
+    def load_pkl(self, path):
+        import pandas as pd # only needed for .pkl files
+        df = pd.read_pickle(path)
+        self.load_triggered(df['ts'].values, df['pulse'])
+
+    def load_pulses(self, path):
+        data = pulse_file.read_pulse_file(path)
+        if data['header']:
+            self.rate = data['header']['RATE']
+        self.waves = list(data['pulse'])
+        self.positions = data['position']
+        if len(self.positions):
+            self.t0 = data['ts'][0] - np.timedelta64(int(round(self.positions[0] * 1e9 / self.rate)), 'ns')
+
+    def load_wav(self, path, frame_size):
+        with wave.open(path, "rb") as f:
+            if f.getsampwidth() != 2:
+                raise ValueError(path + " is not a 16 bit recording")
+            self.rate = f.getframerate()
+            channels = f.getnchannels()
+            y = np.frombuffer(f.readframes(f.getnframes()), dtype='<i2')
+        y = y[::channels]
+        self.positions = np.arange(0, len(y), frame_size)
+        self.sparse = False
+        self.waves = [y[x:x+frame_size] for x in self.positions]
+
+    def load_msgp(self, path):
+        import msgpack # only needed for webGui recordings
+        with open(path, "rb") as f:
+            data = msgpack.unpackb(f.read(), raw=False)
+        if isinstance(data, dict):
+            data = [data[k] for k in sorted(data, key=int)]
+        ts = np.array([d['ts'] for d in data], dtype='datetime64[ms]')
+        self.load_triggered(ts, [d['pulse'] for d in data])
+
+    def frames(self):
+        """Yield (stream position, samples) of all frames, paced according to speed."""
+        started = time.monotonic()
+        first = self.positions[0] if len(self.positions) else 0
+        for x, w in zip(self.positions, self.waves):
+            if self.speed > 0:
+                delay = started + (x - first) / self.rate / self.speed - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            yield int(x), w
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Replay recorded pulses through the pulse recorder pipeline.")
+    parser.add_argument("files", nargs="+",
+                        help=".pkl, .pulses, .wav or .msgp files")
+    parser.add_argument("--thl", type=int, default=THL,
+                        help="trigger threshold (default: %(default)s)")
+    parser.add_argument("--min-alpha-peak", type=int, default=MIN_ALPHA_PEAK,
+                        help="amplitude separating alpha from electron pulses (default: %(default)s)")
+    parser.add_argument("--speed", type=float, default=0,
+                        help="replay speed, 1 = real time, 0 = as fast as possible (default: %(default)s)")
+    recorder_options.add_arguments(parser) # adaptive threshold, veto, rotation, calibration
+    parser.add_argument("--window", type=int, nargs=2, metavar=("PRE", "POST"),
+                        help="only store PRE samples before and POST samples after each pulse start")
+    parser.add_argument("--save", action="store_true",
+                        help="save the replayed pulses like a recording")
+    parser.add_argument("--data-folder", default=DATA_FOLDER,
+                        help="folder for saved files (default: %(default)s)")
+    parser.add_argument("--gui", action="store_true",
+                        help="show the replay in the oscilloscope window of pulse_recorder.py, with its settings")
+    parser.add_argument("--verbose", action="store_true",
+                        help="print one line per triggered frame")
+    return parser.parse_args(argv)
+
+
+def replay(path, args):
+    source = ReplaySource(path, FRAME_SIZE, RATE, args.speed)
+    acq = Acquisition(args.thl, args.min_alpha_peak, source.rate, source.frame_size,
+                      ring_slots=RING_SLOTS, save_data=args.save, data_folder=args.data_folder,
+                      overlap=OVERLAP, window=args.window, verbose=args.verbose,
+                      adaptive_thl=recorder_options.adaptive_thl(args), veto=recorder_options.veto(args),
+                      **recorder_options.rotation(args),
+                      calibration=recorder_options.calibration(args))
+    started = time.perf_counter()
+    acq.start(source)
+    while acq.feeding:
+        time.sleep(0.01)
+    acq.stop()
+    elapsed = time.perf_counter() - started
+    print("{name}: {frames} frames, {pulses} pulses (stitched: {stitched}), {stored} stored, {vetoed} vetoed, THL: {thl} ({changes} changes), "
+          "{elapsed:.2f} s, {fps:.0f} frames/s, {pps:.0f} pulses/s, {rt:.1f}x real time".format(
+              name=os.path.basename(path), frames=acq.frame_counter, pulses=acq.pulse_counter,
+              stitched=acq.stitched, stored=acq.pcounter, vetoed=acq.vetoed_frames, thl=acq.thl,
+              changes=len(acq.thl_changes), elapsed=elapsed,
+              fps=acq.frame_counter / elapsed, pps=acq.pulse_counter / elapsed,
+              rt=source.samples / source.rate / elapsed), flush=True)
+    if args.save:
+        acq.save()
+    return acq
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.gui:
+        if len(args.files) > 1:
+            raise SystemExit("--gui replays only one file")
+        import pulse_recorder # Qt is only needed here
+        pulse_recorder.main(ReplaySource(args.files[0], FRAME_SIZE, RATE, args.speed or 1))
+        return
+    for path in args.files:
+        replay(path, args)
+
+
+if __name__ == '__main__':
+    main()
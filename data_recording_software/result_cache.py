@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Disk cache of the pulse analysis results, so the plots of a long measurement
+can be redone without running the pulse finder again.
+
+analyse_cached() returns the same as stream_analysis.analyse_blocks(). The
+results of each dataset file (the per-pulse results: timestamp, waveform
+index, position, width, peak, amplitude, area; the PulseMap counts and the
+file summary) are stored in one .npz file in the cache directory, named by a
+hash of
+    - the content of the dataset file (sha256),
+    - the finder parameters thl, min_g, max_g, min_length, max_length and
+      min_skip (defaults of pulse_finder.py filled in),
+    - CACHE_VERSION, to be increased whenever the results of the analysis change.
+So renamed or copied datasets are found again and changed parameters give a
+new entry. Hashing reads the whole file once; the digest is remembered in
+index.json together with size and modification time of the file and the
+entries stored for it, so unchanged files are not read again.
+
+The cache is limited to max_bytes: after storing a result, the least recently
+used entries (by modification time, which is updated on each hit) are deleted
+and removed from the index, files without entries left are dropped from it.
+The index is read and replaced right before each change, through a temporary
+file renamed over it, so concurrent runs never leave a partly written index
+(at worst a digest is computed again).
+
+Usage:
+    python3 result_cache.py DATASET [DATASET ...] [--thl THL]
+    python3 result_cache.py --clear
+The first form analyses the datasets through the cache and prints for each
+file if the result was cached, the second deletes all entries.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import tempfile
+import time
+import numpy as np
+
+import pulse_finder
+from pulse_finder import RESULT_DTYPE, THL
+from dataset import BLOCK_SIZE
+from stream_analysis import analyse_blocks, PulseMap
+
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "pulse_analysis")
+MAX_BYTES = 2 * 1024**3 # 2 GB
+CACHE_VERSION = 2
+INDEX = "index.json"
+PARAMS = ['min_g', 'max_g', 'min_length', 'max_length', 'min_skip']
+
+
+def read_index(cache_dir=CACHE_DIR):
+    try:
+        with open(os.path.join(cache_dir, INDEX)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def update_index(change, cache_dir=CACHE_DIR):
+    """Apply change(index) to the current index and replace the index file atomically."""
+    index = read_index(cache_dir)
+    change(index)
+    fd, tmp = tempfile.mkstemp(dir=cache_dir, prefix=INDEX, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(index, f, indent=1)
+        os.replace(tmp, os.path.join(cache_dir, INDEX))
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def file_digest(path, cache_dir=CACHE_DIR, chunk_size=1 << 22):
+    """sha256 of the file content, read again only if size or modification time changed."""
+    st = os.stat(path)
+    key = os.path.abspath(path)
+    record = read_index(cache_dir).get(key)
+    if isinstance(record, dict) and (record['size'], record['mtime_ns']) == (st.st_size, st.st_mtime_ns):
+        return record['digest']
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    digest = h.hexdigest()
+
+    def change(index):
+        old = index.get(key)
+        entries = old['entries'] if isinstance(old, dict) and old['digest'] == digest else []
+        index[key] = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'digest': digest, 'entries': entries}
+    os.makedirs(cache_dir, exist_ok=True)
+    update_index(change, cache_dir)
+    return digest
+
+
+def add_to_index(path, name, cache_dir=CACHE_DIR):
+    """Note the entry name stored for the dataset file path."""
+    key = os.path.abspath(path)
+
+    def change(index):
+        record = index.get(key)
+        if isinstance(record, dict) and name not in record['entries']:
+            record['entries'].append(name)
+    update_index(change, cache_dir)
+
+
+def cache_key(digest, thl, **params):
+    """Name of the cache entry of a file digest and the finder parameters."""
+    settings = {name: params.get(name, getattr(pulse_finder, name.upper())) for name in PARAMS}
+    settings['thl'] = thl
+    text = json.dumps({'file': digest, 'params': settings, 'version': CACHE_VERSION}, sort_keys=True)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def load_entry(path):
+    """Result of one file as stored by store_entry(), None if missing or unreadable."""
+    try:
+        with np.load(path) as entry:
+            pulses, counts = entry['pulses'], entry['counts']
+            info = json.loads(str(entry['info']))
+    except (OSError, ValueError, KeyError):
+        return None
+    os.utime(path) # mark as recently used for the eviction
+    for name in ('start', 'stop'):
+        info[name] = np.datetime64(info[name]) if info[name] is not None else None
+    return pulses, counts, info
+
+
+def store_entry(path, pulses, counts, info):
+    """Write an entry atomically, an interrupted write leaves no broken entry."""
+    info = dict(info, start=None if info['start'] is None else str(info['start']),
+                stop=None if info['stop'] is None else str(info['stop']))
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.savez_compressed(f, pulses=pulses, counts=counts, info=np.array(json.dumps(info, default=int)))
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def evict(cache_dir=CACHE_DIR, max_bytes=MAX_BYTES):
+    """Delete the least recently used entries until the cache fits into max_bytes
+    and remove them from the index."""
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith(".npz"):
+            st = os.stat(os.path.join(cache_dir, name))
+            entries.append((st.st_mtime, st.st_size, name))
+    total = sum(size for _, size, _ in entries)
+    removed = set()
+    for _, size, name in sorted(entries):
+        if total <= max_bytes:
+            break
+        os.remove(os.path.join(cache_dir, name))
+        removed.add(name)
+        total -= size
+    if not removed:
+        return
+
+    def change(index):
+        for key, record in list(index.items()):
+            if not isinstance(record, dict):
+                del index[key] # written by an older version
+                continue
+            left = [name for name in record['entries'] if name not in removed]
+            if len(left) < len(record['entries']):
+                record['entries'] = left
+                if not left:
+                    del index[key]
+    update_index(change, cache_dir)
+
+
+def clear(cache_dir=CACHE_DIR):
+    if os.path.isdir(cache_dir):
+        for name in os.listdir(cache_dir):
+            if name.endswith((".npz", ".tmp")) or name == INDEX:
+                os.remove(os.path.join(cache_dir, name))
+
+
+def analyse_cached(paths, thl=THL, block_size=BLOCK_SIZE, cache_dir=CACHE_DIR, max_bytes=MAX_BYTES, **params):
+    """stream_analysis.analyse_blocks() with the results of each file taken from or stored in
+    the cache. 'cached' in the file summaries tells whether the result came from the cache."""
+    os.makedirs(cache_dir, exist_ok=True)
+    pmap = PulseMap(params.get('max_length', pulse_finder.MAX_LENGTH),
+                    params.get('min_length', pulse_finder.MIN_LENGTH))
+    parts, files = [], []
+    for i, path in enumerate(paths):
+        entry_path = os.path.join(cache_dir, cache_key(file_digest(path, cache_dir), thl, **params) + ".npz")
+        entry = load_entry(entry_path) if os.path.exists(entry_path) else None
+        if entry is not None and entry[1].shape != pmap.counts.shape:
+            entry = None # stored with other PulseMap settings
+        if entry is None:
+            result = analyse_blocks([path], thl, block_size, **params)
+            entry = result['pulses'], result['map'].counts, dict(result['files'][0], pulses=result['map'].pulses)
+            store_entry(entry_path, *entry)
+            add_to_index(path, os.path.basename(entry_path), cache_dir)
+            evict(cache_dir, max_bytes)
+            cached = False
+        else:
+            cached = True
+        pulses, counts, info = entry
+        pulses = pulses.astype(RESULT_DTYPE)
+        pulses['file'] = i
+        parts.append(pulses)
+        pmap.counts += counts
+        pmap.pulses += info.pop('pulses')
+        files.append(dict(info, path=path, cached=cached))
+    return {'pulses': np.concatenate(parts) if parts else np.zeros(0, dtype=RESULT_DTYPE),
+            'files': files, 'map': pmap}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Analyse datasets through the results cache.")
+    parser.add_argument("files", nargs="*", help=".pulses, .pkl, .wav or .msgp datasets")
+    parser.add_argument("--thl", type=int, default=THL, help="pulse threshold")
+    parser.add_argument("--cache-dir", default=CACHE_DIR, help="cache directory")
+    parser.add_argument("--clear", action="store_true", help="delete all cached results")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.clear:
+        clear(args.cache_dir)
+    t = time.perf_counter()
+    result = analyse_cached(args.files, args.thl, cache_dir=args.cache_dir)
+    for i, info in enumerate(result['files']):
+        print(os.path.basename(info['path']) + ":", np.count_nonzero(result['pulses']['file'] == i), "pulses",
+              "(cached)" if info['cached'] else "")
+    if args.files:
+        print(len(result['pulses']), "pulses in total, {0:.2f} s".format(time.perf_counter() - t))
+
+
+if __name__ == '__main__':
+    main()
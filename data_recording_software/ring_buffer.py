@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Preallocated ring buffer for passing audio frames from the PortAudio callback
+to a consumer thread.
+
+There is exactly one producer (the audio callback) and one consumer (the
+processing thread). The producer only copies the int16 samples into the next
+free slot and advances the write counter, the consumer reads a slot in place
+and advances the read counter afterwards. Each counter is written by one
+thread only, so no lock is needed on either side. If the consumer falls behind
+and all slots are in use, new frames are dropped and counted as overflows
+instead of blocking the audio thread.
+
+Each slot also keeps the position of its first sample in the audio stream.
+The position counts dropped frames, too, so sample positions (and the
+timestamps derived from them) stay exact after an overflow.
+"""
+
+import time
+import numpy as np
+
+
+class FrameRing:
+
+    def __init__(self, slots, frame_size, dtype=np.int16):
+        self.slots = slots
+        self.frame_size = frame_size
+        self.buf = np.zeros((slots, frame_size), dtype=dtype)
+        self.lengths = np.zeros(slots, dtype=np.int64) # last frame of a stream can be shorter
+        self.starts = np.zeros(slots, dtype=np.int64)  # stream position of the first sample in each slot
+        self.samples_in = 0  # samples delivered by the audio stream so far, including dropped frames (producer only)
+        self.head = 0        # number of frames written so far (producer only)
+        self.tail = 0        # number of frames consumed so far (consumer only)
+        self.overflows = 0   # frames dropped because the ring was full
+        self.high_water = 0  # max. number of occupied slots seen so far
+
+    def occupancy(self):
+        return self.head - self.tail
+
+    def push(self, in_data, start=None):
+        """Copy one frame of raw int16 audio data into the ring.
+        Called from the audio callback, returns False if the frame was dropped.
+        A replay (replay.py) can pass the stream position of a frame after a gap as start."""
+        # in_data can also be an array, e.g. one channel of a multi-channel frame (strided view)
+        samples = in_data if isinstance(in_data, np.ndarray) else np.frombuffer(in_data, dtype=self.buf.dtype)
+        if start is not None:
+            self.samples_in = start
+        start = self.samples_in
+        self.samples_in += samples.size
+        used = self.head - self.tail
+        if used >= self.slots:
+            self.overflows += 1
+            return False
+        n = min(samples.size, self.frame_size)
+        slot = self.head % self.slots
+        self.buf[slot, :n] = samples[:n]
+        self.lengths[slot] = n
+        self.starts[slot] = start
+        self.head += 1
+        if used + 1 > self.high_water:
+            self.high_water = used + 1
+        return True
+
+    def peek(self):
+        """Oldest unread frame as (stream position, view into the ring), or None if empty.
+        The view stays valid until release() is called."""
+        if self.head == self.tail:
+            return None
+        slot = self.tail % self.slots
+        return int(self.starts[slot]), self.buf[slot, :self.lengths[slot]]
+
+    def release(self):
+        """Hand the slot returned by the last peek() back to the producer."""
+        self.tail += 1
+
+    def wait(self, timeout, poll=0.002):
+        """Block the consumer until a frame is available or timeout [s] passed.
+        Polling keeps the producer side free of any synchronisation."""
+        deadline = time.monotonic() + timeout
+        while self.head == self.tail:
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(poll)
+        return True
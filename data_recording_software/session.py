@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Recording sessions consisting of several .pulses files (segments).
+
+For long measurements the recorder starts a new output file after a given
+time or file size (ROTATE_HOURS / ROTATE_MB in pulse_recorder.py), so each
+file stays small enough to be loaded quickly. All segments of a recording
+are listed in a session manifest, a JSON file next to the data files
+(pulses_<session start>.session.json), which is rewritten after each segment.
+For every segment it holds
+    file            name of the .pulses file (in the same folder)
+    pkl             name of the exported .pkl file, if any
+    start, stop     local time of the first and after the last sample
+    start_position, end_position   stream positions [samples]
+    duration        (end_position - start_position) / RATE [s]
+    dead_time       vetoed interference bursts [s], see veto.py
+    gap_time        frames lost e.g. by ring buffer overflows [s]
+    live_time       duration - dead_time - gap_time [s]
+    frames, stored, pulses  processed frames, stored waveforms, valid pulses
+and the 'gaps' (stream intervals without data) of the session.
+
+read_session() loads all segments as one dataset in the format of
+pulse_file.read_pulse_file() with the total live time added.
+
+For the analysis of measurements in several files (sessions or e.g. .pkl files
+of several days), session_files() expands manifests into their segments and
+file_live_time() gives the live time of each file, so the rates don't count
+the time between the files: the live time of the manifest segment, else the
+one of the END summary of a .pulses file, else the time from the first to the
+last waveform of the file (minus the vetoed intervals of an interrupted
+.pulses file). The sum over the files is the live time of the
+measurement (see pulse_analysis.py).
+"""
+
+import os
+import json
+import numpy as np
+
+import pulse_file
+
+MANIFEST_EXTENSION = ".session.json"
+
+
+def write_manifest(path, manifest):
+    """Replace the manifest file atomically, a crash leaves the previous version."""
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(manifest, f, indent=1, default=str)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def read_manifest(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def live_time(manifest):
+    """Total live time [s] of all segments of a session."""
+    return sum(seg['live_time'] for seg in manifest['segments'])
+
+
+def read_session(path):
+    """Read all segments of a session into one dataset, see pulse_file.read_pulse_file().
+    Additional keys: 'manifest', 'live_time' [s] and 'segment' (index of the segment of each pulse)."""
+    manifest = read_manifest(path)
+    folder = os.path.dirname(path)
+    parts = [pulse_file.read_pulse_file(os.path.join(folder, seg['file'])) for seg in manifest['segments']]
+    if not parts:
+        raise ValueError(path + " contains no segments")
+    data = {'header': parts[0]['header'],
+            'summary': parts[-1]['summary'],
+            'spectrum': parts[-1]['spectrum'], # accumulated over the whole session
+            'manifest': manifest,
+            'live_time': live_time(manifest),
+            'segment': np.concatenate([np.full(len(p['ts']), i) for i, p in enumerate(parts)])}
+    for key in ('ts', 'ptype', 'position', 'pulse'):
+        data[key] = np.concatenate([p[key] for p in parts])
+    for key in ('thl_changes', 'vetoes'):
+        data[key] = [x for p in parts for x in p[key]]
+    return data
+
+
+def manifest_files(path):
+    """All data files of a session: the .pulses segments and their .pkl exports."""
+    folder = os.path.dirname(path)
+    return [os.path.join(folder, name) for seg in read_manifest(path)['segments']
+            for name in (seg['file'], seg.get('pkl')) if name]
+
+
+def session_files(paths):
+    """Recording files of a measurement in the given order, manifests (MANIFEST_EXTENSION)
+    replaced by their segments. List of dicts with 'path' and 'segment' (manifest entry or None).
+    Raises ValueError if a recording would be counted twice: a file given twice or a
+    segment or .pkl export given along with the manifest of its session."""
+    files, recorded = [], {}
+    for path in paths:
+        if path.endswith(MANIFEST_EXTENSION):
+            folder = os.path.dirname(path)
+            files += [{'path': os.path.join(folder, seg['file']), 'segment': seg}
+                      for seg in read_manifest(path)['segments']]
+            names = manifest_files(path)
+        else:
+            files.append({'path': path, 'segment': None})
+            names = [path]
+        for name in names:
+            key = os.path.abspath(name)
+            if key in recorded:
+                raise ValueError(path + " and " + recorded[key] + " contain the same recording " + name)
+            recorded[key] = path
+    return files
+
+
+def file_live_time(path, segment=None, start=None, stop=None):
+    """Live time [s] of one recording file, see module description.
+    start and stop are the timestamps of its first and last waveform."""
+    if segment is not None:
+        return segment['live_time']
+    dead_time = 0.
+    if path.endswith(pulse_file.FILE_EXTENSION):
+        records = pulse_file.read_json_records(path, (b"END ", b"VETO"))
+        summary = [record for tag, record in records if tag == b"END "]
+        if summary and 'live_time' in summary[-1]:
+            return summary[-1]['live_time']
+        # interrupted recording: the vetoed intervals written so far are dead time
+        dead_time = sum(record['dead_time'] for tag, record in records if tag == b"VETO")
+    if start is None or stop is None:
+        return 0.
+    return max((stop - start) / np.timedelta64(1, 's') - dead_time, 0.)
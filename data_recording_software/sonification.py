@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Sonification of detected pulses with pyo (https://github.com/belangeo/pyo).
+
+The acquisition only hands each pulse to submit(), which puts its peak value
+into a bounded queue without waiting and never calls pyo. A separate thread
+takes the pulses from the queue and triggers the sounds, so the acquisition
+runs the same with and without sound. At high pulse rates
+    - the queue drops the newest pulses when it is full,
+    - at most max_rate sounds per second are started (token bucket, short
+      bursts of up to max_rate sounds are allowed), further pulses are skipped,
+    - at most 'voices' sounds play at the same time, a new sound replaces the
+      voice that would end first (voice stealing) instead of piling up.
+
+The sound itself is the wild Karplus-Strong oscillator of the pulse recorder:
+a ring modulated source excites a waveguide, one envelope and waveguide per
+voice. Louder/longer sounds for larger pulses.
+"""
+
+import queue
+import random
+import threading
+import time
+
+
+class Ring:
+
+    def __init__(self, pyo, tab_m, tab_p, fport=250, fmod=100, amp=.3):
+        self.mod = pyo.Osc(tab_m, freq=fmod, mul=amp)
+        self.port = pyo.Osc(tab_p, freq=fport, mul=self.mod)
+
+    def out(self):
+        self.port.out()
+        return self
+
+    def sig(self):
+        return self.port
+
+
+class Sonifier:
+
+    def __init__(self, output_device=1, voices=3, max_rate=10., queue_size=64):
+        import pyo # only needed with sonification enabled
+        self.pyo = pyo
+        self.max_rate = max_rate      # max. started sounds per second
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.dropped = 0              # pulses lost because the queue was full
+        self.limited = 0              # pulses skipped by the rate limit
+        self.played = 0
+        self.stolen = 0               # sounds cut short by a new one
+        self.tokens = max_rate
+        self.last_refill = time.monotonic()
+
+        self.server = pyo.Server(duplex=0).boot()
+        self.server.deactivateMidi()
+        self.server.setOutputDevice(output_device)
+        pyo.pa_list_devices()
+        self.server.start()
+        tab_m = pyo.HarmTable([1,0,0,0,0,.3,0,0,0,0,0,.2,0,0,0,0,0,.1,0,0,0,0,.05]).normalize()
+        tab_p = pyo.HarmTable([1,0,.33,0,.2,0,.143,0,.111])
+        # setup some wild Karplus-Strong oscillator
+        self.lf = pyo.Sine(.03, mul=.2, add=1)
+        self.rg = Ring(pyo, tab_m, tab_p,
+                       fport = [random.choice([62.5,125,187.5,250]) * random.uniform(.99,1.01) for i in range(8)],
+                       fmod = self.lf * [random.choice([25,50,75,100]) * random.uniform(.99,1.01) for i in range(8)],
+                       amp = 0.1)
+        self.envs, self.res = [], []
+        for i in range(voices):
+            env = pyo.Adsr(attack=0.01, decay=0.1, sustain=0.5, release=1.5, dur=5, mul=0.1)
+            self.envs.append(env)
+            self.res.append(pyo.Waveguide(self.rg.sig(), freq=[30.1,60.05,119.7,181,242.5,303.33], dur=30, mul=1*env).out())
+        self.voice_end = [0.] * voices # time when each voice is silent again
+
+        self.running = True
+        self.worker = threading.Thread(target=self.run, name="sonification", daemon=True)
+        self.worker.start()
+
+    def submit(self, peak):
+        """Called by the acquisition for each pulse, never blocks."""
+        try:
+            self.queue.put_nowait(peak)
+        except queue.Full:
+            self.dropped += 1
+
+    def allow(self):
+        """Token bucket rate limit."""
+        now = time.monotonic()
+        self.tokens = min(self.max_rate, self.tokens + (now - self.last_refill) * self.max_rate)
+        self.last_refill = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def play(self, peak):
+        now = time.monotonic()
+        voice = min(range(len(self.envs)), key=lambda i: self.voice_end[i]) # free or ending first
+        if self.voice_end[voice] > now:
+            self.stolen += 1
+        env = self.envs[voice]
+        self.lf.setMul(abs(int(peak)/16000))
+        env.dur = abs(int(peak)/500)
+        env.play()
+        self.voice_end[voice] = now + env.dur + env.release
+        self.played += 1
+
+    def run(self):
+        while self.running:
+            try:
+                peak = self.queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if self.allow():
+                self.play(peak)
+            else:
+                self.limited += 1
+
+    def stop(self):
+        self.running = False
+        self.worker.join()
+        self.server.stop()
+        print("Sonification:", self.played, "sounds,", self.stolen, "voices stolen,",
+              self.limited, "pulses skipped by the rate limit,", self.dropped, "dropped")
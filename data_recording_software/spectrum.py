@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Online energy spectrum and pulse rates of a running measurement.
+
+The linear energy calibration of the analysis script (poly1 fit of the pulse
+amplitudes 'data_peak' against the reference energies 'ref', see
+analyse_and_plot_pulses.py) is read from a small JSON file:
+    {"a": 0.4958, "b": -116.4, "quantity": "amplitude", "unit": "keV", ...}
+energy = a * amplitude + b, with the amplitude as returned by pulse_finder.
+energy_calibration.json holds the fit of the mixed alpha source reference
+measurement, analyse_and_plot_pulses.py can write a new one.
+
+Each valid pulse is added to a histogram with fixed energy bins and to the
+counts of the current minute of stream time, both in constant time per pulse,
+so a measurement can be judged while it runs. The state is written to the
+.pulses file (SPEC record, see pulse_file.py) and shown in the pulse recorder.
+"""
+
+import json
+import os
+import sys
+import numpy as np
+
+ALPHA = 0 # particle type code, same as in acquisition.py
+CALIBRATION_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "energy_calibration.json")
+
+
+def load_calibration(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def online_calibration(path):
+    """Calibration for the online spectrum, None if path is empty. A missing or unreadable
+    file only disables the spectrum (with a warning), the recording goes on without it."""
+    if not path:
+        return None
+    try:
+        calibration = load_calibration(path)
+        float(calibration['a']), float(calibration['b'])
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        print("Warning: no energy calibration from", path, "(" + repr(e) + "), online spectrum disabled",
+              file=sys.stderr)
+        return None
+    return calibration
+
+
+def save_calibration(path, a, b, **info):
+    """Write a calibration energy = a * amplitude + b, info is stored along (e.g. source, errors)."""
+    cal = {'a': float(a), 'b': float(b), 'quantity': 'amplitude', 'unit': 'keV'}
+    cal.update(info)
+    with open(path, "w") as f:
+        json.dump(cal, f, indent=1, default=str)
+
+
+class EnergySpectrum:
+
+    def __init__(self, calibration, rate, bin_width=33., max_energy=10000.):
+        self.calibration = calibration
+        self.a = calibration['a']
+        self.b = calibration['b']
+        self.rate = rate
+        self.bin_width = bin_width    # [keV], 33 keV as in the simulation comparison of the analysis
+        self.edges = np.arange(0., max_energy + bin_width, bin_width)
+        self.counts = np.zeros(len(self.edges), dtype=np.int64) # last bin: overflow, first also underflow
+        self.minute = int(60 * rate)  # stream samples per rate bin
+        self.per_minute = np.zeros((2, 64), dtype=np.int64) # all pulses, alphas; grows when needed
+        self.first_minute = None
+        self.last_minute = 0
+
+    def energy(self, amplitude):
+        return self.a * amplitude + self.b
+
+    def add(self, amplitude, position, ptype):
+        """Add one pulse with the given amplitude at stream position."""
+        i = int(self.energy(amplitude) // self.bin_width)
+        self.counts[min(max(i, 0), len(self.counts) - 1)] += 1
+        m = position // self.minute
+        if self.first_minute is None:
+            self.first_minute = m
+        m -= self.first_minute
+        if m < 0:
+            return
+        if m >= self.per_minute.shape[1]:
+            grown = np.zeros((2, max(2 * self.per_minute.shape[1], m + 1)), dtype=np.int64)
+            grown[:, :self.per_minute.shape[1]] = self.per_minute
+            self.per_minute = grown
+        self.per_minute[0, m] += 1
+        if ptype == ALPHA:
+            self.per_minute[1, m] += 1
+        self.last_minute = max(self.last_minute, m)
+
+    def rates(self):
+        """Counts per minute of all pulses and of alphas, up to the latest minute."""
+        return self.per_minute[:, :self.last_minute + 1]
+
+    def state(self):
+        """JSON serialisable histogram and rates."""
+        return {'calibration': self.calibration, 'bin_width': self.bin_width,
+                'edges': self.edges.tolist(), 'counts': self.counts.tolist(),
+                'first_minute': self.first_minute, 'counts_per_minute': self.rates()[0].tolist(),
+                'alphas_per_minute': self.rates()[1].tolist()}
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Startup time of the recording and analysis entry points.
+
+Each entry point is started several times in a fresh python interpreter, as
+it would be after booting a recording box, and the median times are printed:
+    total       wall time of the whole interpreter run [s]
+    import      time spent importing the entry point module [s]
+    heavy       large optional modules that got loaded on the way
+                (pandas, scipy, matplotlib, Qt, pyo, ...)
+The 'first frame' line runs replay.py on a short generated WAV file, i.e.
+the time from starting python until the first frames are analysed and the
+report is printed.
+
+analyse_and_plot_pulses.py (in ../data_analysis_and_reference_measurements/
+diode_detector) analyses and plots the selected dataset as soon as it is
+run, so only its imports are timed: pandas, matplotlib and pulse_analysis,
+which is also timed on its own as the entry point of the batch analysis.
+
+Entry points whose requirements are not installed (e.g. pyqtgraph for
+pulse_recorder.py, matplotlib for the analysis script) are reported as such.
+
+Usage:
+    python3 startup_benchmark.py [--runs 5]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import wave
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+ENTRY_POINTS = [("headless_recorder.py", "headless_recorder"),
+                ("replay.py", "replay"),
+                ("pulse_recorder.py", "pulse_recorder"),
+                ("pulse_analysis.py", "pulse_analysis"),
+                ("analyse_and_plot_pulses.py", "pandas, matplotlib.pyplot, matplotlib.gridspec, pulse_analysis, spectrum"),
+                ("analysis modules", "pulse_finder, pulse_file, session, spectrum")]
+
+HEAVY = ["pandas", "scipy", "matplotlib", "pyqtgraph", "PyQt5", "PySide2", "pyo", "msgpack", "pyaudio"]
+
+PROBE = """
+import json, sys, time
+t = time.perf_counter()
+try:
+    import {modules}
+    error = None
+except ImportError as e:
+    error = repr(e)
+t = time.perf_counter() - t
+print(json.dumps({{'import': t, 'error': error,
+                  'heavy': [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+
+def run(args):
+    t = time.perf_counter()
+    out = subprocess.run([sys.executable] + args, cwd=HERE, stdout=subprocess.PIPE,
+                         stderr=subprocess.DEVNULL, universal_newlines=True, check=False).stdout
+    return time.perf_counter() - t, out
+
+
+def bench_import(modules, runs):
+    totals, imports = [], []
+    for i in range(runs):
+        total, out = run(["-c", PROBE.format(modules=modules, heavy=HEAVY)])
+        result = json.loads(out.strip().splitlines()[-1])
+        if result['error']:
+            return "not available: " + result['error']
+        totals.append(total)
+        imports.append(result['import'])
+    return "total {0:6.3f} s, import {1:6.3f} s, heavy: {2}".format(
+        statistics.median(totals), statistics.median(imports), ", ".join(result['heavy']) or "-")
+
+
+def bench_first_frame(runs, seconds=2., rate=48000):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "noise.wav")
+        samples = np.random.RandomState(1).normal(0, 20, int(seconds * rate)).astype(np.int16)
+        with wave.open(path, "wb") as f:
+            f.setnchannels(1)
+            f.setsampwidth(2)
+            f.setframerate(rate)
+            f.writeframes(samples.tobytes())
+        totals = [run(["replay.py", path])[0] for i in range(runs)]
+    return "total {0:6.3f} s for {1:g} s of audio".format(statistics.median(totals), seconds)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Measure the startup time of the entry points.")
+    parser.add_argument("--runs", type=int, default=5, help="fresh interpreters per entry point (median)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    print("python", sys.version.split()[0], "- median of", args.runs, "runs")
+    for name, modules in ENTRY_POINTS:
+        print("{0:28s}".format(name), bench_import(modules, args.runs))
+    print("{0:28s}".format("first frame (replay)"), bench_first_frame(args.runs))
+
+
+if __name__ == '__main__':
+    main()
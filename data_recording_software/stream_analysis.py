@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Out-of-core pulse analysis of datasets larger than the memory.
+
+analyse_blocks() streams one or more datasets in blocks of a fixed number of
+waveforms (dataset.iter_blocks(), memory-mapped for .pulses and .wav files)
+through
+    - the pulse finder (find_pulses_block() in pulse_finder.py),
+    - the persistence map of the pulse shapes (PulseMap below),
+    - an optional callback, e.g. for plotting the detected pulses,
+and only keeps the compact per-pulse results (one row of
+pulse_finder.RESULT_DTYPE per pulse: file, timestamp, waveform index,
+position, width, peak, amplitude, area). The amplitude histograms of the
+analysis are made from these results. The memory needed is bounded by the
+block size and the number of pulses, not by the length of the run.
+
+The persistence map replaces the lists of pulse shapes (xpulses, ypulses) of
+analyse_and_plot_pulses.py: every found pulse is cut out and aligned like
+there (100 samples before and after, minimum shifted to sample 50 with
+np.roll, the first 130 samples dropped, only snippets longer than min_length)
+and added to a 2d histogram of sample index versus signal value, which is
+accumulated per block. Differences to the lists of the original script:
+    - the snippet starts at max(x1 - 100, 0), the original slice
+      y[x1-100:x2+100] wrapped around for pulses starting within the first
+      100 samples (and was mostly empty, so these pulses were missing),
+    - shorter snippets just end, the original padded all of them with zeros
+      to the longest one and counted the padding as signal value 0,
+    - the signal values are binned with fixed edges, floor((y + 32768) / y_bin),
+      image() returns the lower edges; the original rounded (y - ymin) / divy
+      with ymin the lowest sample of all pulses, i.e. data dependent edges
+      shifted by half a bin.
+
+Datasets with stored windows count only the pulse starting at the window
+offset, as in the analysis script (pulse_finder.window_pulses()).
+"""
+
+import numpy as np
+
+import pulse_finder
+from pulse_finder import RESULT_DTYPE, THL
+from dataset import iter_blocks, BLOCK_SIZE
+
+PRE, POST = 100, 100 # samples cut out before and after each pulse
+SHIFT = 50           # position of the pulse minimum after aligning
+DROP = 130           # leading samples dropped after aligning
+
+
+class PulseMap:
+    """2d histogram of aligned pulse shapes: sample index x signal value."""
+
+    def __init__(self, max_length=pulse_finder.MAX_LENGTH, min_length=pulse_finder.MIN_LENGTH, y_bin=20):
+        self.min_length = min_length
+        self.length = max_length + PRE + POST - DROP # longest aligned pulse
+        self.y_bin = y_bin                           # finest resolution of the signal value
+        self.y_min = -32768
+        self.ny = 65536 // y_bin + 1
+        self.counts = np.zeros((self.length, self.ny), dtype=np.int64)
+        self.pulses = 0
+
+    def add(self, waves, pulses, step=4096):
+        """Add the pulses (pulse_finder result, frame = row of waves) of one block."""
+        for i in range(0, len(pulses), step): # bounds the temporary index arrays
+            self.add_pulses(waves, pulses[i:i+step])
+
+    def add_pulses(self, waves, pulses):
+        n = waves.shape[1]
+        rows = pulses['frame'][:, None] # samples are gathered from the block, rows are not copied
+        x1 = pulses['position'].astype(np.int64)
+        width = pulses['width'].astype(np.int64)
+        # position of the minimum inside the pulse
+        j = np.arange(width.max())
+        inside = j < width[:, None]
+        pulse = waves[rows, np.minimum(x1[:, None] + j, n - 1)]
+        low = np.where(inside, pulse, np.iinfo(np.int16).max).argmin(axis=1)
+        # np.roll(y[x1-PRE:x2+POST], SHIFT - low)[DROP:] as in the analysis script
+        a = np.maximum(x1 - PRE, 0)
+        size = np.minimum(x1 + width + POST, n) - a
+        k = DROP + np.arange(self.length)
+        valid = (k < size[:, None]) & (size[:, None] - DROP > self.min_length)
+        values = waves[rows, a[:, None] + (k - (SHIFT - low)[:, None]) % size[:, None]]
+        x = np.broadcast_to(np.arange(self.length), values.shape)[valid]
+        yi = (values[valid].astype(np.int64) - self.y_min) // self.y_bin
+        self.counts += np.bincount(x * self.ny + yi, minlength=self.counts.size).reshape(self.counts.shape)
+        self.pulses += np.count_nonzero(valid.any(axis=1))
+
+    def image(self, y_bin=180):
+        """Counts in bins of y_bin (a multiple of the finest resolution) and the lower bin edges of the signal values."""
+        factor = max(int(round(y_bin / self.y_bin)), 1)
+        ny = -(-self.ny // factor)
+        counts = np.zeros((self.length, ny * factor), dtype=np.int64)
+        counts[:, :self.ny] = self.counts
+        return counts.reshape(self.length, ny, factor).sum(axis=2), self.y_min + np.arange(ny) * factor * self.y_bin
+
+
+def analyse_blocks(paths, thl=THL, block_size=BLOCK_SIZE, pulse_map=True, on_block=None, **params):
+    """Find the pulses of the given dataset files block by block.
+    on_block(block, found) is called for each block, found being the pulse_finder
+    result with frame = row in the block. Returns a dict with
+        'pulses'   RESULT_DTYPE array in file and waveform order
+        'files'    per file: path, waveforms (below thl), start and stop timestamp
+        'map'      PulseMap of all pulses (None if not requested)"""
+    params['thl'] = thl
+    pmap = PulseMap(params.get('max_length', pulse_finder.MAX_LENGTH),
+                    params.get('min_length', pulse_finder.MIN_LENGTH)) if pulse_map else None
+    parts, files = [], []
+    for i, path in enumerate(paths):
+        info = {'path': path, 'waveforms': 0, 'start': None, 'stop': None}
+        files.append(info)
+        for block in iter_blocks(path, block_size):
+            ts = block['ts']
+            if len(ts) == 0:
+                continue
+            if info['start'] is None:
+                info['start'] = ts[0]
+            info['stop'] = ts[-1]
+            waves = block['pulse']
+            keep = np.flatnonzero(waves.min(axis=1) < thl) # THL prefilter, frames above can't contain pulses
+            info['waveforms'] += len(keep)
+            found = pulse_finder.find_pulses_block(waves[keep], starts=block['offset'][keep] if block['offset'] is not None else None,
+                                                   **params)
+            found['frame'] = keep[found['frame']]
+            if block['offset'] is not None:
+                found = pulse_finder.window_pulses(found, block['offset'])
+            if pmap is not None:
+                pmap.add(waves, found)
+            if on_block is not None:
+                on_block(block, found)
+            part = np.zeros(len(found), dtype=RESULT_DTYPE)
+            for name in pulse_finder.PULSE_DTYPE.names:
+                part[name] = found[name]
+            part['file'] = i
+            part['frame'] = block['index'][found['frame']]
+            part['ts'] = ts[found['frame']]
+            parts.append(part)
+    return {'pulses': np.concatenate(parts) if parts else np.zeros(0, dtype=RESULT_DTYPE),
+            'files': files, 'map': pmap}
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Veto of electromagnetic interference bursts ("noise storms").
+
+A switching motor or a phone close to the detector cable can trigger every
+audio frame, which would fill the disk with useless waveforms. A triggered
+frame is vetoed, i.e. not searched for pulses and not stored, if
+    - it crosses the threshold more often than max_crossings times
+      (real pulses rarely pile up more than a few times per frame), or
+    - it swings between large positive and negative values more often than
+      max_sign_changes times (detector pulses are unipolar, only samples
+      beyond half the threshold are taken into account).
+Optionally (rate_factor, off by default) also if
+    - the fraction of triggered frames within the last second is more than
+      rate_factor times the long term average. This can't tell a burst from a
+      real rise of the count rate, e.g. a source put in front of the detector:
+      all frames except those vetoed for their shape update the average, so a
+      sustained higher rate is accepted again after about 1 / weight frames,
+      but the pulses of the frames vetoed until then are lost.
+
+Consecutive vetoed frames form a veto interval, which is dead time of the
+measurement: the analysis has to subtract it from the live time.
+"""
+
+from collections import deque
+import numpy as np
+
+
+class BurstVeto:
+
+    def __init__(self, rate, frame_size, max_crossings=20, max_sign_changes=40, rate_factor=None,
+                 min_burst_fraction=0.5, warmup=600, weight=0.001):
+        self.max_crossings = max_crossings
+        self.max_sign_changes = max_sign_changes
+        self.rate_factor = rate_factor # None: no veto by trigger rate
+        self.min_burst_fraction = min_burst_fraction # fraction of triggered frames always accepted
+        self.warmup = warmup          # frames needed for the long term average (about 50 s)
+        self.weight = weight          # weight of each frame in the long term average
+        self.recent = deque(maxlen=max(int(round(rate / frame_size)), 1)) # trigger flags of the last second
+        self.average = 0.             # long term fraction of triggered frames
+        self.frames = 0
+
+    def check(self, samples, thl, triggered):
+        """Reason for vetoing this frame or None. Call for every frame."""
+        self.recent.append(triggered)
+        reason = None
+        if triggered:
+            below = samples < thl
+            crossings = np.count_nonzero(below[1:] & ~below[:-1])
+            big = samples[np.abs(samples) > abs(thl) / 2]
+            sign_changes = np.count_nonzero(np.diff(big > 0))
+            fraction = sum(self.recent) / len(self.recent)
+            if crossings > self.max_crossings:
+                reason = "crossings"
+            elif sign_changes > self.max_sign_changes:
+                reason = "sign changes"
+            elif (self.rate_factor is not None and self.frames >= self.warmup
+                  and fraction > self.min_burst_fraction and fraction > self.rate_factor * self.average):
+                reason = "trigger rate"
+        if reason in (None, "trigger rate"):
+            self.frames += 1
+            # plain mean until the exponential average has enough frames
+            self.average += max(self.weight, 1 / self.frames) * (triggered - self.average)
+        return reason